@@ -3,38 +3,196 @@
 ################################################################################
 """---1.0 Import Modules---"""
 
+import numpy as np
 import pandas as pd
 import pathlib
+from Blast_Tabular_Reader import BLAST_COLUMNS, read_tabular_batches
 import argparse, sys
 
 ################################################################################
 """---2.0 Define Functions---"""
 
-def Blast_2_Matrix(Files_List, Num_Ext):
+def Count_Subjects(Arguments):
+    """
+    Counts the reads mapped to each subject in a Blast file.
+
+    Arguments:
+        Arguments {tuple} -- (Blast file, number of extensions to remove from the name)
+
+    Returns:
+        [tuple] -- Sample name, subject IDs and read counts per subject
+    """
+    File, Num_Ext = Arguments
+    print("Processing {}...".format(File))
+    Filename = pathlib.Path(File)
+    # Remove as many extensions as indicated.
+    for num in range(1,Num_Ext+1):
+        Name = Filename.stem
+        Filename = pathlib.Path(Name)
+    # Count reads per subject code.
+    Subjects = {}
+    File_Counts = np.zeros(0, dtype=np.int64)
+    for Hits in read_tabular_batches(File, BLAST_COLUMNS, ["sseqid"], dictionaries={"sseqid": Subjects}):
+        Batch_Counts = np.bincount(Hits["sseqid"], minlength=len(File_Counts))
+        Batch_Counts[:len(File_Counts)] += File_Counts
+        File_Counts = Batch_Counts
+    return str(Filename), list(Subjects), File_Counts
+
+
+def Blast_2_Sparse_Matrix(Files_List, Num_Ext, Threads=1):
+    """
+    Builds a sparse subject x sample read count matrix from multiple Blast files.
+    Files are counted in parallel and subjects are indexed in order of appearance.
+
+    Arguments:
+        Files_List {list} -- Blast files
+        Num_Ext {int} -- Number of extensions to remove from the file names
+        Threads {int} -- Number of files processed in parallel
+
+    Returns:
+        [tuple] -- CSR matrix (subjects x samples), subject IDs and sample names
+    """
+    from scipy import sparse
     Num_Ext = int(Num_Ext)
-    # Create empty dataframe.
-    Read_Matrix = pd.DataFrame()
-
-    for File in Files_List:
-        print("Processing {}...".format(File))
-        Filename = pathlib.Path(File)
-        # Remove as many extensions as indicated.
-        for num in range(1,Num_Ext+1):
-            Name = Filename.stem
-            Filename = pathlib.Path(Name)
-        # Add column and fill with 0.
-        Read_Matrix[Filename] = 0
-        with open(File) as Blast_File:
-            for line in Blast_File:
-                line = line.strip()
-                line = line.split(sep="\t")
-                if line[1] not in Read_Matrix.index:
-                    Read_Matrix = Read_Matrix.reindex(Read_Matrix.index.values.tolist()+[line[1]], fill_value=0)
-                    Read_Matrix.loc[line[1],Filename] += 1
-                else:
-                    Read_Matrix.loc[line[1],Filename] += 1
-
-    return Read_Matrix
+    # Subject IDs are encoded as integers, shared by all files.
+    Subjects = {}
+    Samples = []
+    Rows = []
+    Columns = []
+    Data = []
+    Arguments = [(File, Num_Ext) for File in Files_List]
+    if Threads > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(Threads, len(Files_List)))
+        try:
+            Results = pool.imap(Count_Subjects, Arguments)
+            for Filename, File_Subjects, File_Counts in Results:
+                Add_Sample(Filename, File_Subjects, File_Counts, Subjects, Samples, Rows, Columns, Data)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for Argument in Arguments:
+            Filename, File_Subjects, File_Counts = Count_Subjects(Argument)
+            Add_Sample(Filename, File_Subjects, File_Counts, Subjects, Samples, Rows, Columns, Data)
+
+    if Data:
+        Rows = np.concatenate(Rows)
+        Columns = np.concatenate(Columns)
+        Data = np.concatenate(Data)
+    Matrix = sparse.coo_matrix((Data, (Rows, Columns)), shape=(len(Subjects), len(Samples)), dtype=np.int64)
+    return Matrix.tocsr(), list(Subjects), Samples
+
+
+def Add_Sample(Filename, File_Subjects, File_Counts, Subjects, Samples, Rows, Columns, Data):
+    """
+    Appends the counts of one file as COO entries, translating its subject codes to the shared ones.
+
+    Arguments:
+        Filename {string} -- Sample name
+        File_Subjects {list} -- Subject IDs of the file, in code order
+        File_Counts {array} -- Read counts per file subject code
+        Subjects {dictionary} -- Shared subject ID: code, updated in place
+        Samples {list} -- Sample names, updated in place
+        Rows, Columns, Data {list} -- COO arrays, updated in place
+    """
+    Codes = np.fromiter((Subjects.setdefault(Subject, len(Subjects)) for Subject in File_Subjects),
+                        dtype=np.int64, count=len(File_Subjects))
+    Present = np.flatnonzero(File_Counts)
+    Rows.append(Codes[Present])
+    Columns.append(np.full(len(Present), len(Samples), dtype=np.int64))
+    Data.append(File_Counts[Present])
+    Samples.append(Filename)
+
+
+def Blast_2_Matrix(Files_List, Num_Ext, Threads=1):
+    """
+    Creates a dense read count table (subjects x samples) from multiple Blast files.
+
+    Arguments:
+        Files_List {list} -- Blast files
+        Num_Ext {int} -- Number of extensions to remove from the file names
+        Threads {int} -- Number of files processed in parallel
+
+    Returns:
+        [DataFrame] -- Read counts with subjects as index and samples as columns
+    """
+    Matrix, Subjects, Samples = Blast_2_Sparse_Matrix(Files_List, Num_Ext, Threads)
+    return pd.DataFrame(Matrix.toarray(), index=Subjects, columns=Samples)
+
+
+def Write_Dense_Matrix(Matrix, Subjects, Samples, Output_File):
+    """
+    Writes the matrix as a tab-separated table.
+
+    Arguments:
+        Matrix {sparse matrix} -- Subjects x samples counts
+        Subjects {list} -- Row names
+        Samples {list} -- Column names
+        Output_File {filepath} -- Output table
+    """
+    Matrix = Matrix.tocsr()
+    with open(Output_File, 'w') as Output:
+        Output.write("\t" + "\t".join(Samples) + "\n")
+        # Densify in blocks of rows to bound memory.
+        for Start in range(0, Matrix.shape[0], 10000):
+            Block = Matrix[Start:Start+10000].toarray()
+            for Subject, Row in zip(Subjects[Start:Start+10000], Block):
+                Output.write(Subject + "\t" + "\t".join(map(str, Row.tolist())) + "\n")
+
+
+def Write_Matrix_Market(Matrix, Subjects, Samples, Output_File):
+    """
+    Writes the matrix in Matrix Market format, with the row and column names in
+    Output_File.rows and Output_File.cols.
+
+    Arguments:
+        Matrix {sparse matrix} -- Subjects x samples counts
+        Subjects {list} -- Row names
+        Samples {list} -- Column names
+        Output_File {filepath} -- Output .mtx file
+    """
+    from scipy.io import mmwrite
+    mmwrite(Output_File, Matrix.tocoo(), field="integer")
+    with open(Output_File + ".rows", 'w') as Rows:
+        Rows.write("\n".join(Subjects) + "\n")
+    with open(Output_File + ".cols", 'w') as Columns:
+        Columns.write("\n".join(Samples) + "\n")
+
+
+def Write_Sparse_Npz(Matrix, Subjects, Samples, Output_File):
+    """
+    Writes the matrix as a compressed numpy archive with the CSR arrays (data, indices,
+    indptr, shape) and the row (subjects) and column (samples) names.
+
+    Arguments:
+        Matrix {sparse matrix} -- Subjects x samples counts
+        Subjects {list} -- Row names
+        Samples {list} -- Column names
+        Output_File {filepath} -- Output .npz file
+    """
+    Matrix = Matrix.tocsr()
+    with open(Output_File, 'wb') as Output:
+        np.savez_compressed(Output, data=Matrix.data, indices=Matrix.indices, indptr=Matrix.indptr,
+                            shape=np.array(Matrix.shape), subjects=np.array(Subjects, dtype=str),
+                            samples=np.array(Samples, dtype=str))
+
+
+def Read_Sparse_Npz(Input_File):
+    """
+    Reads a matrix written by Write_Sparse_Npz.
+
+    Arguments:
+        Input_File {filepath} -- .npz file
+
+    Returns:
+        [tuple] -- CSR matrix, subject IDs and sample names
+    """
+    from scipy import sparse
+    with np.load(Input_File) as Archive:
+        Matrix = sparse.csr_matrix((Archive["data"], Archive["indices"], Archive["indptr"]),
+                                   shape=tuple(Archive["shape"]))
+        return Matrix, Archive["subjects"].tolist(), Archive["samples"].tolist()
 
 ################################################################################
 """---3.0 Main Function---"""
@@ -47,17 +205,28 @@ def main():
     parser.add_argument('-l', '--List', dest='Files_List', action='store', required=True, nargs='+', help='List of Blast Files (Name will be used as column names)')
     parser.add_argument('-o', '--output', dest='Output_File', action='store', required=False, help='Output table with reads mapped per subject, if none, "Matrix_Counts.tab".', default="Matrix_Counts.tab")
     parser.add_argument('--ext', dest='Num_Ext', action='store', type=int, help='Number of extensions to remove from file name, e.g. 1 to remove .blast from Genome1.blast. If none, 1', default=1)
+    parser.add_argument('--format', dest='Format', action='store', choices=['tsv', 'mtx', 'npz'], required=False, default='tsv',
+                        help='Output format: dense tab-separated table (tsv), Matrix Market (mtx, with .rows and .cols name files)\n'
+                        'or compressed sparse numpy archive (npz). If none, tsv')
+    parser.add_argument('-t', '--threads', dest='Threads', action='store', type=int, required=False, default=1, help='Number of files processed in parallel. If none, 1')
     args = parser.parse_args()
 
     Files_List = args.Files_List
     Output_File = args.Output_File
     Num_Ext = args.Num_Ext
+    Format = args.Format
+    Threads = args.Threads
 
-    # Return dataframes
-    Read_Table = Blast_2_Matrix(Files_List, Num_Ext)
+    # Build the sparse count matrix.
+    Matrix, Subjects, Samples = Blast_2_Sparse_Matrix(Files_List, Num_Ext, Threads)
 
-    # Export both dataframes to tab-separated tables.
-    Read_Table.to_csv(Output_File, sep='\t')
+    # Export the matrix.
+    if Format == 'mtx':
+        Write_Matrix_Market(Matrix, Subjects, Samples, Output_File)
+    elif Format == 'npz':
+        Write_Sparse_Npz(Matrix, Subjects, Samples, Output_File)
+    else:
+        Write_Dense_Matrix(Matrix, Subjects, Samples, Output_File)
 
 if __name__ == "__main__":
     main()
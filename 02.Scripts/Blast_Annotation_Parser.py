@@ -3,43 +3,43 @@
 """------------------------- 0.0 Import Modules -----------------------------"""
 
 import sys, argparse, os
-from Bio import SeqIO
-import pandas as pd
+from Blast_Tabular_Reader import BLAST_COLUMNS, BLAST_STD_COLUMNS, parse_column_spec, open_tabular, read_tabular_batches
+from Blast_Filter_Expression import compile_vectorized_filter
 
 """----------------------------- 1.0 Define Functions -----------------------------"""
 
-def HitConfidence(GeneID, identity, bitscore, long, qlen = 100, slen = 100):
-    if long == True:
-        if (int(min(qlen,slen))/int(max(qlen,slen))*100 >= 80) and float(bitscore) >= 80 and float(identity) >= 40:
-            return(GeneID)
-    else:
-        if float(bitscore) >= 80 and float(identity) >= 40:
-            return(GeneID)
-
-def Blast_Parser(BlastFile):
+def Blast_Parser(BlastFile, Expression = None, Columns = None):
     print("Reading Blast Output")
-    BlastFile = pd.read_csv(BlastFile, sep="\t", header=None)
-    if len(BlastFile.columns) > 12:
-        print("I am assuming your Blast output has qlen and slen besides the standard output columns")
-        ID_List = (BlastFile.apply(lambda row: HitConfidence(row[0], row[2], row[11], True, row[12], row[13]), axis=1)).tolist()
-    else:
-        print("I am assuming your Blast output has the standard output")
-        ID_List = (BlastFile.apply(lambda row: HitConfidence(row[0], row[2], row[11], True), axis=1)).tolist()
-    ID_List = [i for i in ID_List if i is not None]
-    return(ID_List)
+    if Columns == None:
+        with open_tabular(BlastFile) as Blast_Input:
+            Columns = BLAST_COLUMNS if len(Blast_Input.readline().strip().split("\t")) > 12 else BLAST_STD_COLUMNS
+    if Expression == None:
+        if "qlen" in Columns and "slen" in Columns:
+            print("I am assuming your Blast output has qlen and slen besides the standard output columns")
+            Expression = "min(qlen, slen) / max(qlen, slen) * 100 >= 80 and bitscore >= 80 and pident >= 40"
+        else:
+            print("I am assuming your Blast output has the standard output")
+            Expression = "bitscore >= 80 and pident >= 40"
+    print("Filter: " + Expression)
+    Hit_Filter = compile_vectorized_filter(Expression, Columns)
+    Usecols = ["qseqid"] + [Column for Column in Hit_Filter.columns if Column != "qseqid"]
+    ID_Set = set()
+    for Hits in read_tabular_batches(BlastFile, Columns, Usecols):
+        ID_Set.update(Hits["qseqid"][Hit_Filter(Hits)].tolist())
+    return(ID_Set)
 
-def FastA_Filter(List, FastaFile, Reverse, Output):
-    records = SeqIO.parse(FastaFile, "fasta")
-    if Reverse == True:
-        with open(Output, 'a') as f_out:
-            for record in records:
-                if record.id not in List:
-                    SeqIO.write(record, f_out, "fasta")
-    if Reverse == False:
-        with open(Output, 'a') as f_out:
-            for record in records:
-                if record.id in List:
-                    SeqIO.write(record, f_out, "fasta")
+def FastA_Filter(IDs, FastaFile, Reverse, Output):
+    # Records are copied as raw lines, the sequence ID is the first word of the header.
+    IDs = set(IDs)
+    Keep = False
+    with open_tabular(FastaFile) as f_in, open(Output, 'a') as f_out:
+        for line in f_in:
+            if line.startswith(">"):
+                Words = line[1:].split(None, 1)
+                Record_ID = Words[0] if Words else ""
+                Keep = (Record_ID in IDs) != Reverse
+            if Keep == True:
+                f_out.write(line)
 
 def main():
     parser = argparse.ArgumentParser(description='''Given a Blast output and a FastA file, determines which sequences had good matches and retrieves
@@ -49,6 +49,8 @@ def main():
     parser.add_argument('-f', '--fasta', dest='Fasta_File', action='store', required=True, help='FastA file to filter')
     parser.add_argument('-b', '--blast', dest='Blast_File', action='store', required=True, help='Blast output of the FastA file search agains a DB')
     parser.add_argument('-o', '--output', dest='Output_File', action='store', required=True, help='Output FastA file with retrieved sequences')
+    parser.add_argument('--filter', dest='Expression', action='store', help='Filter expression for good matches, by default "min(qlen, slen) / max(qlen, slen) * 100 >= 80 and bitscore >= 80 and pident >= 40"')
+    parser.add_argument('--columns', dest='Columns', action='store', help='Columns of the Blast output, as given to -outfmt 6 ("std" accepted). By default "std", or "std qlen slen" if the file has more than 12 columns')
     parser.add_argument('--inverse', action='store_false', help='Retrieve the sequences with good matches. By default False, i.e. retrieves those without matches')
     args = parser.parse_args()
 
@@ -56,9 +58,11 @@ def main():
     Blast_File = args.Blast_File
     Output_File = args.Output_File
     Inverse = args.inverse
+    Expression = args.Expression
+    Columns = parse_column_spec(args.Columns) if args.Columns else None
 
-    ID_List = Blast_Parser(Blast_File)
-    FastA_Filter(ID_List, Fasta_File, Inverse, Output_File)
+    ID_Set = Blast_Parser(Blast_File, Expression, Columns)
+    FastA_Filter(ID_Set, Fasta_File, Inverse, Output_File)
 
 if __name__ == "__main__":
     main()
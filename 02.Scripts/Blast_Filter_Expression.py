@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+"""
+########################################################################
+# Author:       Carlos A. Ruiz-Perez
+# Email:        cruizperez3@gatech.edu
+# Github:       https://github.com/cruizperez
+# Institution:  Georgia Institute of Technology
+# Version:      0.1
+# Date:         15 February 2020
+
+# Description: This module compiles filter expressions for Blast and
+# MagicBlast tabular hits, e.g.
+# "pident >= 30 and bitscore >= 50 and aln_len / min(qlen, slen) >= 0.7"
+# The expression is parsed and validated once and compiled into either a
+# per-line predicate (for split lines) or a vectorized predicate (for
+# tables of column arrays). Only the columns used in the expression are
+# ever converted.
+########################################################################
+"""
+
+################################################################################
+
+"""---1.0 Import Modules---"""
+
+import ast
+from Blast_Tabular_Reader import BLAST_COLUMNS, STRING_COLUMNS
+
+################################################################################
+
+"""---2.0 Define Functions---"""
+
+COLUMN_ALIASES = {"aln_len": "length", "identity": "pident"}
+
+# Functions allowed in expressions: (per-line function, numpy function name)
+FILTER_FUNCTIONS = {"min": (min, "minimum"), "max": (max, "maximum"), "abs": (abs, "abs")}
+
+# Number of arguments taken by each function: (fewest, most), None for no limit
+FUNCTION_ARGUMENTS = {"min": (2, None), "max": (2, None), "abs": (1, 1)}
+
+ALLOWED_NODES = (ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.USub, ast.UAdd,
+                 ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Mod, ast.Pow, ast.Compare,
+                 ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Call, ast.Name, ast.Load,
+                 ast.Constant)
+
+
+def parse_filter_expression(expression, columns=BLAST_COLUMNS):
+    """
+    Parses and validates a filter expression.
+
+    Arguments:
+        expression {string} -- Filter expression
+        columns {list} -- Column names, in the order of the tabular file
+
+    Returns:
+        [tuple] -- Expression tree and names of the columns used
+    """
+    try:
+        tree = ast.parse(expression.strip(), mode="eval")
+    except SyntaxError:
+        raise ValueError("Could not parse filter expression: {}".format(expression))
+    used_columns = []
+    called_functions = set()
+    # ast.walk visits each call before its function name, so called names are known when reached.
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES):
+            raise ValueError("Unsupported element '{}' in filter expression: {}".format(
+                             type(node).__name__, expression))
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in FILTER_FUNCTIONS or node.keywords:
+                raise ValueError("Only {} can be called in filter expressions".format(", ".join(FILTER_FUNCTIONS)))
+            fewest, most = FUNCTION_ARGUMENTS[node.func.id]
+            if any(isinstance(argument, ast.Starred) for argument in node.args):
+                raise ValueError("Starred arguments are not allowed in filter expression: {}".format(expression))
+            if len(node.args) < fewest or (most is not None and len(node.args) > most):
+                raise ValueError("Function '{}' takes {} in filter expression: {}".format(node.func.id,
+                                 "exactly 1 argument" if most == 1 else "at least {} arguments".format(fewest), expression))
+            called_functions.add(id(node.func))
+        elif isinstance(node, ast.Name) and node.id in FILTER_FUNCTIONS:
+            if id(node) not in called_functions:
+                raise ValueError("Function '{}' must be called in filter expression: {}".format(node.id, expression))
+        elif isinstance(node, ast.Name):
+            node.id = COLUMN_ALIASES.get(node.id, node.id)
+            if node.id not in columns:
+                raise ValueError("Unknown column '{}' in filter expression. Available columns: {}".format(
+                                 node.id, " ".join(columns)))
+            if node.id not in used_columns:
+                used_columns.append(node.id)
+    return tree, used_columns
+
+
+def compile_filter(expression, columns=BLAST_COLUMNS):
+    """
+    Compiles a filter expression into a predicate over a split tabular line.
+
+    Arguments:
+        expression {string} -- Filter expression
+        columns {list} -- Column names, in the order of the tabular file
+
+    Returns:
+        [function] -- Predicate taking a list of fields and returning True or False.
+                      The names of the columns used are stored in predicate.columns
+    """
+    tree, used_columns = parse_filter_expression(expression, columns)
+    source = ["def predicate(hit):"]
+    for column in used_columns:
+        if column in STRING_COLUMNS:
+            source.append("    {} = hit[{}]".format(column, columns.index(column)))
+        else:
+            source.append("    {} = float(hit[{}])".format(column, columns.index(column)))
+    source.append("    return bool({})".format(ast.unparse(tree.body)))
+    namespace = {name: functions[0] for name, functions in FILTER_FUNCTIONS.items()}
+    exec(compile("\n".join(source), "<filter: {}>".format(expression), "exec"), namespace)
+    predicate = namespace["predicate"]
+    predicate.columns = used_columns
+    predicate.expression = expression
+    return predicate
+
+
+class _VectorizeExpression(ast.NodeTransformer):
+    """Rewrites boolean logic and comparison chains into elementwise numpy operations."""
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        operator = ast.BitAnd() if isinstance(node.op, ast.And) else ast.BitOr()
+        result = node.values[0]
+        for value in node.values[1:]:
+            result = ast.BinOp(left=result, op=operator, right=value)
+        return result
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return ast.UnaryOp(op=ast.Invert(), operand=node.operand)
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        terms = [node.left] + node.comparators
+        result = None
+        for left, operator, right in zip(terms[:-1], node.ops, terms[1:]):
+            comparison = ast.Compare(left=left, ops=[operator], comparators=[right])
+            result = comparison if result is None else ast.BinOp(left=result, op=ast.BitAnd(), right=comparison)
+        return result
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        function = "_" + FILTER_FUNCTIONS[node.func.id][1]
+        result = node.args[0]
+        for argument in node.args[1:]:
+            result = ast.Call(func=ast.Name(id=function, ctx=ast.Load()), args=[result, argument], keywords=[])
+        if len(node.args) == 1:
+            result = ast.Call(func=ast.Name(id=function, ctx=ast.Load()), args=[result], keywords=[])
+        return result
+
+
+def compile_vectorized_filter(expression, columns=BLAST_COLUMNS):
+    """
+    Compiles a filter expression into a predicate over a table of columns.
+
+    Arguments:
+        expression {string} -- Filter expression
+        columns {list} -- Column names, in the order of the tabular file
+
+    Returns:
+        [function] -- Predicate taking a table (DataFrame or dictionary of arrays, indexed
+                      by column name) and returning a boolean numpy array.
+                      The names of the columns used are stored in predicate.columns
+    """
+    import numpy as np
+    tree, used_columns = parse_filter_expression(expression, columns)
+    tree = ast.fix_missing_locations(_VectorizeExpression().visit(tree))
+    code = compile(tree, "<filter: {}>".format(expression), "eval")
+    namespace = {"_" + functions[1]: getattr(np, functions[1]) for functions in FILTER_FUNCTIONS.values()}
+
+    def predicate(table):
+        arrays = {column: np.asarray(table[column]) for column in used_columns}
+        mask = eval(code, namespace, arrays)
+        rows = len(next(iter(arrays.values()))) if arrays else len(table)
+        return np.broadcast_to(np.asarray(mask, dtype=bool), (rows,))
+
+    predicate.columns = used_columns
+    predicate.expression = expression
+    return predicate
@@ -5,121 +5,111 @@
 import sys, argparse, os
 import pandas as pd
 from random import randrange
+from Blast_Tabular_Reader import BLAST_COLUMNS, BLAST_STD_COLUMNS, parse_column_spec, open_tabular, is_compressed
+from Blast_Filter_Expression import compile_filter
 
 """----------------------------- 1.0 Define Functions -----------------------------"""
 ### ------------------------------Match filter--------------------------------------
-def HitConfidence(line, id, bitscore, evalue, Aln_Percent = None, Shorter = None, Query = None, Subject = None):
-    if Aln_Percent == None:
-        if float(line[2]) >= float(id) and float(line[11]) >= float(bitscore) and float(line[10]) <= float(evalue):
-            High_Quality_Match = True
-        else:
-            High_Quality_Match = False
-    else:
+def Filter_Expression(id, bitscore, evalue, Aln_Percent = None, Shorter = None, Query = None, Subject = None):
+    Expression = "pident >= {!r} and bitscore >= {!r} and evalue <= {!r}".format(float(id), float(bitscore), float(evalue))
+    if Aln_Percent != None:
         if Shorter == True:
-            if (int(line[3])*100/min(int(line[13]),int(line[12])) >= float(Aln_Percent)) and float(line[11]) >= float(bitscore) and float(line[2]) >= float(id) and float(line[10]) <= float(evalue):
-                High_Quality_Match = True
-            else:
-                High_Quality_Match = False
+            Aligned_On = "min(qlen, slen)"
         elif Query == True:
-            if (int(line[3])*100/int(line[12])) >= float(Aln_Percent) and float(line[11]) >= float(bitscore) and float(line[2]) >= float(id) and float(line[10]) <= float(evalue):
-                High_Quality_Match = True
-            else:
-                High_Quality_Match = False
+            Aligned_On = "qlen"
         elif Subject == True:
-            if (int(line[3])*100/int(line[13])) >= float(Aln_Percent) and float(line[11]) >= float(bitscore) and float(line[2]) >= float(id) and float(line[10]) <= float(evalue):
-                High_Quality_Match = True
-            else:
-                High_Quality_Match = False
+            Aligned_On = "slen"
         else:
-            if (int(line[3])*100/max(int(line[13]),int(line[12])) >= float(Aln_Percent)) and float(line[11]) >= float(bitscore) and float(line[2]) >= float(id) and float(line[10]) <= float(evalue):
-                High_Quality_Match = True
-            else:
-                High_Quality_Match = False
-    return(High_Quality_Match)
+            Aligned_On = "max(qlen, slen)"
+        Expression += " and length * 100 / {} >= {!r}".format(Aligned_On, float(Aln_Percent))
+    return Expression
 
 ### ----------------------------- Blast Parser ----------------------------------------
-def Blast_Parser(BlastFile, Output, id, bitscore, evalue, Aln_Percent = None, Shorter = None, Query = None, Subject = None):
+def Best_Hits(Lines, Hit_Filter, Query_Column = 0, Score_Column = 11):
     Blast_Dict = {}
+    Best_Scores = {}
+    for line in Lines:
+        line = line.strip().split("\t")
+        if Hit_Filter(line) == True:
+            Hit_Query = line[Query_Column]
+            Score = float(line[Score_Column])
+            if Hit_Query not in Blast_Dict:
+                Blast_Dict[Hit_Query] = line[:Query_Column] + line[Query_Column+1:]
+                Best_Scores[Hit_Query] = Score
+            else:
+                if Score >= Best_Scores[Hit_Query]:
+                    Blast_Dict[Hit_Query] = line[:Query_Column] + line[Query_Column+1:]
+                    Best_Scores[Hit_Query] = Score
+                elif Score == Best_Scores[Hit_Query]:
+                        if randrange(0, 2) > 0:
+                            Blast_Dict[Hit_Query] = line[:Query_Column] + line[Query_Column+1:]
+                else:
+                    pass
+        else:
+            pass
+    return Blast_Dict
+
+def Best_Hits_Shard(Shard):
+    from Blast_Tab_Filter import read_shard_lines
+    BlastFile, Start, End, Expression, Columns = Shard
+    return Best_Hits(read_shard_lines(BlastFile, Start, End), compile_filter(Expression, Columns),
+                     Columns.index("qseqid"), Columns.index("bitscore"))
+
+def Blast_Parser(BlastFile, Output, id, bitscore, evalue, Aln_Percent = None, Shorter = None, Query = None, Subject = None, Threads = 1, Expression = None, Columns = None):
     print("Reading " + BlastFile + " Blast Output")
     # Check if Blast output has qlen and slen in addition to std output.
-    with open(BlastFile) as BlastFile_Input:
-        if len(BlastFile_Input.readline().strip().split("\t")) == 14:
-            print("I am assuming your Blast output has qlen and slen besides the standard output columns")
-            long = True
-        else:
-            print("I am assuming your Blast output has the standard output")
-            long = False
+    if Columns == None:
+        with open_tabular(BlastFile) as BlastFile_Input:
+            if len(BlastFile_Input.readline().strip().split("\t")) == 14:
+                print("I am assuming your Blast output has qlen and slen besides the standard output columns")
+                Columns = BLAST_COLUMNS
+            else:
+                print("I am assuming your Blast output has the standard output")
+                Columns = BLAST_STD_COLUMNS
+    else:
+        print("Reading columns: " + " ".join(Columns))
+    long = "qlen" in Columns and "slen" in Columns
     # Check if any parameter was given for match filtering.
-    if all(variable is None for variable in [id, bitscore, evalue, Aln_Percent]):
+    if Expression != None:
+        print("Performing match filtering with your filter expression and retrieving best match based on best bitscore.")
+    elif all(variable is None for variable in [id, bitscore, evalue, Aln_Percent]):
         print("Only retrieving best match per sequence using other default values.")
-        if id == None:
-            id = 30
-        if bitscore == None:
-            bitscore = 50
-        if evalue == None:
-            evalue = 10
-        # Give only best match based on bitscore.
-        with open(BlastFile) as BlastFile_Input:
-                for line in BlastFile_Input:
-                    line = line.strip().split("\t")
-                    Good = HitConfidence(line, id, bitscore, evalue, Aln_Percent, Shorter, Query, Subject)
-                    if Good == True:
-                        if line[0] not in Blast_Dict:
-                            Blast_Dict[line[0]] = line[1:]
-                        else:
-                            if float(line[11]) >= float(Blast_Dict[line[0]][10]):
-                                Blast_Dict[line[0]] = line[1:]
-                            elif float(line[11]) == float(Blast_Dict[line[0]][10]):
-                                    if randrange(0, 2) > 0:
-                                        Blast_Dict[line[0]] = line[1:]
-                            else:
-                                pass
-                    else:
-                        pass
     else:
         print("Performing match filtering and retrieving best match based on the parameters you provided (if only some, the others will take their default values).")
-        if id == None:
-            id = 30
-        if bitscore == None:
-            bitscore = 50
-        if evalue == None:
-            evalue = 10
-        # Do match filtering based on parameters provided and retrieve best match based on best bitscore.
-        with open(BlastFile) as BlastFile_Input:
-            if long == True:
-                for line in BlastFile_Input:
-                    line = line.strip().split("\t")
-                    Good = HitConfidence(line, id, bitscore, evalue, Aln_Percent, Shorter, Query, Subject)
-                    if Good == True:
-                        if line[0] not in Blast_Dict:
-                            Blast_Dict[line[0]] = line[1:]
-                        else:
-                            if float(line[11]) >= float(Blast_Dict[line[0]][10]):
-                                Blast_Dict[line[0]] = line[1:]
-                            elif float(line[11]) == float(Blast_Dict[line[0]][10]):
-                                if randrange(0, 2) > 0:
-                                    Blast_Dict[line[0]] = line[1:]
-                            else:
-                                pass
-                    else:
-                        pass
-            else:
-                for line in BlastFile_Input:
-                    line = line.strip().split("\t")
-                    Good = HitConfidence(line, id, bitscore, evalue)
-                    if Good == True:
-                        if line[0] not in Blast_Dict:
-                            Blast_Dict[line[0]] = line[1:]
-                        else:
-                            if float(line[11]) >= float(Blast_Dict[line[0]][10]):
-                                Blast_Dict[line[0]] = line[1:]
-                            elif float(line[11]) == float(Blast_Dict[line[0]][10]):
-                                if randrange(0, 2) > 0:
-                                    Blast_Dict[line[0]] = line[1:]
-                            else:
-                                pass
-                    else:
-                        pass
+        # Alignment percentage can only be calculated with qlen and slen.
+        if long == False:
+            Aln_Percent, Shorter, Query, Subject = None, None, None, None
+    if id == None:
+        id = 30
+    if bitscore == None:
+        bitscore = 50
+    if evalue == None:
+        evalue = 10
+    if Expression == None:
+        Expression = Filter_Expression(id, bitscore, evalue, Aln_Percent, Shorter, Query, Subject)
+    print("Filter: " + Expression)
+    # Do match filtering based on parameters provided and retrieve best match based on best bitscore.
+    if Threads > 1 and is_compressed(BlastFile) != None:
+        print("Compressed input cannot be split in byte ranges, filtering on a single process.")
+        Threads = 1
+    if Threads > 1:
+        import multiprocessing
+        from Blast_Tab_Filter import find_shard_boundaries
+        # Shards never split a query, so the best hits of each shard are final.
+        Shards = [(BlastFile, Start, End, Expression, Columns)
+                  for Start, End in find_shard_boundaries(BlastFile, Threads)]
+        Blast_Dict = {}
+        pool = multiprocessing.Pool(Threads)
+        try:
+            for Shard_Dict in pool.imap(Best_Hits_Shard, Shards):
+                Blast_Dict.update(Shard_Dict)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        with open_tabular(BlastFile) as BlastFile_Input:
+            Blast_Dict = Best_Hits(BlastFile_Input, compile_filter(Expression, Columns),
+                                   Columns.index("qseqid"), Columns.index("bitscore"))
 
     # Convert dictionary to dataframe and export
     Blast_DF = pd.DataFrame.from_dict(Blast_Dict, orient='index')
@@ -139,6 +129,9 @@ def main():
         parser.add_argument('--shorter', action='store_true', help='Calculates the alignment percentage on the shorter sequence, by default false, i.e. calculated on the longer')
         parser.add_argument('--query', action='store_true', help='Calculates the alignment percentage on the query sequence, by default false, i.e. calculated on the longer')
         parser.add_argument('--subject', action='store_true', help='Calculates the alignment percentage on the subject sequence, by default false, i.e. calculated on the longer')
+        parser.add_argument('--filter', dest='Expression', action='store', help='Filter expression used instead of the thresholds, e.g. "pident >= 30 and bitscore >= 50 and aln_len / min(qlen, slen) >= 0.7". Any column in --columns can be used')
+        parser.add_argument('--columns', dest='Columns', action='store', help='Columns of the Blast output, as given to -outfmt 6 ("std" accepted). By default "std", or "std qlen slen" if the file has 14 columns')
+        parser.add_argument('-t', '--threads', dest='Threads', action='store', type=int, default=1, help='Number of processes to use. Input must be grouped by query (Blast default). By default 1')
         args = parser.parse_args()
 
         Blast_File = args.Blast_File
@@ -150,8 +143,11 @@ def main():
         Shorter = args.shorter
         Query = args.query
         Subject = args.subject
+        Threads = args.Threads
+        Expression = args.Expression
+        Columns = parse_column_spec(args.Columns) if args.Columns else None
 
-        Blast_Parser(Blast_File, Output_File, ID_Perc, Bitscore, Evalue, Aln_Percent, Shorter, Query, Subject)
+        Blast_Parser(Blast_File, Output_File, ID_Perc, Bitscore, Evalue, Aln_Percent, Shorter, Query, Subject, Threads, Expression, Columns)
 
 if __name__ == "__main__":
     main()
@@ -9,50 +9,740 @@
 
 # Description: This script performs a given blast process from a fasta query to a fasta-derived database.
 # It splits the fasta file into several jobs and merges the outputs.
+# Jobs are submitted to PBS or Slurm, or run in a local pool of workers (see Job_Scheduler.py).
 ########################################################################
 """
 
 ################################################################################
 """---1.0 Import Modules---"""
 
-################################################################################
-"""---2.0 Define Functions---"""
-
-
-
 import sys, argparse, os
-import time, glob
-import subprocess
-
-"""--------------------1.0 Initialize Variables---------------------------"""
+import glob, re, json
+import shlex, heapq, hashlib, threading
+from Job_Scheduler import BACKENDS, make_job, run_step
 
+################################################################################
+"""---2.0 Define Functions---"""
 
-parser = argparse.ArgumentParser(description=
-	'Global mandatory parameters: [query_file] [database_file] [program] [number_Jobs] [db_type]\n'
-	'Optional Database Parameters: See '+sys.argv[0]+' -h')
-
-parser.add_argument("-q", "--query", required=True, help="Query File")
-parser.add_argument("-j", "--jobs", help="Number of Jobs to Run", type=int, default=None)
-parser.add_argument("-p", "--program", help="Program to run [blastn, blastp, blastx, tblastx or blat]", default="blastn")
-parser.add_argument("-e", "--output", required=True, help="Output Folder")
-parser.add_argument("--step", help="Step to begin with: [1] FormatDB, [2] Split Query, [3] Blast Run,", type=int, default=1)
-parser.add_argument("-f", "--force", help="Force overwriting database if already formatted", action='store_true')
-parser.add_argument("-s", "--split", help="Force overwriting split query if already found", action='store_true')
-
-"""--------------------1.1 Database Variables ----------------------------"""
+def get_paths(query, database, output):
+    """
+    Extracts the directories and names of the query, database and output.
+
+    Arguments:
+        query {filepath} -- Query FastA
+        database {filepath} -- Database FastA
+        output {dirpath} -- Output folder
+
+    Returns:
+        [dictionary] -- Paths used by the pipeline steps
+    """
+    paths = {"rundir": os.getcwd()}
+    paths["query_dir"] = os.path.abspath(os.path.dirname(query))
+    paths["query_name"] = os.path.basename(query)
+    paths["query_base"] = os.path.splitext(paths["query_name"])[0]
+    paths["query_fullpath"] = os.path.join(paths["query_dir"], paths["query_name"])
+    paths["split_dir"] = os.path.join(paths["query_dir"], paths["query_base"] + "_Split")
+    paths["database_dir"] = os.path.abspath(os.path.dirname(database))
+    paths["database_name"] = os.path.basename(database)
+    paths["database_base"] = os.path.splitext(paths["database_name"])[0]
+    paths["database_fullpath"] = os.path.join(paths["database_dir"], paths["database_name"])
+    paths["database_prefix"] = paths["database_dir"] + "/" + paths["database_base"]
+    paths["output_dir"] = os.path.abspath(os.path.dirname(output))
+    paths["output_name"] = os.path.basename(output)
+    paths["output_fullpath"] = os.path.join(paths["output_dir"], paths["output_name"])
+    return paths
+
+
+"""--------------------2.1 Format Database-------------------------------"""
+
+# makeblastdb options accepted by --db_opt without their dash.
+MAKEBLASTDB_FLAGS = {"input_type", "title", "parse_seqids", "hash_index", "mask_data", "mask_id", "mask_desc",
+                     "gi_mask", "gi_mask_name", "max_file_sz", "taxid", "taxid_map", "blastdb_version"}
+
+
+def makeblastdb_options(db_opt):
+    """
+    Converts the --db_opt values (option_flag value with no dash) to makeblastdb arguments.
+
+    Arguments:
+        db_opt {list} -- Options, e.g. ["parse_seqids", "taxid", "9606"]
+
+    Returns:
+        [list] -- makeblastdb arguments, e.g. ["-parse_seqids", "-taxid", "9606"]
+    """
+    options = []
+    for option in shlex.split(" ".join(db_opt or [])):
+        options.append("-" + option if option in MAKEBLASTDB_FLAGS else option)
+    return options
+
+
+def fasta_sha256(fasta_file, cache_dir=None, known=None):
+    """
+    Returns the SHA-256 of a FastA file. The digest is remembered by path, size and
+    modification time, in the cache folder or in the known record (e.g. the source of
+    an existing database), so unchanged files are not read again.
+    """
+    fasta_file = os.path.abspath(fasta_file)
+    stat = os.stat(fasta_file)
+    if known and known.get("fasta") == fasta_file and known.get("fasta_size") == stat.st_size \
+            and known.get("fasta_mtime") == stat.st_mtime and known.get("fasta_sha256"):
+        return known["fasta_sha256"]
+    memo_file = os.path.join(cache_dir, "fasta_hashes.json") if cache_dir else None
+    memo = {}
+    if memo_file and os.path.exists(memo_file):
+        with open(memo_file) as memo_handle:
+            memo = json.load(memo_handle)
+        known = memo.get(fasta_file, {})
+        if known.get("size") == stat.st_size and known.get("mtime") == stat.st_mtime:
+            return known["sha256"]
+    digest = file_sha256(fasta_file)
+    if memo_file:
+        memo[fasta_file] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": digest}
+        with open(memo_file + ".{}.tmp".format(os.getpid()), "w") as memo_handle:
+            json.dump(memo, memo_handle, indent=2, sort_keys=True)
+        os.replace(memo_file + ".{}.tmp".format(os.getpid()), memo_file)
+    return digest
+
+
+def database_exists(prefix, dbtype):
+    """
+    Checks if a Blast database (single or multi-volume) exists for the given prefix.
+    """
+    letter = "p" if dbtype == "prot" else "n"
+    return (os.path.exists(prefix + "." + letter + "hr") or os.path.exists(prefix + "." + letter + "al") or
+            bool(glob.glob(prefix + ".[0-9]*." + letter + "hr")))
+
+
+def locate_database(paths, dbtype, db_opt=None, cache_dir=None):
+    """
+    Finds where the database of the current FastA and options is. In a cache folder the
+    database lives in <cache>/<key>/, where key is the SHA-256 of the FastA contents, the
+    molecule type and the makeblastdb options. Otherwise it is next to the FastA, with the
+    key saved in <database>.source.json, which also spares hashing an unchanged FastA.
+
+    Arguments:
+        paths {dictionary} -- Pipeline paths (see get_paths)
+        dbtype {string} -- Molecule type, nucl or prot
+        db_opt {list} -- makeblastdb options (see makeblastdb_options)
+        cache_dir {dirpath} -- Database cache folder
+
+    Returns:
+        [dictionary] -- Database prefix, key, source description and if it is up to date
+    """
+    options = makeblastdb_options(db_opt)
+    known = None
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    else:
+        prefix = paths["database_dir"] + "/" + paths["database_base"]
+        source_file = prefix + ".source.json"
+        try:
+            with open(source_file) as source_handle:
+                known = json.load(source_handle)
+        except (OSError, ValueError):
+            pass
+    fasta_file = os.path.abspath(paths["database_fullpath"])
+    fasta_stat = os.stat(fasta_file)
+    source = {"fasta": fasta_file, "fasta_size": fasta_stat.st_size, "fasta_mtime": fasta_stat.st_mtime,
+              "fasta_sha256": fasta_sha256(fasta_file, cache_dir, known), "dbtype": dbtype, "options": options}
+    key = hashlib.sha256(json.dumps([source["fasta_sha256"], dbtype, options]).encode()).hexdigest()
+    if cache_dir:
+        prefix = os.path.join(os.path.abspath(cache_dir), key, paths["database_base"])
+        source_file = os.path.join(os.path.dirname(prefix), "source.json")
+    source["key"] = key
+    database = {"prefix": prefix, "key": key, "source": source, "source_file": source_file}
+    database["current"] = cached_database_valid(database, dbtype)
+    return database
+
+
+def cached_database_valid(database, dbtype):
+    """
+    Checks if a database location (see locate_database) holds a complete database
+    whose source.json matches its key.
+    """
+    if not (database_exists(database["prefix"], dbtype) and os.path.exists(database["source_file"])):
+        return False
+    try:
+        with open(database["source_file"]) as source_handle:
+            return json.load(source_handle).get("key") == database["key"]
+    except (OSError, ValueError):
+        return False
+
+
+def format_database(paths, dbtype, force, scheduler, db_opt=None, cache_dir=None):
+    """
+    Formats the database unless a database of the same FastA contents and options exists and
+    force is not set. With a cache folder the database is built in a temporary folder and
+    moved into the cache when complete, so other runs never see a partial database.
+    A forced or invalid cache entry is renamed aside, replaced by the new build and then
+    deleted (runs reading it keep their open files). A database next to the FastA made
+    before sources were recorded is adopted by writing its source instead of rebuilt.
+
+    Arguments:
+        paths {dictionary} -- Pipeline paths (see get_paths)
+        dbtype {string} -- Molecule type, nucl or prot
+        force {bool} -- Overwrite an existing database
+        scheduler {dictionary} -- Job_Scheduler.run_step options (backend, queue, modules...)
+        db_opt {list} -- makeblastdb options (see makeblastdb_options)
+        cache_dir {dirpath} -- Database cache folder
+
+    Returns:
+        [string] -- Database prefix for Blast -db
+    """
+    import shutil
+    print("Formatting Database: " + paths["database_name"])
+    database = locate_database(paths, dbtype, db_opt, cache_dir)
+    if database["current"] and force == False:
+        if not cache_dir:
+            # Records the current FastA size and modification time, so it is not hashed again.
+            with open(database["source_file"], "w") as source_handle:
+                json.dump(database["source"], source_handle, indent=2, sort_keys=True)
+        print("Database already formatted ({}), use --force to rebuild it".format(database["prefix"]))
+        return database["prefix"]
+    elif (not cache_dir and force == False and database_exists(database["prefix"], dbtype) and
+          not os.path.exists(database["source_file"])):
+        with open(database["source_file"], "w") as source_handle:
+            json.dump(database["source"], source_handle, indent=2, sort_keys=True)
+        print("Database already formatted ({}), recorded its source in {}, use --force to rebuild it".format(
+              database["prefix"], database["source_file"]))
+        return database["prefix"]
+    elif database_exists(database["prefix"], dbtype) and force == False:
+        print("Database does not match {} and its options, formatting it again".format(paths["database_name"]))
+    if cache_dir:
+        build_dir = os.path.dirname(database["prefix"]) + ".build.{}".format(os.getpid())
+        os.makedirs(build_dir, exist_ok=True)
+        out_prefix = os.path.join(build_dir, paths["database_base"])
+    else:
+        out_prefix = database["prefix"]
+    command = ["makeblastdb", "-in", paths["database_fullpath"], "-dbtype", dbtype, "-title", paths["database_base"],
+               "-out", out_prefix, "-logfile", os.path.dirname(out_prefix) + "/DB_Format_Log.txt"] + makeblastdb_options(db_opt)
+    job = make_job("Format_" + paths["database_base"], command,
+                   paths["output_fullpath"] + "/" + paths["database_base"] + "_Format.out",
+                   paths["output_fullpath"], threads=1, memory=5, walltime="3:00:00")
+    run_step([job], "Database formatting", **scheduler)
+    if cache_dir:
+        with open(os.path.join(build_dir, "source.json"), "w") as source_handle:
+            json.dump(database["source"], source_handle, indent=2, sort_keys=True)
+        final_dir = os.path.dirname(database["prefix"])
+        old_dir = None
+        if os.path.exists(final_dir) and (force == True or not cached_database_valid(database, dbtype)):
+            # Forced or invalid entry, swapped for the new build and then deleted.
+            old_dir = final_dir + ".old.{}".format(os.getpid())
+            try:
+                os.rename(final_dir, old_dir)
+            except OSError:
+                if os.path.exists(final_dir):
+                    raise
+                old_dir = None
+        try:
+            os.rename(build_dir, final_dir)
+            print("Database cached in " + final_dir)
+        except OSError:
+            if not cached_database_valid(database, dbtype):
+                raise
+            # Another run cached the same database first, use its copy.
+            shutil.rmtree(build_dir)
+            print("Database already cached by another run in " + final_dir)
+        if old_dir is not None:
+            shutil.rmtree(old_dir, ignore_errors=True)
+    else:
+        with open(database["source_file"], "w") as source_handle:
+            json.dump(database["source"], source_handle, indent=2, sort_keys=True)
+    return database["prefix"]
+
+
+"""------------------2.2 Split Query ----------------------"""
+
+def index_fasta(fasta_file):
+    """
+    Finds the byte offset, size and number of residues of every record in a FastA file.
+
+    Arguments:
+        fasta_file {filepath} -- FastA file
+
+    Returns:
+        [tuple] -- Lists of record offsets, sizes (bytes) and residues
+    """
+    offsets = []
+    residues = []
+    position = 0
+    with open(fasta_file, "rb", buffering=1048576) as fasta:
+        for line in fasta:
+            if line.startswith(b">"):
+                offsets.append(position)
+                residues.append(0)
+            elif residues:
+                residues[-1] += len(line.rstrip())
+            position += len(line)
+    sizes = [next_offset - offset for offset, next_offset in zip(offsets, offsets[1:] + [position])]
+    return offsets, sizes, residues
+
+
+def balance_shards(residues, shards):
+    """
+    Assigns records to shards balancing the total residues per shard. Records are placed
+    from the longest to the shortest in the shard with the fewest residues so far.
+
+    Arguments:
+        residues {list} -- Residues per record
+        shards {int} -- Number of shards
+
+    Returns:
+        [tuple] -- Shard of each record and residues per shard
+    """
+    import heapq
+    assignment = [0] * len(residues)
+    loads = [0] * shards
+    heap = [(0, shard) for shard in range(shards)]
+    for record in sorted(range(len(residues)), key=lambda record: residues[record], reverse=True):
+        load, shard = heapq.heappop(heap)
+        assignment[record] = shard
+        loads[shard] = load + residues[record]
+        heapq.heappush(heap, (loads[shard], shard))
+    return assignment, loads
+
+
+def split_fasta(fasta_file, split_dir, prefix, shards):
+    """
+    Splits a FastA file in shards with similar total residues, named prefix_1.fasta, prefix_2.fasta...
+    Records are copied unchanged and keep their original order within each shard.
+
+    Arguments:
+        fasta_file {filepath} -- FastA file
+        split_dir {dirpath} -- Output folder
+        prefix {string} -- Shard name prefix
+        shards {int} -- Number of shards, at most one per record
+
+    Returns:
+        [list] -- Shard files
+    """
+    offsets, sizes, residues = index_fasta(fasta_file)
+    shards = max(1, min(int(shards), len(offsets)))
+    assignment, loads = balance_shards(residues, shards)
+    shard_files = [split_dir + "/" + prefix + "_%i.fasta" % (shard + 1) for shard in range(shards)]
+    handles = [open(shard_file, "wb", buffering=1048576) for shard_file in shard_files]
+    try:
+        with open(fasta_file, "rb", buffering=1048576) as fasta:
+            if offsets:
+                # Skip anything before the first record.
+                fasta.seek(offsets[0])
+            for record, size in enumerate(sizes):
+                handles[assignment[record]].write(fasta.read(size))
+    finally:
+        for handle in handles:
+            handle.close()
+    records = [assignment.count(shard) for shard in range(shards)]
+    for shard, shard_file in enumerate(shard_files):
+        print("Wrote %i records (%i residues) to %s" % (records[shard], loads[shard], shard_file))
+    return shard_files
+
+
+def split_query(paths, jobs, force):
+    """
+    Splits the query in jobs files unless it is already split and force is not set.
+
+    Arguments:
+        paths {dictionary} -- Pipeline paths (see get_paths)
+        jobs {int} -- Number of query files
+        force {bool} -- Overwrite an existing split
+    """
+    print("Splitting Query: " + paths["query_name"])
+    if os.path.exists(paths["split_dir"]):
+        if force == False:
+            return
+        for shard in glob.glob(paths["split_dir"] + "/" + paths["query_base"] + "_*.fasta"):
+            os.remove(shard)
+    else:
+        os.makedirs(paths["split_dir"])
+    split_fasta(paths["query_fullpath"], paths["split_dir"], paths["query_base"], jobs)
+
+
+"""------------------2.3 Run Blast------------------------"""
+
+def query_shards(paths):
+    """
+    Lists the split query files sorted by shard number.
+
+    Returns:
+        [list] -- Query shard files
+    """
+    queries = glob.glob(paths["split_dir"] + "/" + paths["query_base"] + "_*.fasta")
+    shard_number = re.compile(re.escape(paths["query_base"]) + r"_(\d+)\.fasta$")
+    return sorted(queries, key=lambda query_i: int(shard_number.search(query_i).group(1)) if shard_number.search(query_i) else 0)
+
+
+def blast_command(paths, program, query_i, blast_threads, blast_opt):
+    """
+    Returns the Blast command searching a query shard. The output is written to the output
+    folder as <shard name>.blast, e.g. query_1.fasta.blast.
+
+    Returns:
+        [list] -- Command arguments
+    """
+    output_file = paths["output_fullpath"] + "/" + os.path.basename(query_i) + ".blast"
+    return [program, "-db", paths["database_prefix"], "-query", query_i,
+            "-out", output_file, "-num_threads", str(blast_threads)] + shlex.split(''.join(blast_opt))
+
+
+def file_sha256(file_path):
+    """
+    Returns the SHA-256 hex digest of a file.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as input_file:
+        for block in iter(lambda: input_file.read(1048576), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def manifest_path(paths):
+    """
+    Returns the run manifest file, recording the state of each Blast shard.
+    """
+    return paths["output_fullpath"] + "/" + paths["query_base"] + "_manifest.json"
+
+
+def read_manifest(manifest_file):
+    """
+    Reads a run manifest.
+
+    Returns:
+        [dictionary] -- {"shards": {shard name: {"input", "input_hash", "command", "output", "status", "output_size"}}}
+    """
+    if not os.path.exists(manifest_file):
+        return {"shards": {}}
+    with open(manifest_file) as manifest:
+        return json.load(manifest)
+
+
+def write_manifest(manifest, manifest_file):
+    """
+    Writes a run manifest, replacing the previous one atomically.
+    """
+    with open(manifest_file + ".tmp", "w") as output:
+        json.dump(manifest, output, indent=2, sort_keys=True)
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+
+def output_intact(output_file, output_size):
+    """
+    Checks if an output file exists with the recorded size.
+    """
+    return output_file is not None and os.path.exists(output_file) and os.path.getsize(output_file) == output_size
+
+
+def shard_finished(record, input_hash, command):
+    """
+    Checks if a manifest record shows a shard searched with the same input and command.
+    """
+    return (record.get("status") in ("done", "filtered") and record.get("input_hash") == input_hash and
+            record.get("command") == command)
+
+
+"""------------------2.4 Filter Outputs------------------------"""
+
+def blast_output_columns(blast_opt):
+    """
+    Returns the columns of the Blast output from the -outfmt option (tabular format 6 only).
+
+    Returns:
+        [list] -- Column names (see Blast_Tabular_Reader.parse_column_spec)
+    """
+    from Blast_Tabular_Reader import parse_column_spec
+    options = shlex.split(''.join(blast_opt))
+    outfmt = options[options.index("-outfmt") + 1] if "-outfmt" in options[:-1] else "0"
+    if outfmt.split()[0] != "6":
+        sys.exit("Filtering requires tabular Blast output (-outfmt 6), not -outfmt " + outfmt)
+    return parse_column_spec(outfmt)
+
+
+def filter_blast_output(arguments):
+    """
+    Filters a finished shard output with Blast_Tab_Filter, keeping all the hits passing the
+    filter (all), the best hit per query (best) or the first passing hit per query (first).
+    The unfiltered output is removed unless keep_raw is set.
+
+    Arguments:
+        arguments {tuple} -- Shard output, filtered output, filter expression, hits to keep
+                             (all, best or first), columns and keep_raw
+
+    Returns:
+        [tuple] -- Filtered output and its size
+    """
+    from Blast_Tab_Filter import filter_shard
+    from Blast_Filter_Expression import compile_filter
+    output_file, filtered_file, filter_expression, filter_hits, columns, keep_raw = arguments
+    if filter_hits == "all":
+        hit_filter = compile_filter(filter_expression, columns)
+        with open(output_file) as hits, open(filtered_file, "w", buffering=1048576) as filtered:
+            for line in hits:
+                if line.strip() and hit_filter(line.rstrip("\n").split("\t")):
+                    filtered.write(line)
+    else:
+        filter_shard((output_file, 0, os.path.getsize(output_file), filtered_file, filter_expression,
+                      filter_hits == "first", columns, None, None))
+    if keep_raw == False:
+        os.remove(output_file)
+    return filtered_file, os.path.getsize(filtered_file)
+
+
+def run_blast(paths, program, blast_opt, scheduler, blast_threads=2, filter_options=None):
+    """
+    Searches every query shard against the database. Shards the manifest records as
+    finished with the same query and command are skipped. With filter_options, each
+    shard output is filtered in a local pool as soon as its search ends, while the
+    other shards are still running.
+
+    Arguments:
+        paths {dictionary} -- Pipeline paths (see get_paths)
+        program {string} -- Blast program
+        blast_opt {string} -- Additional Blast options
+        scheduler {dictionary} -- Job_Scheduler.run_step options (backend, queue, modules...)
+        blast_threads {int} -- Threads per Blast search
+        filter_options {dictionary} -- expression, hits (all, best or first), threads and keep_raw
+    """
+    print("Running Blast: " + paths["query_name"])
+    manifest_file = manifest_path(paths)
+    previous = read_manifest(manifest_file)["shards"]
+    manifest = {"query": paths["query_fullpath"], "shards": {}}
+    # Records are updated from the main thread and from the filter pool callbacks, every
+    # update and manifest save holds this lock (reentrant, so updates can save inside it).
+    manifest_lock = threading.RLock()
+    if filter_options is not None:
+        import multiprocessing
+        from Blast_Filter_Expression import compile_filter
+        columns = blast_output_columns(blast_opt)
+        # Check the expression before any search is run.
+        try:
+            compile_filter(filter_options["expression"], columns)
+        except ValueError as error:
+            sys.exit(str(error))
+        filter_key = "{} ({} hits)".format(filter_options["expression"], filter_options["hits"])
+        filter_pool = multiprocessing.Pool(filter_options["threads"])
+
+    def save_manifest():
+        with manifest_lock:
+            write_manifest(manifest, manifest_file)
+
+    def filter_output(shard_name):
+        with manifest_lock:
+            record = manifest["shards"][shard_name]
+            record["filter"] = filter_key
+            record["filtered_output"] = os.path.splitext(record["output"])[0] + ".filtered.blast"
+            record["filtered_size"] = None
+            arguments = (record["output"], record["filtered_output"], filter_options["expression"],
+                         filter_options["hits"], columns, filter_options["keep_raw"])
+
+        def filter_done(result):
+            with manifest_lock:
+                record["status"] = "filtered"
+                record["filtered_size"] = result[1]
+                save_manifest()
+            print("Filtered " + shard_name)
+
+        def filter_failed(error):
+            with manifest_lock:
+                record["status"] = "filter_failed"
+                save_manifest()
+            print("Failed filtering {}: {}".format(shard_name, error))
+
+        filter_pool.apply_async(filter_blast_output, (arguments,), callback=filter_done, error_callback=filter_failed)
+
+    shard_jobs = []
+    pending_filters = []
+    for query_i in query_shards(paths):
+        shard_name = os.path.splitext(os.path.basename(query_i))[0]
+        command = blast_command(paths, program, query_i, blast_threads, blast_opt)
+        input_hash = file_sha256(query_i)
+        record = previous.get(shard_name, {})
+        if shard_finished(record, input_hash, " ".join(command)):
+            filtered = record["status"] == "filtered" and output_intact(record.get("filtered_output"), record.get("filtered_size"))
+            raw = output_intact(record["output"], record["output_size"])
+            if filter_options is None and raw:
+                print("Skipping finished shard " + shard_name)
+                record = dict(record, status="done")
+                for key in ("filter", "filtered_output", "filtered_size"):
+                    record.pop(key, None)
+                manifest["shards"][shard_name] = record
+                continue
+            elif filter_options is not None and filtered and record.get("filter") == filter_key:
+                print("Skipping finished shard " + shard_name)
+                manifest["shards"][shard_name] = record
+                continue
+            elif filter_options is not None and raw:
+                print("Skipping search of finished shard " + shard_name)
+                manifest["shards"][shard_name] = dict(record, status="done")
+                pending_filters.append(shard_name)
+                continue
+        manifest["shards"][shard_name] = {"input": query_i, "input_hash": input_hash, "command": " ".join(command),
+                                          "output": command[command.index("-out") + 1], "status": "submitted",
+                                          "output_size": None}
+        shard_jobs.append(make_job("Blast-" + shard_name, command, paths["output_fullpath"] + "/Blast-" + shard_name + ".out",
+                                   paths["output_fullpath"], threads=blast_threads, memory=10, walltime="12:00:00"))
+    save_manifest()
+
+    def finish_shard(job_name, status):
+        shard_name = job_name[len("Blast-"):]
+        with manifest_lock:
+            record = manifest["shards"][shard_name]
+            record["status"] = "done" if status == 0 else "failed"
+            record["output_size"] = os.path.getsize(record["output"]) if os.path.exists(record["output"]) else None
+            save_manifest()
+        if status == 0 and filter_options is not None:
+            filter_output(shard_name)
+
+    if filter_options is None:
+        run_step(shard_jobs, "Blast", callback=finish_shard, **scheduler)
+    else:
+        try:
+            for shard_name in pending_filters:
+                filter_output(shard_name)
+            run_step(shard_jobs, "Blast", callback=finish_shard, **scheduler)
+        finally:
+            filter_pool.close()
+            filter_pool.join()
+        failed = [shard_name for shard_name, record in manifest["shards"].items() if record["status"] != "filtered"]
+        if failed:
+            sys.exit("Filtering failed: " + ", ".join(failed))
+    print("Blast finished. Check outputs in " + paths["output_fullpath"])
+
+
+"""------------------2.5 Merge Outputs------------------------"""
+
+def query_ranks(query_fasta):
+    """
+    Finds the position of each query in the query FastA.
+
+    Returns:
+        [dictionary] -- Query ID (first word of the header): rank
+    """
+    ranks = {}
+    with open(query_fasta, "rb", buffering=1048576) as fasta:
+        for line in fasta:
+            if line.startswith(b">"):
+                words = line[1:].split(None, 1)
+                if words:
+                    ranks.setdefault(words[0].decode(), len(ranks))
+    return ranks
+
+
+def ranked_lines(handle, ranks):
+    """
+    Yields the lines of a shard output with the rank of their query (see query_ranks).
+    Raises ValueError if a query ID is not in the query FastA or the queries are not in
+    FastA order, since the output then cannot be merged by rank.
+    """
+    last_rank = -1
+    for line in handle:
+        rank = ranks.get(line.split("\t", 1)[0])
+        if rank is None or rank < last_rank:
+            raise ValueError("Query {} not found in the query FastA or out of order".format(line.split("\t", 1)[0].strip()))
+        last_rank = rank
+        yield rank, line
+
+
+def merge_blast_outputs(paths, compress=False):
+    """
+    Merges the shard outputs in query order into <output folder>/<query>.blast, or the
+    filtered outputs into <query>.filtered.blast. Blast writes the hits of each query
+    together and in the order of its query shard, so the outputs are
+    streamed through a k-way merge keyed by the rank of the query in the query FastA. If any
+    query ID is not found in the FastA headers (or the outputs have comments) the outputs
+    are concatenated in shard order instead.
+
+    Arguments:
+        paths {dictionary} -- Pipeline paths (see get_paths)
+        compress {bool} -- Gzip compress the merged output
+
+    Returns:
+        [filepath] -- Merged output
+    """
+    import gzip, shutil
+    shards = read_manifest(manifest_path(paths))["shards"]
+    shard_names = sorted(shards, key=lambda shard_name: int(shard_name.rsplit("_", 1)[1]))
+    filtered = bool(shard_names) and all("filter" in shards[shard_name] for shard_name in shard_names)
+    unfinished = [shard_name for shard_name in shard_names if shards[shard_name]["status"] != ("filtered" if filtered else "done")]
+    if not shard_names or unfinished:
+        sys.exit("Cannot merge, shards not finished: " + (", ".join(unfinished) if unfinished else "no shards run"))
+    if filtered:
+        outputs = [shards[shard_name]["filtered_output"] for shard_name in shard_names]
+    else:
+        outputs = [shards[shard_name]["output"] for shard_name in shard_names]
+    merged_file = (paths["output_fullpath"] + "/" + paths["query_base"] + (".filtered" if filtered else "") +
+                   ".blast" + (".gz" if compress else ""))
+    print("Merging {} shard outputs into {}".format(len(outputs), merged_file))
+
+    ranks = query_ranks(paths["query_fullpath"])
+    sortable = True
+    for output in outputs:
+        with open(output) as output_file:
+            first_line = output_file.readline()
+        if first_line and (first_line.startswith("#") or first_line.split("\t", 1)[0] not in ranks):
+            sortable = False
+    handles = [open(output, buffering=1048576) for output in outputs]
+    try:
+        if sortable:
+            # Every line is ranked, if one cannot be the partial merge is rewritten in shard order.
+            try:
+                with (gzip.open(merged_file, "wt") if compress else open(merged_file, "w", buffering=1048576)) as merged:
+                    for rank, line in heapq.merge(*[ranked_lines(handle, ranks) for handle in handles],
+                                                  key=lambda ranked_line: ranked_line[0]):
+                        merged.write(line if line.endswith("\n") else line + "\n")
+            except ValueError as error:
+                print(error)
+                sortable = False
+                for handle in handles:
+                    handle.seek(0)
+        if not sortable:
+            print("Query IDs not found in the query FastA, concatenating the outputs in shard order")
+            with (gzip.open(merged_file, "wt") if compress else open(merged_file, "w", buffering=1048576)) as merged:
+                for handle in handles:
+                    shutil.copyfileobj(handle, merged)
+    finally:
+        for handle in handles:
+            handle.close()
+    return merged_file
 
-parser.add_argument("-d", "--database", required=True, help="Database File to Format")
-parser.add_argument("--dbtype", required=True, help="Molecule type of target db [nucl, prot]")
-parser.add_argument("--db_opt", nargs='*', dest='db_opt',  help="""Enter the options as option_flag value with no dash "-" (e.g. [input_type fasta])
+################################################################################
+"""---3.0 Main Function---"""
+
+def main():
+    parser = argparse.ArgumentParser(description=
+        'Global mandatory parameters: [query_file] [database_file] [program] [number_Jobs] [db_type]\n'
+        'Optional Database Parameters: See '+sys.argv[0]+' -h')
+
+    parser.add_argument("-q", "--query", required=True, help="Query File")
+    parser.add_argument("-j", "--jobs", help="Number of Jobs to Run", type=int, default=None)
+    parser.add_argument("-p", "--program", help="Program to run [blastn, blastp, blastx, tblastx or blat]", default="blastn")
+    parser.add_argument("-e", "--output", required=True, help="Output Folder")
+    parser.add_argument("--step", help="Step to begin with: [1] FormatDB, [2] Split Query, [3] Blast Run, [4] Merge Outputs", type=int, default=1)
+    parser.add_argument("-f", "--force", help="Force overwriting database if already formatted", action='store_true')
+    parser.add_argument("-s", "--split", help="Force overwriting split query if already found", action='store_true')
+    parser.add_argument("--backend", choices=BACKENDS, default="pbs", help="""Where to run the jobs: submitted to PBS (pbs) or Slurm (slurm),
+    in a local pool of workers (local) or as local background jobs through the scheduler interface (fake, for testing). If none, pbs""")
+    parser.add_argument("--queue", default=None, help="Queue (PBS) or partition (Slurm) to submit the jobs to. If none, the scheduler default")
+    parser.add_argument("--modules", nargs='*', default=[], help="Environment modules loaded by the jobs, e.g. ncbi_blast/2.2.29")
+    parser.add_argument("--poll", type=float, default=5, help="Seconds between job status checks on a scheduler. If none, 5")
+    parser.add_argument("-t", "--threads", type=int, default=os.cpu_count(), help="Threads available to the local backend. If none, all the CPUs")
+    parser.add_argument("--blast_threads", type=int, default=2, help="Threads used by each Blast job. If none, 2")
+    parser.add_argument("--compress", action='store_true', help="Gzip compress the merged Blast output")
+
+    """--------------------1.1 Database Variables ----------------------------"""
+
+    parser.add_argument("-d", "--database", required=True, help="Database File to Format")
+    parser.add_argument("--dbtype", required=True, help="Molecule type of target db [nucl, prot]")
+    parser.add_argument("--db_cache", default=None, help="""Folder shared by runs to cache databases by the contents of the FastA
+    and the makeblastdb options. If none, the database is formatted next to the FastA""")
+    parser.add_argument("--db_opt", nargs='*', dest='db_opt',  help="""Enter the options as option_flag value with no dash "-" (e.g. [input_type fasta])
 	[-input_type type] [-dbtype molecule_type]
 	[-title database_title] [-parse_seqids] [-hash_index] [-mask_data mask_data_files]
 	[-mask_id mask_algo_ids] [-mask_desc mask_algo_descriptions] [-gi_mask]
 	[-gi_mask_name gi_based_mask_names] [-out database_name] [-max_file_sz number_of_bytes]
 	[-taxid TaxID] [-taxid_map TaxIDMapFile] [-logfile File_Name]\n""")
 
-"""--------------------1.2 Blast Variables -------------------------------"""
+    """--------------------1.2 Blast Variables -------------------------------"""
 
-parser.add_argument("--blast_opt", dest='blast_opt', nargs='*', default="-outfmt 6", help="""Enter the options as option_flag value with no dash "-" (e.g. [outfmt 6])
+    parser.add_argument("--blast_opt", dest='blast_opt', nargs='*', default="-outfmt 6", help="""Enter the options as option_flag value with no dash "-" (e.g. [outfmt 6])
 	[-import_search_strategy filename] [-export_search_strategy filename] [-task task_name] [-db database_name]
 	[-dbsize num_letters] [-gilist filename] [-seqidlist filename]
 	[-negative_gilist filename] [-entrez_query entrez_query]
@@ -77,206 +767,52 @@ parser.add_argument("--blast_opt", dest='blast_opt', nargs='*', default="-outfmt
 	[-num_alignments int_value] [-html] [-max_target_seqs num_sequences]
 	[-num_threads int_value] [-remote]""")
 
-args = parser.parse_args()
-
-"""Parse all the inputs and extract the target and origin folders"""
-
-# Run directory
-rundir = os.getcwd()
-
-# Query information
-query = args.query
-query_dir = os.path.abspath(os.path.dirname(query))
-query_name = os.path.basename(query)
-query_base = os.path.splitext(query_name)[0]
-query_fullpath = os.path.join(query_dir, query_name)
-
-# Number of jobs
-jobs = args.jobs if args.jobs else input("Number of Jobs to Run: ")
-jobs = str(jobs)
-
-# Program to run
-program = args.program
-
-# Database information
-database = args.database
-database_dir = os.path.abspath(os.path.dirname(database))
-database_name = os.path.basename(database)
-database_base = os.path.splitext(database_name)[0]
-database_fullpath = os.path.join(database_dir, database_name)
-
-dbtype = args.dbtype
-force = args.force
-
-# Other options
-db_opt = args.db_opt
-
-blast_opt = args.blast_opt
-
-# Step to run
-step = args.step
-
-# Output information
-output = args.output
-output_dir = os.path.abspath(os.path.dirname(output))
-output_name = os.path.basename(output)
-output_fullpath = os.path.join(output_dir, output_name)
-
-
-"""--------------------2.0 Format Database-------------------------------"""
-if step == 1:
-	if not os.path.exists(output_fullpath):
-		os.makedirs(output_fullpath)
-	os.chdir(rundir)
-	print("Formatting Database: " + database_name)
-
-# Create the format DB script.
-	def formatDatabase():
-		text_file = open(output_fullpath + "/Format" + database_base + "_DB.pbs", "w")
-		text_file.write("#!/bin/bash\n")
-		text_file.write("#PBS -N Database_Format\n")
-		text_file.write("#PBS -l nodes=1:ppn=1\n")
-		text_file.write("#PBS -l mem=5gb\n")
-		text_file.write("#PBS -l walltime=3:00:00\n")
-		text_file.write("#PBS -q iw-shared-6\n")
-		text_file.write("#PBS -j oe\n")
-		text_file.write("#PBS -o " + database_base + "_Format.out\n")
-		text_file.write("#PBS -e " + database_base + "_Format.err\n\n")
-		text_file.write("\ncd " + rundir + "\n\n")
-		text_file.write("\nmodule load boost/1.53.0\nmodule load python/2.7\nmodule load ncbi_blast/2.2.29\n")
-		text_file.write("\nmakeblastdb -in " + database_fullpath + " -dbtype " + dbtype + " -title " + database_base + " -out " + database_dir + "/" + database_base + " -logfile " + database_dir + "/DB_Format_Log.txt\n")
-		text_file.close()
-
-	formatDatabase()
-
-	# Check if database exists and if overwrite is active
-	if os.path.exists(database_dir + "/" + database_base + ".phr"):
-		if force == True:
-			try:
-				os.remove(rundir + "/" + database_base + "_Format.out")
-			except OSError:
-				pass
-			os.system("qsub " + output_fullpath + "/Format" + database_base + "_DB.pbs")
-			for i in range(1000):
-				if os.path.exists(rundir + "/" + database_base +"_Format.out"):
-					break
-				else:
-					print("Still Formatting Database")
-					time.sleep(30)
-					continue
-			os.system("mv " + rundir + "/" + database_base + "_Format.out " + output_fullpath)
-	else:
-		os.system("qsub " + output_fullpath + "/Format" + database_base + "_DB.pbs")
-		for i in range(1000):
-			if os.path.exists(rundir + "/" + database_base +"_Format.out"):
-				break
-			else:
-				print("Still Formatting Database")
-				time.sleep(30)
-				continue
-		os.system("mv " + rundir + "/" + database_base + "_Format.out " + output_fullpath)
-	step += 1
-
-"""------------------3.0 Split Query ----------------------"""
-
-if step == 2:
-	if not os.path.exists(output_fullpath):
-		os.makedirs(output_fullpath)
-	print("Splitting Query: " + query_name)
-
-	def SplitQuery():
-		divide = open(output_fullpath + "/Split.py", "w")
-		divide.write("#!/usr/bin/env python\nfrom Bio import SeqIO\nimport sys, math\n")
-		divide.write("record_iter = SeqIO.parse(open(\"" + query_fullpath + "\", \"r\"),\"fasta\")\n")
-		divide.write("number=0\n")
-		divide.write("for record in record_iter:\n")
-		divide.write("\tnumber += 1\n")
-		divide.write("num_seqs = int(math.ceil(number/float(" + jobs + ")))\n")
-		divide.write("def batch_iterator(iterator, batch_size) :\n")
-		divide.write("\tentry = True\n")
-		divide.write("\twhile entry :\n")
-		divide.write("\t\tbatch = []\n")
-		divide.write("\t\twhile len(batch) < batch_size :\n")
-		divide.write("\t\t\ttry :\n")
-		divide.write("\t\t\t\tentry = next(iterator)\n")
-		divide.write("\t\t\texcept StopIteration :\n")
-		divide.write("\t\t\t\tentry = None\n")
-		divide.write("\t\t\tif entry is None :\n")
-		divide.write("\t\t\t\tbreak\n")
-		divide.write("\t\t\tbatch.append(entry)\n")
-		divide.write("\t\tif batch :\n")
-		divide.write("\t\t\tyield batch\n")
-		divide.write("record_iter = SeqIO.parse(open(\"" + query_fullpath + "\", \"r\"),\"fasta\")\n")
-		divide.write("for i, batch in enumerate(batch_iterator(record_iter, num_seqs)) :\n")
-		divide.write("\tfilename = \"" + query_dir + "/" + query_base + "_Split/" + query_base + "_%i.fasta\" % (i+1)\n")
-		divide.write("\thandle = open(filename, \"w\")\n")
-		divide.write("\tcount = SeqIO.write(batch, handle, \"fasta\")\n")
-		divide.write("\thandle.close()\n")
-		divide.write("\tprint(\"Wrote %i records to %s\" % (count, filename)) \n")
-		divide.close()
-
-
-		split_pbs = open(output_fullpath + "/Split.pbs", "w")
-		split_pbs.write("#!/bin/bash\n#PBS -N Split_Query\n#PBS -l nodes=1:ppn=1\n#PBS -l mem=5gb\n#PBS -l walltime=12:00:00\n#PBS -q iw-shared-6\n#PBS -j oe\n#PBS -o Split_" + query_base + ".out\n#PBS -e Split_" + query_base + ".err\n\n")
-		split_pbs.write("\nmodule load intel\ncd "+ output_fullpath + "\n")
-		split_pbs.write("\npython Split.py\n")
-		split_pbs.close()
-
-	SplitQuery()
-
-
-	if os.path.exists(query_dir + "/" + query_base + "_Split"):
-		if force == True:
-			try:
-				os.removedirs(query_dir + "/" + query_base + "_Split")
-				os.makedirs(query_dir + "/" + query_base + "_Split")
-			except OSError:
-				pass
-			os.system("qsub " + output_fullpath + "/Split.pbs")
-			for i in range(1000):
-				if os.path.exists(rundir + "/Split_" + query_base + ".out"):
-					break
-				else:
-					print("Spliting Query")
-					time.sleep(30)
-					continue
-			os.system("mv " + rundir + "/Split_" + query_base + ".out " + output_dir + "/" + output_name + "/")
-	else:
-		os.makedirs(query_dir + "/" + query_base + "_Split")
-		os.system("qsub " + output_fullpath + "/Split.pbs")
-		for i in range(1000):
-			if os.path.exists(rundir + "/Split_" + query_base + ".out"):
-				break
-			else:
-				print("Spliting Query")
-				time.sleep(30)
-				continue
-		os.system("mv " + rundir + "/Split_" + query_base + ".out " + output_dir + "/" + output_name + "/")
-	step += 1
-
-
-"""------------------4.0 Run Blast------------------------"""
-
-if step == 3:
-	if not os.path.exists(output_fullpath):
-		os.makedirs(output_fullpath)
-	print("Running Blast: " + query_name)
-	queries = glob.glob(query_dir + "/" + query_base + "_Split/" + query_base + "_*.fasta")
-	#queries = glob.glob(output_dir + "/" + output_name + "/query_*.fasta")
-	lon = len(queries)
-	i = 0
-	while i < lon:
-		query_i = queries[i]
-		blast_pbs = open(output_fullpath + "/Blast-" + query_base + "_" + str(i+1) + ".pbs", "w")
-		blast_pbs.write("#PBS -N Blast-" + query_base + "_" + str(i+1)+"\n#PBS -l nodes=1:ppn=2\n#PBS -l mem=10gb\n#PBS -l walltime=12:00:00\n#PBS -q iw-shared-6\n#PBS -j oe\n#PBS -o Blast-" + query_base + "_" + str(i+1)+".out\n#PBS -e Blast-" + query_base + "_" + str(i+1)+".err\n\n")
-		blast_pbs.write("\nmodule load boost/1.53.0;\nmodule load python/2.7;\nmodule load ncbi_blast/2.2.29;\n")
-		blast_pbs.write("\ncd "+ output_fullpath +"\n")
-		blast_pbs.write("\npwd\n")
-		blast_pbs.write("\n" + program + " -db " + database_dir + "/" + database_base + " -query " + query_i + " -out " + output_fullpath + "/" + query_base + "_" + str(i+1) + ".fasta.blast -num_threads 2 " + ''.join(blast_opt) + "\n")
-		blast_pbs.close()
-		os.chdir(output_fullpath)
-		os.system("qsub "+ output_fullpath + "/Blast-" + query_base + "_" + str(i+1) +".pbs")
-		time.sleep(1)
-		i += 1
-
-print("Jobs Submitted. Check outputs in a while!")
+    """--------------------1.3 Filter Variables ------------------------------"""
+
+    parser.add_argument("--filter", dest='filter_expression', default=None, help="""Filter each shard output as soon as its search ends, e.g.
+    "pident >= 30 and bitscore >= 50 and evalue <= 10" (see Blast_Tab_Filter.py). Requires -outfmt 6""")
+    parser.add_argument("--filter_hits", choices=["best", "first", "all"], default=None, help="""Hits kept per query by the filter: the best (best),
+    the first passing the filter (first) or all passing the filter (all). Enables the filter. If none, best""")
+    parser.add_argument("--filter_threads", type=int, default=2, help="Shard outputs filtered at the same time. If none, 2")
+    parser.add_argument("--keep_raw", action='store_true', help="Keep the unfiltered shard outputs. By default they are removed once filtered")
+
+    args = parser.parse_args()
+
+    paths = get_paths(args.query, args.database, args.output)
+
+    # Number of jobs
+    jobs = args.jobs if args.jobs else input("Number of Jobs to Run: ")
+    jobs = str(jobs)
+
+    # Step to run
+    step = args.step
+    scheduler = {"backend": args.backend, "queue": args.queue, "modules": args.modules,
+                 "workers": max(1, args.threads // args.blast_threads), "poll_interval": args.poll}
+
+    if not os.path.exists(paths["output_fullpath"]):
+        os.makedirs(paths["output_fullpath"])
+    if step == 1:
+        paths["database_prefix"] = format_database(paths, args.dbtype, args.force, scheduler, args.db_opt, args.db_cache)
+        step += 1
+    elif step <= 3 and args.db_cache:
+        paths["database_prefix"] = locate_database(paths, args.dbtype, args.db_opt, args.db_cache)["prefix"]
+    if step == 2:
+        split_query(paths, jobs, args.force or args.split)
+        step += 1
+    if step == 3:
+        filter_options = None
+        if args.filter_expression is not None or args.filter_hits is not None:
+            from Blast_Tab_Filter import hit_filter_expression
+            filter_expression = args.filter_expression
+            if filter_expression is None:
+                filter_expression = hit_filter_expression(None, None, None, None, None, None, None)
+            filter_options = {"expression": filter_expression, "hits": args.filter_hits or "best",
+                              "threads": args.filter_threads, "keep_raw": args.keep_raw}
+        run_blast(paths, args.program, args.blast_opt, scheduler, args.blast_threads, filter_options)
+        step += 1
+    if step == 4:
+        merged_file = merge_blast_outputs(paths, args.compress)
+        print("Done! Check your output " + merged_file)
+
+if __name__ == "__main__":
+    main()
@@ -8,59 +8,195 @@
 # Date:		 22 March 2019
 
 # Description: This script parses Blast 2.2.31+ SAM output )-outfmt 15), selecting the best hit
-and removing the duplications in the reference IDs
+and removing the duplications in the reference IDs. Input grouped by read (as written by Blast)
+can be streamed keeping a single read in memory, and the output can be written as BAM
+with multithreaded compression (requires samtools).
 ########################################################################
 """
 
 ################################################################################
 """---1.0 Import Modules---"""
 from random import randrange
-import argparse, sys
+from Blast_Tabular_Reader import open_tabular
+import argparse, sys, shutil, subprocess
 
 ################################################################################
 """---2.0 Define Functions---"""
 
-def Blast_SAM_Parser(SAM_File, Output_File):
-    Output_FH = open(Output_File, "w")
-    with open(SAM_File, "r") as SAM_FH:
-        Header_Count = 0
-        Ref_ID = []
-        Read_ID = {}
+def Reference_Key(Line):
+    """
+    Returns the reference ID of an @SQ header used to remove duplicated references.
+
+    Arguments:
+        Line {string} -- @SQ header line
+
+    Returns:
+        [string] -- Reference ID (second field of SN:x|ID|..., or the full SN)
+    """
+    Ref = Line.split()[1]
+    if "|" in Ref:
+        Ref = Ref.split("|")[1]
+    return Ref
+
+
+def Read_SAM_Headers(SAM_File):
+    """
+    Collects the unique header lines of a SAM file. References (@SQ) are unique by
+    their ID and other headers by their content, in order of appearance.
+
+    Arguments:
+        SAM_File {filepath} -- SAM file
+
+    Returns:
+        [list] -- Header lines
+    """
+    Headers = []
+    Seen = set()
+    with open_tabular(SAM_File) as SAM_FH:
         for line in SAM_FH:
-            line = line.strip()
-            if line.startswith('@SQ'):
-                Ref = line.split()[1]
-                Ref = Ref.split("|")[1]
-                if Ref not in Ref_ID:
-                    Ref_ID.append(Ref)
-                    Output_FH.write(line + "\n")
-                else:
-                    pass
-            elif line.startswith('@'):
-                if Header_Count != 0:
-                    Output_FH.write(line + "\n")
-                    Header_Count += 1
+            if line.startswith('@'):
+                line = line.strip()
+                Key = Reference_Key(line) if line.startswith('@SQ') else line
+                if Key not in Seen:
+                    Seen.add(Key)
+                    Headers.append(line)
+    return Headers
+
+
+def Alignment_Bitscore(Line):
+    """
+    Returns the bitscore stored in the BS:f tag of an alignment line.
+    """
+    return float(Line.split("BS:f:")[1].split("\t")[0])
+
+
+def Best_Alignments(Lines):
+    """
+    Selects the best alignment (highest bitscore, ties chosen at random) per read,
+    keeping all reads in memory.
+
+    Arguments:
+        Lines {iterable} -- SAM lines, headers are skipped
+
+    Returns:
+        [generator] -- Best alignment line per read
+    """
+    Read_ID = {}
+    for line in Lines:
+        if line.startswith('@'):
+            continue
+        line = line.strip()
+        if not line:
+            continue
+        Read = line.split()[0]
+        Bitscore = Alignment_Bitscore(line)
+        if Read not in Read_ID:
+            Read_ID[Read] = [Bitscore, line]
+        else:
+            if Bitscore > Read_ID[Read][0]:
+                Read_ID[Read] = [Bitscore, line]
+            elif Bitscore == Read_ID[Read][0]:
+                if randrange(0,2) > 0:
+                    Read_ID[Read] = [Bitscore, line]
                 else:
                     pass
             else:
-                Read = line.split()[0]
-                Bitscore = float(line.split("BS:f:")[1])
-                if Read not in Read_ID:
-                    Read_ID[Read] = [Bitscore, line]
-                else:
-                    if Bitscore > Read_ID[Read][0]:
-                        Read_ID[Read] = [Bitscore, line]
-                    elif Bitscore == Read_ID[Read][0]:
-                        if randrange(0,2) > 0:
-                            Read_ID[Read] = [Bitscore, line]
-                        else:
-                            pass
-                    else:
-                        pass
-
-        for key in Read_ID:
-            Output_FH.write(Read_ID[key][1] + "\n")
-    Output_FH.close()
+                pass
+    for key in Read_ID:
+        yield Read_ID[key][1]
+
+
+def Best_Alignments_Grouped(Lines):
+    """
+    Selects the best alignment (highest bitscore, ties chosen uniformly at random) per read
+    from input grouped by read name, keeping only the current read in memory.
+
+    Arguments:
+        Lines {iterable} -- SAM lines grouped by read, headers are skipped
+
+    Returns:
+        [generator] -- Best alignment line per read
+    """
+    Current_Read = None
+    Best_Score = None
+    Best_Line = None
+    Ties = 0
+    for line in Lines:
+        if line.startswith('@'):
+            continue
+        line = line.strip()
+        if not line:
+            continue
+        Read = line.split("\t", 1)[0]
+        Bitscore = Alignment_Bitscore(line)
+        if Read != Current_Read:
+            if Current_Read is not None:
+                yield Best_Line
+            Current_Read, Best_Score, Best_Line, Ties = Read, Bitscore, line, 1
+        elif Bitscore > Best_Score:
+            Best_Score, Best_Line, Ties = Bitscore, line, 1
+        elif Bitscore == Best_Score:
+            # Reservoir sampling among the tied alignments.
+            Ties += 1
+            if randrange(Ties) == 0:
+                Best_Line = line
+    if Current_Read is not None:
+        yield Best_Line
+
+
+def Open_SAM_Output(Output_File, Output_Format="sam", Threads=1):
+    """
+    Opens the output for writing SAM text. BAM is compressed by samtools with Threads threads.
+
+    Arguments:
+        Output_File {filepath} -- Output file
+        Output_Format {string} -- "sam" or "bam"
+        Threads {int} -- Compression threads for BAM output
+
+    Returns:
+        [tuple] -- Text handle and samtools process (None for SAM output)
+    """
+    if Output_Format == "bam":
+        if shutil.which("samtools") is None:
+            sys.exit("BAM output requires samtools in your PATH")
+        Process = subprocess.Popen(["samtools", "view", "-b", "-@", str(Threads), "-o", Output_File, "-"],
+                                   stdin=subprocess.PIPE, universal_newlines=True, bufsize=1048576)
+        return Process.stdin, Process
+    else:
+        return open(Output_File, "w"), None
+
+
+def Blast_SAM_Parser(SAM_File, Output_File, Grouped=False, Output_Format="sam", Threads=1):
+    """
+    Writes the unique headers and the best alignment per read of a Blast SAM file.
+
+    Arguments:
+        SAM_File {filepath} -- Blast SAM output (plain, gzip or zstd)
+        Output_File {filepath} -- Output SAM or BAM file
+        Grouped {bool} -- Alignments of each read are contiguous, stream them
+        Output_Format {string} -- "sam" or "bam"
+        Threads {int} -- Compression threads for BAM output
+    """
+    Headers = Read_SAM_Headers(SAM_File)
+    Output_FH, Process = Open_SAM_Output(Output_File, Output_Format, Threads)
+    try:
+        for line in Headers:
+            Output_FH.write(line + "\n")
+        with open_tabular(SAM_File) as SAM_FH:
+            if Grouped == True:
+                Alignments = Best_Alignments_Grouped(SAM_FH)
+            else:
+                Alignments = Best_Alignments(SAM_FH)
+            for line in Alignments:
+                Output_FH.write(line + "\n")
+    finally:
+        # Errors raised while writing propagate, samtools is only checked once the output is complete.
+        try:
+            Output_FH.close()
+        finally:
+            Status = Process.wait() if Process is not None else 0
+    if Status != 0:
+        sys.exit("samtools failed writing {}".format(Output_File))
 
 ################################################################################
 """---3.0 Main Function---"""
@@ -72,12 +208,19 @@ def main():
                                     'Optional Database Parameters: See ' + sys.argv[0] + ' -h')
     parser.add_argument('-s', '--sam', dest='SAM_File', action='store', required=True, help='SAM file to parse')
     parser.add_argument('-o', '--output', dest='Output_File', action='store', required=True, help='Output SAM file best hits')
+    parser.add_argument('--grouped', dest='Grouped', action='store_true', required=False, help='Alignments are grouped by read (Blast default),\n'
+                        'process them streaming with constant memory.')
+    parser.add_argument('--bam', dest='Output_Format', action='store_const', const='bam', default='sam', help='Write BAM instead of SAM (requires samtools)')
+    parser.add_argument('-t', '--threads', dest='Threads', action='store', type=int, required=False, default=1, help='Threads used to compress BAM output. If none, 1')
     args = parser.parse_args()
 
     SAM_File = args.SAM_File
     Output_File = args.Output_File
+    Grouped = args.Grouped
+    Output_Format = args.Output_Format
+    Threads = args.Threads
 
-    Blast_SAM_Parser(SAM_File, Output_File)
+    Blast_SAM_Parser(SAM_File, Output_File, Grouped, Output_Format, Threads)
 
 if __name__ == "__main__":
     main()
@@ -23,125 +23,452 @@
 """---1.0 Import Modules---"""
 
 import sys, argparse, os
+import heapq
 from random import choice
 from sys import argv
+from Blast_Tabular_Reader import BLAST_COLUMNS, parse_column_spec, open_tabular, is_compressed
+from Blast_Filter_Expression import compile_filter, compile_vectorized_filter
 
 ################################################################################
 
 """---2.0 Define Functions---"""
-def hit_confidence(hit, id_perc, bitscore, evalue, aln_percent, shorter, query, subject):
-    if aln_percent == None:
-        if float(hit[2]) >= float(id_perc) and float(hit[11]) >= float(bitscore) and float(hit[10]) <= float(evalue):
-            high_quality_match = True
-        else:
-            high_quality_match = False
-    else:
+def hit_filter_expression(id_perc, bitscore, evalue, aln_percent, shorter, query, subject):
+    """
+    Builds the filter expression equivalent to the threshold options.
+    Thresholds not provided take their default values.
+
+    Returns:
+        [string] -- Filter expression (see Blast_Filter_Expression)
+    """
+    if id_perc is None:
+        id_perc = 30
+    if bitscore is None:
+        bitscore = 50
+    if evalue is None:
+        evalue = 10
+    expression = "pident >= {!r} and bitscore >= {!r} and evalue <= {!r}".format(float(id_perc), float(bitscore), float(evalue))
+    if aln_percent is not None:
         if shorter == True:
-            if (float(hit[3])*100/min(float(hit[13]),float(hit[12])) >= float(aln_percent)) \
-                and float(hit[11]) >= float(bitscore) and float(hit[2]) >= float(id_perc) and float(hit[10]) <= float(evalue):
-                high_quality_match = True
-            else:
-                high_quality_match = False
+            aligned_on = "min(qlen, slen)"
         elif query == True:
-            if (float(hit[3])*100/float(hit[12])) >= float(aln_percent) and float(hit[11]) \
-                >= float(bitscore) and float(hit[2]) >= float(id_perc) and float(hit[10]) <= float(evalue):
-                high_quality_match = True
-            else:
-                high_quality_match = False
+            aligned_on = "qlen"
         elif subject == True:
-            if (float(hit[3])*100/float(hit[13])) >= float(aln_percent) and float(hit[11]) \
-                >= float(bitscore) and float(hit[2]) >= float(id_perc) and float(hit[10]) <= float(evalue):
-                high_quality_match = True
-            else:
-                high_quality_match = False
+            aligned_on = "slen"
         else:
-            if (float(hit[3])*100/max(float(hit[13]),float(hit[12])) >= float(aln_percent)) \
-                and float(hit[11]) >= float(bitscore) and float(hit[2]) >= float(id_perc) and float(hit[10]) <= float(evalue):
-                high_quality_match = True
-            else:
-                high_quality_match = False
-    return(high_quality_match)
+            aligned_on = "max(qlen, slen)"
+        expression += " and length * 100 / {} >= {!r}".format(aligned_on, float(aln_percent))
+    return expression
+
+def check_blast_columns(input_tab, columns):
+    """
+    Reports the column layout used and warns if the first line does not match it.
+
+    Arguments:
+        input_tab {filepath} -- Blast tabular output
+        columns {list} -- Column names (see parse_column_spec)
+    """
+    with open_tabular(input_tab) as blast_input:
+        first_line = blast_input.readline()
+    print("Reading columns: " + " ".join(columns))
+    if len(first_line.strip().split("\t")) != len(columns):
+        print("Warning: the first line of {} has {} columns but {} were given.".format(
+              input_tab, len(first_line.strip().split("\t")), len(columns)))
+        print("Use --columns to give the outfmt 6 columns of your Blast output.")
 
 ### ----------------------------- Blast Parser ----------------------------------------
-def blast_filter_slow(input_tab, outfile, id_perc, bitscore, evalue, aln_percent, shorter, query, subject):
+def best_hits_from_lines(lines, hit_filter, query_column=0, score_column=11):
+    """
+    Finds the highest scoring high quality hits per query.
+
+    Arguments:
+        lines {iterable} -- Blast tabular lines
+        hit_filter {function} -- Compiled filter (see compile_filter)
+        query_column {int} -- Index of qseqid
+        score_column {int} -- Index of bitscore
+
+    Returns:
+        [dictionary] -- Query: [Best bitscore, [Lines with the best bitscore]]
+    """
     blast_hits = {}
-    print("Reading " + input_tab + " Blast Output")
-    # Check if Blast output has qlen and slen in addition to std output.
-    with open(input_tab) as blast_input:
-        if len(blast_input.readline().strip().split("\t")) == 14:
-            print("I am assuming your Blast output has qlen (col 13) and slen (col 14) besides the standard output columns.")
-            print("If this is not the case, i.e. columns 13 and 14 represent other values, please remove them.")
+    for line in lines:
+        line = line.strip()
+        hit = line.split("\t")
+        if hit_filter(hit) == True:
+            hit_query = hit[query_column]
+            hit_score = float(hit[score_column])
+            if hit_query not in blast_hits:
+                blast_hits[hit_query] = [hit_score, [line]]
+            else:
+                if hit_score < blast_hits[hit_query][0]:
+                    continue
+                elif hit_score > blast_hits[hit_query][0]:
+                    blast_hits[hit_query] = [hit_score, [line]]
+                else:
+                    blast_hits[hit_query][1].append(line)
         else:
-            print("I am assuming your Blast output has the standard Blast tabular output")
+            continue
+    return blast_hits
+
+def first_hits_from_lines(lines, hit_filter, query_column=0):
+    """
+    Yields the first high quality hit per query.
+
+    Arguments:
+        lines {iterable} -- Blast tabular lines
+        hit_filter {function} -- Compiled filter (see compile_filter)
+        query_column {int} -- Index of qseqid
+
+    Returns:
+        [generator] -- Retained lines
+    """
+    blast_hits = set()
+    for line in lines:
+        line = line.strip()
+        hit = line.split("\t")
+        if hit_filter(hit) == True:
+            if hit[query_column] not in blast_hits:
+                blast_hits.add(hit[query_column])
+                yield line
+            else:
+                continue
+
+def top_hits_from_lines(lines, hit_filter, top_hits=None, top_percent=None, grouped=False,
+                        query_column=0, score_column=11):
+    """
+    Finds the top_hits highest scoring high quality hits per query and/or all those
+    within top_percent of the best bitscore of the query. Each open query keeps a
+    heap bounded by these limits, which is released as soon as the input moves to
+    another query (grouped input) or at the end of the input.
+
+    Arguments:
+        lines {iterable} -- Blast tabular lines
+        hit_filter {function} -- Compiled filter (see compile_filter)
+        top_hits {int} -- Maximum hits per query
+        top_percent {float} -- Keep hits with bitscore >= best * (1 - top_percent/100)
+        grouped {bool} -- Lines of each query are contiguous
+        query_column {int} -- Index of qseqid
+        score_column {int} -- Index of bitscore
+
+    Returns:
+        [generator] -- Lists of retained lines per query, highest bitscore first
+    """
+    open_queries = {}
+    hit_number = 0
+    for line in lines:
+        line = line.strip()
+        hit = line.split("\t")
+        if hit_filter(hit) == False:
+            continue
+        hit_query = hit[query_column]
+        hit_score = float(hit[score_column])
+        if grouped == True and open_queries and hit_query not in open_queries:
+            for query_hits in open_queries.values():
+                yield [heap_hit[2] for heap_hit in sorted(query_hits[1], reverse=True)]
+            open_queries = {}
+        if hit_query not in open_queries:
+            open_queries[hit_query] = [hit_score, []]
+        query_hits = open_queries[hit_query]
+        query_hits[0] = max(query_hits[0], hit_score)
+        # Min-heap on (bitscore, -order), ties are resolved in favor of the first hit.
+        hit_number += 1
+        heapq.heappush(query_hits[1], (hit_score, -hit_number, line))
+        if top_percent is not None:
+            min_score = query_hits[0] * (1 - top_percent / 100)
+            while query_hits[1][0][0] < min_score:
+                heapq.heappop(query_hits[1])
+        if top_hits is not None and len(query_hits[1]) > top_hits:
+            heapq.heappop(query_hits[1])
+    for query_hits in open_queries.values():
+        yield [heap_hit[2] for heap_hit in sorted(query_hits[1], reverse=True)]
+
+def blast_filter_slow(input_tab, outfile, id_perc, bitscore, evalue, aln_percent, shorter, query, subject,
+                        filter_expression=None, columns=BLAST_COLUMNS):
+    print("Reading " + input_tab + " Blast Output")
+    check_blast_columns(input_tab, columns)
     # Check if any parameter was given for match filtering.
-    if all(variable is None for variable in [id_perc, bitscore, evalue, aln_percent]):
+    if filter_expression is not None:
+        print("Retrieving best match per sequence using the filter expression you provided.")
+    elif all(variable is None for variable in [id_perc, bitscore, evalue, aln_percent]):
         print("Retrieving best match per sequence using default parameters.")
     else:
         print("Retrieving best match per seqeunce using parameters you provided. If only some provided, the others will take their default values.")
-    # Setting default values if not provided
-    if id_perc is None:
-        id_perc = 30
-    if bitscore is None:
-        bitscore = 50
-    if evalue is None:
-        evalue = 10
+    if filter_expression is None:
+        filter_expression = hit_filter_expression(id_perc, bitscore, evalue, aln_percent, shorter, query, subject)
+    print("Filter: " + filter_expression)
+    hit_filter = compile_filter(filter_expression, columns)
     # Retrieve best matches
-    with open(input_tab) as blast_input:
-        for line in blast_input:
-            line = line.strip()
-            hit = line.split("\t")
-            good_hit = hit_confidence(hit, id_perc, bitscore, evalue, aln_percent, shorter, query, subject)
-            if good_hit == True:
-                if hit[0] not in blast_hits:
-                    blast_hits[hit[0]] = [float(hit[11]), [line]]
-                else:
-                    if float(hit[11]) < blast_hits[hit[0]][0]:
-                        continue
-                    elif float(hit[11]) > blast_hits[hit[0]][0]:
-                        blast_hits[hit[0]] = [float(hit[11]), [line]]
-                    else:
-                        blast_hits[hit[0]][1].append(line)
-            else:
-                continue
+    with open_tabular(input_tab) as blast_input:
+        blast_hits = best_hits_from_lines(blast_input, hit_filter, columns.index("qseqid"), columns.index("bitscore"))
     with open(outfile, 'w') as output:
         for hit_values in blast_hits.values():
             output.write("{}\n".format(choice(hit_values[1])))
     print("Done! Check your output {}".format(outfile))
 
-def blast_filter_fast(input_tab, outfile, id_perc, bitscore, evalue, aln_percent, shorter, query, subject):
-    blast_hits = []
+def blast_filter_fast(input_tab, outfile, id_perc, bitscore, evalue, aln_percent, shorter, query, subject,
+                        filter_expression=None, columns=BLAST_COLUMNS):
     print("Reading " + input_tab + " Blast Output")
-    # Check if Blast output has qlen and slen in addition to std output.
-    with open(input_tab) as blast_input:
-        if len(blast_input.readline().strip().split("\t")) == 14:
-            print("I am assuming your Blast output has qlen (col 13) and slen (col 14) besides the standard output columns.")
-            print("If this is not the case, i.e. columns 13 and 14 represent other values, please remove them.")
-        else:
-            print("I am assuming your Blast output has the standard Blast tabular output")
+    check_blast_columns(input_tab, columns)
     # Check if any parameter was given for match filtering.
-    if all(variable is None for variable in [id_perc, bitscore, evalue, aln_percent]):
+    if filter_expression is not None:
+        print("Retrieving best match per sequence using the filter expression you provided.")
+    elif all(variable is None for variable in [id_perc, bitscore, evalue, aln_percent]):
         print("Retrieving best match per sequence using default parameters.")
     else:
         print("Retrieving best match per seqeunce using parameters you provided (if only some, the others will take their default values.")
-    # Setting default values if not provided
-    if id_perc is None:
-        id_perc = 30
-    if bitscore is None:
-        bitscore = 50
-    if evalue is None:
-        evalue = 10
+    if filter_expression is None:
+        filter_expression = hit_filter_expression(id_perc, bitscore, evalue, aln_percent, shorter, query, subject)
+    print("Filter: " + filter_expression)
+    hit_filter = compile_filter(filter_expression, columns)
     # Retrieve best matches
-    with open(input_tab, 'r') as tabular, open(outfile, 'w') as output:
+    with open_tabular(input_tab) as tabular, open(outfile, 'w') as output:
+        for line in first_hits_from_lines(tabular, hit_filter, columns.index("qseqid")):
+            output.write("{}\n".format(line))
+    print("Done! Check your output {}".format(outfile))
+
+
+def blast_filter_top(input_tab, outfile, id_perc, bitscore, evalue, aln_percent, shorter, query, subject,
+                        top_hits=None, top_percent=None, grouped=False, filter_expression=None, columns=BLAST_COLUMNS):
+    """
+    Retains the best top_hits hits per query and/or all hits within top_percent of the best bitscore.
+
+    Arguments:
+        input_tab {filepath} -- Blast tabular output
+        outfile {filepath} -- Filtered output
+        top_hits {int} -- Maximum hits per query
+        top_percent {float} -- Percentage below the best bitscore of the query to retain
+        grouped {bool} -- Input is grouped by query, release each query as soon as it ends
+        filter_expression {string} -- Filter used instead of the thresholds
+        columns {list} -- Columns of the Blast output (see parse_column_spec)
+    """
+    print("Reading " + input_tab + " Blast Output")
+    check_blast_columns(input_tab, columns)
+    if filter_expression is None:
+        filter_expression = hit_filter_expression(id_perc, bitscore, evalue, aln_percent, shorter, query, subject)
+    print("Filter: " + filter_expression)
+    print("Retaining per query: {}{}{}".format("the best {} hits".format(top_hits) if top_hits is not None else "",
+          " and " if top_hits is not None and top_percent is not None else "",
+          "hits within {}% of the best bitscore".format(top_percent) if top_percent is not None else ""))
+    hit_filter = compile_filter(filter_expression, columns)
+    with open_tabular(input_tab) as tabular, open(outfile, 'w') as output:
+        for query_lines in top_hits_from_lines(tabular, hit_filter, top_hits, top_percent, grouped,
+                                               columns.index("qseqid"), columns.index("bitscore")):
+            for line in query_lines:
+                output.write("{}\n".format(line))
+    print("Done! Check your output {}".format(outfile))
+
+
+### ------------------------- Vectorized Blast Parser ---------------------------
+def blast_filter_vectorized(input_tab, outfile, id_perc, bitscore, evalue, aln_percent, shorter, query, subject,
+                            rapid=False, chunk_size=1000000, filter_expression=None, columns=BLAST_COLUMNS):
+    """
+    Filters a Blast tabular output in chunks of typed columns. Produces the same output
+    as blast_filter_slow (or blast_filter_fast if rapid is True).
+
+    Arguments:
+        input_tab {filepath} -- Blast tabular output
+        outfile {filepath} -- Filtered output
+        rapid {bool} -- Retain the first high quality hit per query instead of the best
+        chunk_size {int} -- Lines parsed per chunk
+        filter_expression {string} -- Filter used instead of the thresholds
+        columns {list} -- Columns of the Blast output (see parse_column_spec)
+    """
+    import numpy as np
+    import pandas as pd
+    from Blast_Tabular_Reader import read_line_batches, parse_tabular_lines
+    print("Reading " + input_tab + " Blast Output")
+    check_blast_columns(input_tab, columns)
+    if filter_expression is None:
+        filter_expression = hit_filter_expression(id_perc, bitscore, evalue, aln_percent, shorter, query, subject)
+    print("Retrieving best match per sequence using vectorized filter: " + filter_expression)
+    hit_filter = compile_vectorized_filter(filter_expression, columns)
+    usecols = ["qseqid", "bitscore"] + [column for column in hit_filter.columns if column not in ("qseqid", "bitscore")]
+    with open_tabular(input_tab) as blast_input, open(outfile, 'w') as output:
+        seen_queries = set()
+        best_chunks = []
+        line_offset = 0
+        for lines in read_line_batches(blast_input, chunk_size):
+            if not lines:
+                continue
+            hits = parse_tabular_lines(lines, columns, usecols)
+            mask = hit_filter(hits)
+            good_hits = pd.DataFrame({"query": hits["qseqid"][mask],
+                                      "bitscore": hits["bitscore"][mask],
+                                      "line": np.asarray(lines, dtype=object)[mask],
+                                      "first": np.flatnonzero(mask) + line_offset})
+            line_offset += len(lines)
+            if rapid == True:
+                # Keep the first high quality hit of queries not written in previous chunks.
+                good_hits = good_hits.drop_duplicates("query")
+                new_query = np.fromiter((hit_query not in seen_queries for hit_query in good_hits["query"]),
+                                        dtype=bool, count=len(good_hits))
+                good_hits = good_hits[new_query]
+                seen_queries.update(good_hits["query"])
+                for line in good_hits["line"]:
+                    output.write("{}\n".format(line.strip()))
+            else:
+                best_chunks.append(reduce_best_hits(good_hits))
+        if rapid == False and best_chunks:
+            best_hits = reduce_best_hits(pd.concat(best_chunks, ignore_index=True))
+            # Random choice among tied hits, reported in order of first appearance.
+            best_hits = best_hits.sample(frac=1).drop_duplicates("query").sort_values("first")
+            for line in best_hits["line"]:
+                output.write("{}\n".format(line.strip()))
+    print("Done! Check your output {}".format(outfile))
+
+def reduce_best_hits(good_hits):
+    """
+    Keeps the hits with the highest bitscore per query (all of them if tied),
+    along with the position of the first high quality hit of the query.
+
+    Arguments:
+        good_hits {DataFrame} -- Query, bitscore, line and first columns
+
+    Returns:
+        [DataFrame] -- Best hits per query
+    """
+    by_query = good_hits.groupby("query", sort=False)
+    good_hits = good_hits.assign(first=by_query["first"].transform("min"))
+    return good_hits[good_hits["bitscore"] == by_query["bitscore"].transform("max")]
+
+
+### --------------------------- Sharded Blast Parser ----------------------------
+def find_shard_boundaries(input_tab, shards):
+    """
+    Splits a tabular file into byte ranges of similar size. Each boundary is moved
+    forward to the first line of a new query, so no query is split between shards
+    (input must be grouped by query, as Blast writes it).
+
+    Arguments:
+        input_tab {filepath} -- Tabular file with the query in the first column
+        shards {int} -- Number of byte ranges to create
+
+    Returns:
+        [list] -- (start, end) byte offsets per shard
+    """
+    file_size = os.path.getsize(input_tab)
+    boundaries = [0]
+    with open(input_tab, 'rb') as tabular:
+        for shard in range(1, shards):
+            position = max(file_size * shard // shards, boundaries[-1])
+            tabular.seek(position)
+            # Move to the beginning of the next line.
+            tabular.readline()
+            line = tabular.readline()
+            if not line:
+                break
+            current_query = line.split(b"\t", 1)[0]
+            while True:
+                line_start = tabular.tell()
+                line = tabular.readline()
+                if not line or line.split(b"\t", 1)[0] != current_query:
+                    break
+            if line_start >= file_size:
+                break
+            if line_start > boundaries[-1]:
+                boundaries.append(line_start)
+    boundaries.append(file_size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+def read_shard_lines(input_tab, start, end):
+    """
+    Reads the lines of a file found within a byte range.
+
+    Arguments:
+        input_tab {filepath} -- Input file
+        start {int} -- Byte where the range starts (beginning of a line)
+        end {int} -- Byte where the range ends (beginning of a line or end of file)
+
+    Returns:
+        [generator] -- Lines within the range
+    """
+    remaining = end - start
+    with open(input_tab, 'rb') as tabular:
+        tabular.seek(start)
         for line in tabular:
-            line = line.strip()
-            hit = line.split("\t")
-            good_hit = hit_confidence(hit, id_perc, bitscore, evalue, aln_percent, shorter, query, subject)
-            if good_hit == True:
-                if hit[0] not in blast_hits:
+            if remaining <= 0:
+                break
+            remaining -= len(line)
+            yield line.decode()
+
+def filter_shard(shard):
+    """
+    Filters a byte range of a Blast tabular file and saves the retained hits.
+
+    Arguments:
+        shard {tuple} -- Input file, start, end, shard output and filtering parameters
+
+    Returns:
+        [filepath] -- Shard output file
+    """
+    input_tab, start, end, shard_output, filter_expression, rapid, columns, top_hits, top_percent = shard
+    hit_filter = compile_filter(filter_expression, columns)
+    lines = read_shard_lines(input_tab, start, end)
+    with open(shard_output, 'w') as output:
+        if top_hits is not None or top_percent is not None:
+            for query_lines in top_hits_from_lines(lines, hit_filter, top_hits, top_percent, True,
+                                                   columns.index("qseqid"), columns.index("bitscore")):
+                for line in query_lines:
                     output.write("{}\n".format(line))
-                    blast_hits.append(hit[0])
-                else:
-                    continue
+        elif rapid == True:
+            for line in first_hits_from_lines(lines, hit_filter, columns.index("qseqid")):
+                output.write("{}\n".format(line))
+        else:
+            blast_hits = best_hits_from_lines(lines, hit_filter, columns.index("qseqid"), columns.index("bitscore"))
+            for hit_values in blast_hits.values():
+                output.write("{}\n".format(choice(hit_values[1])))
+    return shard_output
+
+def blast_filter_parallel(input_tab, outfile, id_perc, bitscore, evalue, aln_percent, shorter, query, subject,
+                            rapid=False, threads=1, filter_expression=None, columns=BLAST_COLUMNS,
+                            top_hits=None, top_percent=None):
+    """
+    Filters a Blast tabular output split in byte ranges processed in parallel.
+    The retained hits of each shard are merged in the original order.
+
+    Arguments:
+        input_tab {filepath} -- Blast tabular output, grouped by query
+        outfile {filepath} -- Filtered output
+        rapid {bool} -- Retain the first high quality hit per query instead of the best
+        threads {int} -- Number of processes (and shards) to use
+        filter_expression {string} -- Filter used instead of the thresholds
+        columns {list} -- Columns of the Blast output (see parse_column_spec)
+        top_hits {int} -- Retain up to top_hits hits per query instead of the best one
+        top_percent {float} -- Retain the hits within top_percent of the best bitscore of each query
+    """
+    import multiprocessing
+    from shutil import copyfileobj
+    if is_compressed(input_tab) is not None:
+        print("Compressed input cannot be split in byte ranges, filtering on a single process.")
+        if top_hits is not None or top_percent is not None:
+            blast_filter_top(input_tab, outfile, id_perc, bitscore, evalue, aln_percent, shorter, query, subject,
+                                top_hits, top_percent, True, filter_expression, columns)
+        elif rapid == True:
+            blast_filter_fast(input_tab, outfile, id_perc, bitscore, evalue, aln_percent, shorter, query, subject,
+                                filter_expression, columns)
+        else:
+            blast_filter_slow(input_tab, outfile, id_perc, bitscore, evalue, aln_percent, shorter, query, subject,
+                                filter_expression, columns)
+        return
+    print("Reading " + input_tab + " Blast Output using {} processes".format(threads))
+    check_blast_columns(input_tab, columns)
+    if filter_expression is None:
+        filter_expression = hit_filter_expression(id_perc, bitscore, evalue, aln_percent, shorter, query, subject)
+    print("Filter: " + filter_expression)
+    shards = []
+    for shard_number, (start, end) in enumerate(find_shard_boundaries(input_tab, threads)):
+        shard_output = "{}.shard{}".format(outfile, shard_number)
+        shards.append((input_tab, start, end, shard_output, filter_expression, rapid, columns, top_hits, top_percent))
+    pool = multiprocessing.Pool(threads)
+    try:
+        shard_outputs = pool.map(filter_shard, shards, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    with open(outfile, 'w') as output:
+        for shard_output in shard_outputs:
+            with open(shard_output) as shard_hits:
+                copyfileobj(shard_hits, output)
+            os.remove(shard_output)
     print("Done! Check your output {}".format(outfile))
 
 
@@ -163,6 +490,9 @@ def main():
                             help='Input blast result in tabular format')
         input_options.add_argument('-o', '--outfile', dest='outfile', action='store', required=True,
                             help='Output filtered blast result in tabular format')
+        input_options.add_argument('--columns', dest='columns', action='store', default=" ".join(BLAST_COLUMNS),
+                            help='Columns of the Blast output, as given to -outfmt 6 ("std" accepted).\n'
+                                'By default "' + " ".join(BLAST_COLUMNS) + '"')
         thresholds = parser.add_argument_group('Thresholds used for filtering')
         thresholds.add_argument('--id_perc', dest='id_perc', action='store', type=float,
                             help='Minimum percentage identity for a match to be included. By default 30')
@@ -173,6 +503,10 @@ def main():
         thresholds.add_argument('--aln_percent', dest='aln_percent', action='store', type=float,
                             help='Minimum alignment the match must cover to be included.\n' 
                                 'Only calculated if you have qlen and slen in your output.')
+        thresholds.add_argument('--filter', dest='filter_expression', action='store',
+                            help='Filter expression used instead of the thresholds above, e.g.\n'
+                                '"pident >= 30 and bitscore >= 50 and aln_len / min(qlen, slen) >= 0.7".\n'
+                                'Any column given in --columns can be used. Functions: min, max, abs.')
         flags = parser.add_argument_group('Additional flags. Only calculated if you have qlen and slen in your output.')
         flags.add_argument('--longer', action='store_true',
                             help='Calculates the alignment percentage on the longer sequence, by default calculated on the shorter')
@@ -183,6 +517,23 @@ def main():
         mode = parser.add_argument_group('Filtering mode. Activate fast filtering by passing "--rapid"')
         mode.add_argument('--rapid', action='store_true',
                             help='Performs rapid filtering, see help for requirements.')
+        mode.add_argument('--top_hits', dest='top_hits', action='store', type=int,
+                            help='Retain up to this number of best hits per query instead of only the best one.')
+        mode.add_argument('--top_percent', dest='top_percent', action='store', type=float,
+                            help='Retain all hits within this percentage of the best bitscore of each query\n'
+                                '(like DIAMOND --top). Can be combined with --top_hits.')
+        mode.add_argument('--sorted', dest='grouped', action='store_true',
+                            help='Input is grouped by query (Blast default). Only with --top_hits/--top_percent: each\n'
+                                'query is written as soon as the next one starts, keeping memory constant.')
+        mode.add_argument('--vectorized', action='store_true',
+                            help='Parses and filters the input in typed column chunks (requires numpy and pandas).\n'
+                                'Gives the same output as the regular or rapid mode. Not available with\n'
+                                '--top_hits/--top_percent or --threads.')
+        mode.add_argument('-t', '--threads', dest='threads', action='store', type=int, default=1,
+                            help='Number of processes to use. The input is split in byte ranges at query\n'
+                                'boundaries, so it must be grouped by query (Blast default). By default 1')
+        mode.add_argument('--chunk_size', dest='chunk_size', action='store', type=int, default=1000000,
+                            help='Lines per chunk in vectorized mode. By default 1000000')
         args = parser.parse_args()
 #! CORRECT LONGER VS SHORTER SEQUENCE
         input_tab = args.input_tab
@@ -195,11 +546,36 @@ def main():
         query = args.query
         subject = args.subject
         rapid = args.rapid
+        vectorized = args.vectorized
+        chunk_size = args.chunk_size
+        threads = args.threads
+        filter_expression = args.filter_expression
+        columns = parse_column_spec(args.columns)
+        top_hits = args.top_hits
+        top_percent = args.top_percent
+        grouped = args.grouped
 
-        if rapid == True:
-            blast_filter_fast(input_tab, outfile, id_perc, bitscore, evalue, aln_percent, longer, query, subject)
+        if vectorized == True and (top_hits is not None or top_percent is not None):
+            parser.error("--vectorized cannot be combined with --top_hits/--top_percent")
+        if vectorized == True and threads > 1:
+            parser.error("--vectorized cannot be combined with --threads")
+        if grouped == True and top_hits is None and top_percent is None:
+            parser.error("--sorted only applies with --top_hits/--top_percent")
+        if threads > 1:
+            blast_filter_parallel(input_tab, outfile, id_perc, bitscore, evalue, aln_percent, longer, query, subject,
+                                    rapid, threads, filter_expression, columns, top_hits, top_percent)
+        elif top_hits is not None or top_percent is not None:
+            blast_filter_top(input_tab, outfile, id_perc, bitscore, evalue, aln_percent, longer, query, subject,
+                                top_hits, top_percent, grouped, filter_expression, columns)
+        elif vectorized == True:
+            blast_filter_vectorized(input_tab, outfile, id_perc, bitscore, evalue, aln_percent, longer, query, subject,
+                                    rapid, chunk_size, filter_expression, columns)
+        elif rapid == True:
+            blast_filter_fast(input_tab, outfile, id_perc, bitscore, evalue, aln_percent, longer, query, subject,
+                                filter_expression, columns)
         else:
-            blast_filter_slow(input_tab, outfile, id_perc, bitscore, evalue, aln_percent, longer, query, subject)
+            blast_filter_slow(input_tab, outfile, id_perc, bitscore, evalue, aln_percent, longer, query, subject,
+                                filter_expression, columns)
 
 if __name__ == "__main__":
     main()
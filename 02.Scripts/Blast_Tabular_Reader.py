@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+"""
+########################################################################
+# Author:       Carlos A. Ruiz-Perez
+# Email:        cruizperez3@gatech.edu
+# Github:       https://github.com/cruizperez
+# Institution:  Georgia Institute of Technology
+# Version:      0.1
+# Date:         15 February 2020
+
+# Description: This module reads Blast (outfmt 6) and MagicBlast tabular
+# outputs in batches of typed records. The layout is given as an outfmt 6
+# column specification, e.g. "qseqid sseqid pident length ... qlen slen",
+# only the requested columns are parsed and sequence IDs are dictionary
+# encoded as integers. Plain, gzip and zstd (requires zstandard) inputs
+# are detected automatically.
+########################################################################
+"""
+
+################################################################################
+
+"""---1.0 Import Modules---"""
+
+import csv, io
+from itertools import islice
+
+################################################################################
+
+"""---2.0 Define Functions---"""
+
+# Blast outfmt 6 standard columns.
+BLAST_STD_COLUMNS = ["qseqid", "sseqid", "pident", "length", "mismatch", "gapopen", "qstart", "qend",
+                     "sstart", "send", "evalue", "bitscore"]
+
+# Blast outfmt 6 standard columns plus qlen and slen.
+BLAST_COLUMNS = BLAST_STD_COLUMNS + ["qlen", "slen"]
+
+# MagicBlast tabular output columns.
+MAGICBLAST_COLUMNS = ["qseqid", "sseqid", "pident", "not_used1", "not_used2", "not_used3", "qstart", "qend",
+                      "sstart", "send", "not_used4", "not_used5", "score", "qstrand", "sstrand", "qlen",
+                      "btop", "num_placements", "splice", "compartment", "left_overhang", "right_overhang",
+                      "mate_sseqid", "mate_sstart", "composite_score"]
+
+# Sequence identifiers, dictionary encoded when read in batches.
+ID_COLUMNS = {"qseqid", "qacc", "qaccver", "qgi", "sseqid", "sacc", "saccver", "sgi", "sallseqid",
+              "sallacc", "sallgi", "mate_sseqid"}
+
+# Columns read as text, all others are numeric.
+STRING_COLUMNS = ID_COLUMNS | {"qstrand", "sstrand", "btop", "splice", "compartment", "qseq", "sseq",
+                               "stitle", "salltitles", "frames", "staxids", "sscinames", "scomnames",
+                               "sblastnames", "sskingdoms", "mate_sstart", "not_used1", "not_used2",
+                               "not_used3", "not_used4", "not_used5"}
+
+# Numeric columns holding integers.
+INTEGER_COLUMNS = {"length", "mismatch", "gapopen", "gaps", "positive", "nident", "qstart", "qend",
+                   "sstart", "send", "qlen", "slen", "score", "qframe", "sframe", "staxid", "num_placements",
+                   "left_overhang", "right_overhang"}
+
+
+def parse_column_spec(column_spec):
+    """
+    Parses an outfmt 6 column specification.
+
+    Arguments:
+        column_spec {string or list} -- Column names separated by spaces, optionally preceded
+                                        by "6" and accepting "std" for the standard columns
+
+    Returns:
+        [list] -- Column names
+    """
+    if isinstance(column_spec, str):
+        column_spec = column_spec.replace("'", " ").replace('"', " ").split()
+    columns = []
+    for column in column_spec:
+        if column in ("6", "7"):
+            continue
+        elif column == "std":
+            columns += BLAST_STD_COLUMNS
+        else:
+            columns.append(column)
+    if not columns:
+        columns = list(BLAST_STD_COLUMNS)
+    return columns
+
+
+def column_dtype(column):
+    """
+    Returns the numpy type used to store a column.
+
+    Arguments:
+        column {string} -- Column name
+
+    Returns:
+        [string] -- "object", "int64" or "float64"
+    """
+    if column in STRING_COLUMNS:
+        return "object"
+    elif column in INTEGER_COLUMNS:
+        return "int64"
+    else:
+        return "float64"
+
+
+def is_compressed(input_file):
+    """
+    Checks if a file is gzip or zstd compressed.
+
+    Arguments:
+        input_file {filepath} -- Input file
+
+    Returns:
+        [string] -- "gzip", "zstd" or None
+    """
+    with open(input_file, 'rb') as input_handle:
+        magic = input_handle.read(4)
+    if magic[:2] == b"\x1f\x8b":
+        return "gzip"
+    elif magic == b"\x28\xb5\x2f\xfd":
+        return "zstd"
+    else:
+        return None
+
+
+def open_tabular(input_file):
+    """
+    Opens a plain, gzip or zstd compressed file for reading as text.
+
+    Arguments:
+        input_file {filepath} -- Input file
+
+    Returns:
+        [file] -- Text file handle
+    """
+    compression = is_compressed(input_file)
+    if compression == "gzip":
+        import gzip
+        return gzip.open(input_file, 'rt')
+    elif compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("Reading zstd compressed files requires the zstandard module (pip install zstandard)")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(input_file, 'rb'), closefd=True))
+    else:
+        return open(input_file, 'r')
+
+
+def read_line_batches(input_handle, batch_size):
+    """
+    Reads a file handle in batches of lines, skipping comments (#) and empty lines.
+
+    Arguments:
+        input_handle {file} -- Open file handle
+        batch_size {int} -- Number of lines read per batch
+
+    Returns:
+        [generator] -- Lists of lines
+    """
+    while True:
+        lines = list(islice(input_handle, batch_size))
+        if not lines:
+            break
+        yield [line for line in lines if line.strip() and not line.startswith("#")]
+
+
+def encode_ids(values, dictionary):
+    """
+    Dictionary encodes an array of IDs, adding unseen IDs to the dictionary.
+
+    Arguments:
+        values {array} -- IDs
+        dictionary {dictionary} -- ID: code, codes are assigned in order of appearance
+
+    Returns:
+        [array] -- Integer codes
+    """
+    import numpy as np
+    import pandas as pd
+    local_codes, uniques = pd.factorize(values)
+    lookup = np.fromiter((dictionary.setdefault(value, len(dictionary)) for value in uniques),
+                         dtype=np.int64, count=len(uniques))
+    return lookup[local_codes]
+
+
+def parse_tabular_lines(lines, columns, usecols=None, dictionaries=None):
+    """
+    Parses a batch of tabular lines into a structured array.
+
+    Arguments:
+        lines {list} -- Tabular lines
+        columns {list} -- Names of all the columns in the file (see parse_column_spec)
+        usecols {list} -- Names of the columns to parse. By default all
+        dictionaries {dictionary} -- Column name: {ID: code}. ID columns present here are
+                                     dictionary encoded (int64). By default IDs are kept as text
+
+    Returns:
+        [array] -- Structured array with one field per parsed column
+    """
+    import numpy as np
+    import pandas as pd
+    if usecols is None:
+        usecols = columns
+    if dictionaries is None:
+        dictionaries = {}
+    positions = {columns.index(column): column for column in usecols}
+    dtypes = {position: column_dtype(column) for position, column in positions.items()}
+    table = pd.read_csv(io.StringIO("".join(lines)), sep="\t", header=None, usecols=list(positions),
+                        dtype=dtypes, quoting=csv.QUOTE_NONE, na_filter=False, skip_blank_lines=False)
+    fields = []
+    for column in usecols:
+        if column in dictionaries:
+            fields.append((column, "int64"))
+        else:
+            fields.append((column, column_dtype(column)))
+    records = np.empty(len(table), dtype=fields)
+    for position, column in positions.items():
+        if column in dictionaries:
+            records[column] = encode_ids(table[position].to_numpy(), dictionaries[column])
+        else:
+            records[column] = table[position].to_numpy()
+    return records
+
+
+def read_tabular_batches(input_file, columns=BLAST_COLUMNS, usecols=None, batch_size=1000000, dictionaries=None):
+    """
+    Reads a Blast or MagicBlast tabular file in batches of typed records.
+
+    Arguments:
+        input_file {filepath} -- Tabular file (plain, gzip or zstd)
+        columns {list} -- Names of all the columns in the file (see parse_column_spec)
+        usecols {list} -- Names of the columns to parse. By default all
+        batch_size {int} -- Lines per batch
+        dictionaries {dictionary} -- Column name: {ID: code} for the ID columns to dictionary encode.
+                                     Codes are consistent across batches
+
+    Returns:
+        [generator] -- Structured arrays (see parse_tabular_lines)
+    """
+    with open_tabular(input_file) as tabular:
+        for lines in read_line_batches(tabular, batch_size):
+            if lines:
+                yield parse_tabular_lines(lines, columns, usecols, dictionaries)
@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+
+"""
+########################################################################
+# Author:       Carlos A. Ruiz-Perez
+# Email:        cruizperez3@gatech.edu
+# Github:       https://github.com/cruizperez
+# Institution:  Georgia Institute of Technology
+# Version:      0.1
+# Date:         15 February 2020
+
+# Description: This module runs pipeline jobs (a command, its log and its
+# resources) on a PBS or Slurm cluster, in a local pool of workers or on a
+# fake scheduler that runs the job scripts as local background processes
+# (for testing without a cluster). Job scripts record the exit status of
+# their command in a <script>.exit file, and the scheduler is queried only
+# to find jobs that ended without writing it (killed, out of time...).
+########################################################################
+"""
+
+################################################################################
+
+"""---1.0 Import Modules---"""
+
+import os, sys, time, shlex, subprocess
+
+################################################################################
+
+"""---2.0 Define Functions---"""
+
+def make_job(name, command, log_file, workdir, threads=1, memory=5, walltime="12:00:00"):
+    """
+    Describes a job.
+
+    Arguments:
+        name {string} -- Job name
+        command {list} -- Command arguments
+        log_file {filepath} -- File receiving the standard output and error
+        workdir {dirpath} -- Folder the job runs in, also where its script is written
+        threads {int} -- CPUs requested
+        memory {int} -- Memory requested in GB
+        walltime {string} -- Time requested (HH:MM:SS)
+
+    Returns:
+        [dictionary] -- Job
+    """
+    return {"name": name, "command": command, "log": log_file, "workdir": workdir, "threads": threads,
+            "memory": memory, "walltime": walltime}
+
+
+"""---2.1 Local Pool---"""
+
+def run_local_job(job):
+    """
+    Runs a job command, writing its standard output and error to the job log.
+
+    Arguments:
+        job {dictionary} -- Job (see make_job)
+
+    Returns:
+        [tuple] -- Job name and exit status
+    """
+    with open(job["log"], "w") as log:
+        try:
+            status = subprocess.call(job["command"], stdout=log, stderr=subprocess.STDOUT, cwd=job["workdir"])
+        except OSError as error:
+            log.write(str(error) + "\n")
+            status = 127
+    return job["name"], status
+
+
+def run_local_jobs(jobs, workers):
+    """
+    Runs jobs in a local pool of workers. Each worker takes the next pending job as soon
+    as it is free, so long jobs don't leave cores idle.
+
+    Arguments:
+        jobs {list} -- Jobs (see make_job)
+        workers {int} -- Number of jobs running at the same time
+
+    Returns:
+        [generator] -- Job name and exit status, in order of completion
+    """
+    import multiprocessing
+    if workers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            yield run_local_job(job)
+        return
+    pool = multiprocessing.Pool(min(workers, len(jobs)))
+    try:
+        for result in pool.imap_unordered(run_local_job, jobs, chunksize=1):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+"""---2.2 Batch Schedulers---"""
+
+def pbs_directives(job, queue=None):
+    """
+    Returns the PBS directives requesting the job resources.
+    """
+    directives = ["#PBS -N " + job["name"], "#PBS -l nodes=1:ppn={}".format(job["threads"]),
+                  "#PBS -l mem={}gb".format(job["memory"]), "#PBS -l walltime=" + job["walltime"]]
+    if queue:
+        directives.append("#PBS -q " + queue)
+    directives += ["#PBS -j oe", "#PBS -o " + job["log"]]
+    return directives
+
+
+def pbs_submit(script):
+    """
+    Submits a script with qsub.
+
+    Returns:
+        [string] -- Job ID
+    """
+    return subprocess.check_output(["qsub", script], universal_newlines=True).strip()
+
+
+def query_failed(query, finished_message):
+    """
+    Checks if a scheduler query (qstat, squeue) failed, e.g. timed out with the scheduler
+    under load. Errors only about finished jobs, which the scheduler no longer knows,
+    are not failures. Failures are logged with the scheduler error.
+
+    Arguments:
+        query {CompletedProcess} -- Query run with its output and error captured
+        finished_message {string} -- Error printed by the scheduler for finished jobs
+
+    Returns:
+        [bool] -- True if the query failed
+    """
+    if query.returncode == 0:
+        return False
+    errors = [line for line in query.stderr.splitlines() if line.strip() and finished_message not in line]
+    if not errors and query.stderr.strip():
+        return False
+    print("{} failed (exit status {}), checking the jobs again later: {}".format(
+          query.args[0], query.returncode, " ".join(errors).strip()), file=sys.stderr)
+    return True
+
+
+def pbs_active(job_ids):
+    """
+    Finds which jobs are still queued or running with qstat. If qstat fails, all the
+    jobs are considered active.
+
+    Returns:
+        [set] -- IDs of the active jobs
+    """
+    qstat = subprocess.run(["qstat", "-f"] + list(job_ids), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                           universal_newlines=True)
+    if query_failed(qstat, "Unknown Job Id"):
+        return set(job_ids)
+    active = set()
+    job_id = None
+    for line in qstat.stdout.splitlines():
+        line = line.strip()
+        if line.startswith("Job Id:"):
+            job_id = line.split(":", 1)[1].strip()
+        elif line.startswith("job_state") and job_id is not None:
+            if line.split("=")[1].strip() not in ("C", "F"):
+                active.add(job_id)
+    # Compare the job numbers, qstat may print the IDs with a longer server suffix than qsub.
+    active = {active_id.split(".")[0] for active_id in active}
+    return {job_id for job_id in job_ids if job_id.split(".")[0] in active}
+
+
+def slurm_directives(job, queue=None):
+    """
+    Returns the Slurm directives requesting the job resources.
+    """
+    directives = ["#SBATCH --job-name=" + job["name"], "#SBATCH --nodes=1",
+                  "#SBATCH --cpus-per-task={}".format(job["threads"]), "#SBATCH --mem={}G".format(job["memory"]),
+                  "#SBATCH --time=" + job["walltime"]]
+    if queue:
+        directives.append("#SBATCH --partition=" + queue)
+    directives.append("#SBATCH --output=" + job["log"])
+    return directives
+
+
+def slurm_submit(script):
+    """
+    Submits a script with sbatch.
+
+    Returns:
+        [string] -- Job ID
+    """
+    return subprocess.check_output(["sbatch", "--parsable", script], universal_newlines=True).strip().split(";")[0]
+
+
+def slurm_active(job_ids):
+    """
+    Finds which jobs are still pending or running with squeue. If squeue fails, all the
+    jobs are considered active.
+
+    Returns:
+        [set] -- IDs of the active jobs
+    """
+    squeue = subprocess.run(["squeue", "--noheader", "--format=%i", "--jobs=" + ",".join(job_ids)],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if query_failed(squeue, "Invalid job id"):
+        return set(job_ids)
+    return set(squeue.stdout.split()) & set(job_ids)
+
+
+# Background processes started by the fake scheduler, by job ID.
+FAKE_JOBS = {}
+
+
+def fake_directives(job, queue=None):
+    """
+    The fake scheduler takes no directives.
+    """
+    return []
+
+
+def fake_submit(script):
+    """
+    Runs a script as a local background process, as a batch scheduler would.
+
+    Returns:
+        [string] -- Job ID
+    """
+    job_id = "fake.{}".format(len(FAKE_JOBS) + 1)
+    FAKE_JOBS[job_id] = subprocess.Popen(["bash", script], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return job_id
+
+
+def fake_active(job_ids):
+    """
+    Finds which background processes are still running.
+
+    Returns:
+        [set] -- IDs of the active jobs
+    """
+    return {job_id for job_id in job_ids if FAKE_JOBS[job_id].poll() is None}
+
+
+SCHEDULERS = {"pbs": {"directives": pbs_directives, "submit": pbs_submit, "active": pbs_active, "extension": ".pbs"},
+              "slurm": {"directives": slurm_directives, "submit": slurm_submit, "active": slurm_active, "extension": ".sbatch"},
+              "fake": {"directives": fake_directives, "submit": fake_submit, "active": fake_active, "extension": ".sh"}}
+
+BACKENDS = ["local"] + list(SCHEDULERS)
+
+
+def write_job_script(job, scheduler, queue=None, modules=None):
+    """
+    Writes the script of a job. The script saves the exit status of the command in <script>.exit.
+
+    Arguments:
+        job {dictionary} -- Job (see make_job)
+        scheduler {string} -- Scheduler name (see SCHEDULERS)
+        queue {string} -- Queue or partition
+        modules {list} -- Environment modules loaded before running the command
+
+    Returns:
+        [filepath] -- Job script
+    """
+    script = os.path.join(job["workdir"], job["name"] + SCHEDULERS[scheduler]["extension"])
+    with open(script, "w") as script_file:
+        script_file.write("#!/bin/bash\n")
+        script_file.write("\n".join(SCHEDULERS[scheduler]["directives"](job, queue)) + "\n\n")
+        if scheduler == "fake":
+            script_file.write("exec > " + shlex.quote(job["log"]) + " 2>&1\n")
+        script_file.write("cd " + shlex.quote(job["workdir"]) + "\n")
+        for module in modules or []:
+            script_file.write("module load " + module + "\n")
+        script_file.write("\n" + " ".join(shlex.quote(argument) for argument in job["command"]) + "\n")
+        script_file.write("echo $? > " + shlex.quote(script + ".exit") + "\n")
+    return script
+
+
+def read_exit_status(script):
+    """
+    Returns the exit status saved by a job script, or None if it is not there yet.
+    """
+    try:
+        with open(script + ".exit") as exit_file:
+            return int(exit_file.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def run_scheduler_jobs(jobs, scheduler, queue=None, modules=None, poll_interval=5):
+    """
+    Submits jobs to a batch scheduler and reports them as they end. Finished jobs are
+    detected by their exit status file; jobs the scheduler no longer lists and that never
+    wrote it (cancelled, killed for time or memory) are reported as failed.
+
+    Arguments:
+        jobs {list} -- Jobs (see make_job)
+        scheduler {string} -- Scheduler name (see SCHEDULERS)
+        queue {string} -- Queue or partition
+        modules {list} -- Environment modules loaded before running the commands
+        poll_interval {float} -- Seconds between checks
+
+    Returns:
+        [generator] -- Job name and exit status, in order of completion
+    """
+    pending = {}
+    for job in jobs:
+        script = write_job_script(job, scheduler, queue, modules)
+        try:
+            os.remove(script + ".exit")
+        except OSError:
+            pass
+        job_id = SCHEDULERS[scheduler]["submit"](script)
+        print("Submitted {} ({})".format(job["name"], job_id))
+        pending[job_id] = [job["name"], script, 0]
+    while pending:
+        active = SCHEDULERS[scheduler]["active"](list(pending))
+        for job_id in list(pending):
+            name, script, missing = pending[job_id]
+            status = read_exit_status(script)
+            if status is not None:
+                del pending[job_id]
+                yield name, status
+            elif job_id not in active:
+                # Give shared file systems a few checks to show the exit status file.
+                pending[job_id][2] += 1
+                if pending[job_id][2] >= 3:
+                    del pending[job_id]
+                    yield name, -1
+            else:
+                pending[job_id][2] = 0
+        if pending:
+            time.sleep(poll_interval)
+
+
+def run_jobs(jobs, backend="local", queue=None, modules=None, workers=1, poll_interval=5):
+    """
+    Runs jobs locally or on a scheduler.
+
+    Arguments:
+        jobs {list} -- Jobs (see make_job)
+        backend {string} -- "local" or a scheduler name (see SCHEDULERS)
+        queue {string} -- Queue or partition
+        modules {list} -- Environment modules loaded before running the commands
+        workers {int} -- Jobs running at the same time (local backend)
+        poll_interval {float} -- Seconds between checks (schedulers)
+
+    Returns:
+        [generator] -- Job name and exit status, in order of completion
+    """
+    if backend == "local":
+        return run_local_jobs(jobs, workers)
+    else:
+        return run_scheduler_jobs(jobs, backend, queue, modules, poll_interval)
+
+
+def run_step(jobs, step_name, backend="local", queue=None, modules=None, workers=1, poll_interval=5, callback=None):
+    """
+    Runs the jobs of a pipeline step and exits if any of them fails.
+
+    Arguments:
+        jobs {list} -- Jobs (see make_job)
+        step_name {string} -- Step name for messages
+        callback {function} -- Called with the job name and exit status as each job ends
+        Other arguments as in run_jobs
+    """
+    failed = []
+    for name, status in run_jobs(jobs, backend, queue, modules, workers, poll_interval):
+        if callback is not None:
+            callback(name, status)
+        if status == 0:
+            print("Finished " + name)
+        else:
+            print("Failed {} (exit status {})".format(name, status))
+            failed.append(name)
+    if failed:
+        sys.exit("{} failed: {}. Check the logs in the output folder".format(step_name, ", ".join(failed)))
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+"""
+########################################################################
+# Author:       Carlos A. Ruiz-Perez
+# Email:        cruizperez3@gatech.edu
+# Github:       https://github.com/cruizperez
+# Institution:  Georgia Institute of Technology
+# Version:      0.1
+# Date:         15 February 2020
+
+# Description: This script parses the MagicBlast tabular outputs of many
+# samples against one reference (in FastA format) and builds one
+# genomes x samples matrix per coverage metric: truncated average depth
+# (TAD), breadth (fraction of bases covered), mean depth and reads per
+# kilobase (RPK). The reference is read once and shared with the worker
+# processes, each of which computes the depth of one sample at a time.
+########################################################################
+"""
+
+################################################################################
+
+"""---1.0 Import Modules---"""
+
+import argparse, sys
+import multiprocessing
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from MagicBlast_SeqDepth import get_genome_sizes, calculate_seq_depth
+from TAD_Calculator import truncated_average_depth
+
+################################################################################
+
+"""---2.0 Define Functions---"""
+
+COVERAGE_METRICS = ["TAD", "Breadth", "Mean_Depth", "RPK"]
+
+
+def group_genome_contigs(genome_sizes, separator=None):
+    """
+    Groups the reference contigs by genome.
+
+    Arguments:
+        genome_sizes {dictionary} -- Lengths per sequence
+        separator {string} -- String separating genome name from contig, None for contigs
+
+    Returns:
+        [dictionary] -- Genome: list of contigs, in reference order
+    """
+    genome_contigs = {}
+    for contig in genome_sizes:
+        genome = contig if separator is None else contig.split(separator)[0]
+        genome_contigs.setdefault(genome, []).append(contig)
+    return genome_contigs
+
+
+def child_initialize(_genome_sizes, _genome_contigs, _tad_percent):
+    """
+    Makes the reference shared by all the samples available to the worker processes.
+    """
+    global genome_sizes, genome_contigs, tad_percent
+    genome_sizes = _genome_sizes
+    genome_contigs = _genome_contigs
+    tad_percent = _tad_percent
+
+
+def sample_coverage(magicblast_file):
+    """
+    Calculates the coverage metrics of each genome in one sample. Uses the reference
+    set by child_initialize. Genome lengths include the contigs without reads.
+
+    Arguments:
+        magicblast_file {filepath} -- File with MagicBlast tabular output
+
+    Returns:
+        [tuple] -- Input file and dictionary of metric: list of values, in genome order
+    """
+    read_counts = {}
+    contig_depth = calculate_seq_depth(magicblast_file, genome_sizes, read_counts)
+    metrics = {metric: [] for metric in COVERAGE_METRICS}
+    for contigs in genome_contigs.values():
+        genome_length = sum(genome_sizes[contig] for contig in contigs)
+        depths = [contig_depth[contig] for contig in contigs if contig in contig_depth]
+        reads = sum(read_counts.get(contig, 0) for contig in contigs)
+        if genome_length == 0:
+            for metric in COVERAGE_METRICS:
+                metrics[metric].append(0.0)
+            continue
+        total_depth = sum(int(depth.sum(dtype=np.uint64)) for depth in depths)
+        covered = sum(int(np.count_nonzero(depth)) for depth in depths)
+        metrics["TAD"].append(truncated_average_depth(depths, tad_percent, genome_length) if depths else 0.0)
+        metrics["Breadth"].append(covered / genome_length)
+        metrics["Mean_Depth"].append(total_depth / genome_length)
+        metrics["RPK"].append(reads / (genome_length / 1000))
+    return magicblast_file, metrics
+
+
+def sample_name(magicblast_file, num_ext=1):
+    """
+    Returns the sample name of a file, removing its last num_ext extensions.
+    """
+    name = Path(magicblast_file).name
+    if num_ext > 0:
+        name = ".".join(name.split(".")[:-num_ext]) or name
+    return name
+
+
+def coverage_matrices(magicblast_files, fasta_file, tad_percent=80, separator=None, num_ext=1, threads=1):
+    """
+    Builds one genomes x samples matrix per coverage metric.
+
+    Arguments:
+        magicblast_files {list} -- Files with MagicBlast tabular output, one per sample
+        fasta_file {filepath} -- Fasta file with reference sequences
+        tad_percent {int} -- TAD percentage to calculate
+        separator {string} -- String separating genome name from contig, None for contigs
+        num_ext {int} -- Extensions removed from the file names to get the sample names, which must be unique
+        threads {int} -- Samples processed at the same time
+
+    Returns:
+        [dictionary] -- Metric: DataFrame with genomes as rows and samples as columns
+    """
+    samples = [sample_name(magicblast_file, num_ext) for magicblast_file in magicblast_files]
+    if len(set(samples)) != len(samples):
+        raise ValueError("Sample names must be unique: " + ", ".join(samples))
+    reference_sizes = get_genome_sizes(fasta_file)
+    reference_genomes = group_genome_contigs(reference_sizes, separator)
+    results = {}
+    if threads <= 1 or len(magicblast_files) <= 1:
+        child_initialize(reference_sizes, reference_genomes, tad_percent)
+        for magicblast_file in magicblast_files:
+            file_name, metrics = sample_coverage(magicblast_file)
+            results[file_name] = metrics
+    else:
+        pool = multiprocessing.Pool(min(threads, len(magicblast_files)), initializer = child_initialize,
+                                    initargs = (reference_sizes, reference_genomes, tad_percent))
+        for file_name, metrics in pool.imap_unordered(sample_coverage, magicblast_files):
+            results[file_name] = metrics
+        pool.close()
+        pool.join()
+    matrices = {}
+    for metric in COVERAGE_METRICS:
+        values = np.column_stack([results[magicblast_file][metric] for magicblast_file in magicblast_files])
+        matrices[metric] = pd.DataFrame(values, index=list(reference_genomes), columns=samples)
+        matrices[metric].index.name = "Genome"
+    return matrices
+
+
+def save_coverage_matrices(matrices, output_prefix):
+    """
+    Writes each metric matrix to <output_prefix>_<metric>.tsv.
+
+    Arguments:
+        matrices {dictionary} -- Metric: DataFrame (see coverage_matrices)
+        output_prefix {string} -- Prefix of the output tables
+    """
+    for metric, matrix in matrices.items():
+        matrix.round(4).to_csv("{}_{}.tsv".format(output_prefix, metric), sep="\t")
+
+
+################################################################################
+
+"""---3.0 Main Function---"""
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+            description='''This script builds genomes x samples matrices of truncated average depth (TAD),\n'''
+                        '''breadth of coverage, mean depth and reads per kilobase (RPK)\n'''
+                        '''from the MagicBlast tabular outputs of many samples against one reference.\n'''
+                        '''Global mandatory parameters: [MagicBlast Files] [Reference FastA] [Output Prefix]\n'''
+                        '''Optional Database Parameters: See ''' + sys.argv[0] + ' -h')
+    parser.add_argument('-i', '--input_magicblast', dest='magic_blast', action='store', nargs='+', required=True,
+                        help='MagicBlast tabular files, one per sample.')
+    parser.add_argument('-f', '--fasta_sequences', dest='fasta_sequences', action='store', required=True,
+                        help='FastA file with the reference sequences.')
+    parser.add_argument('-o', '--output_prefix', dest='output_prefix', action='store', required=True,
+                        help='Output prefix, writes [prefix]_TAD.tsv, [prefix]_Breadth.tsv, [prefix]_Mean_Depth.tsv\n'
+                             'and [prefix]_RPK.tsv.')
+    parser.add_argument('--tad', dest='tad', action='store', required=False, default=80, type=int,
+                        help='TAD percentage to calculate, e.g. 80 removes the top and bottom 10 percent of positions. By default 80.')
+    parser.add_argument('--separator', dest='separator', action='store', required=False,
+                        help='''String separating genome name from contig. By default None, i.e., one row per contig.\n'''
+                             '''If separator has "-" or "--" pass it as --separator="--"''')
+    parser.add_argument('--ext', dest='num_ext', action='store', required=False, default=1, type=int,
+                        help='Number of extensions removed from the file names to get the sample names. By default 1.')
+    parser.add_argument('-t', '--threads', dest='threads', action='store', required=False, default=1, type=int,
+                        help='Samples processed in parallel. By default 1.')
+    args = parser.parse_args()
+
+    separator = args.separator
+    samples = [sample_name(magicblast_file, args.num_ext) for magicblast_file in args.magic_blast]
+    if len(set(samples)) != len(samples):
+        parser.error("sample names must be unique, found repeated names: {} (rename the files or change --ext)".format(
+            ", ".join(sorted(set(sample for sample in samples if samples.count(sample) > 1)))))
+
+    matrices = coverage_matrices(args.magic_blast, args.fasta_sequences, args.tad, separator,
+                                 args.num_ext, args.threads)
+    save_coverage_matrices(matrices, args.output_prefix)
+
+
+if __name__ == "__main__":
+    main()
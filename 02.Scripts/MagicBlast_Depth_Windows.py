@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+"""
+########################################################################
+# Author:       Carlos A. Ruiz-Perez
+# Email:        cruizperez3@gatech.edu
+# Github:       https://github.com/cruizperez
+# Institution:  Georgia Institute of Technology
+# Version:      0.1
+# Date:         15 February 2020
+
+# Description: This script summarizes the per-base sequencing depth of
+# each contig in windows (mean depth and breadth of coverage) and finds
+# the regions with low or no coverage, useful to flag contamination and
+# deletions in MAGs. The depth is computed from a MagicBlast output and
+# its reference (see MagicBlast_SeqDepth.py) or read from a depth file
+# (npz or memmap) saved by MagicBlast_SeqDepth.py. Window statistics come
+# from cumulative sums and regions from changes in a boolean mask, so
+# no per-base Python loop is involved.
+########################################################################
+"""
+
+################################################################################
+
+"""---1.0 Import Modules---"""
+
+import argparse, sys, os, zipfile
+import numpy as np
+import pandas as pd
+
+################################################################################
+
+"""---2.0 Define Functions---"""
+
+def depth_file_contigs(input_file):
+    """
+    Yields the per-base depth of each contig stored in a depth file saved by
+    MagicBlast_SeqDepth.py (npz or memmap, with its .index). Contigs without
+    reads may be missing from the file.
+    """
+    from MagicBlast_SeqDepth import open_depth_memmap
+    if os.path.exists(input_file + ".index"):
+        depth, contig_index = open_depth_memmap(input_file)
+        for contig, (offset, length, reads) in contig_index.items():
+            yield contig, depth[offset:offset+length]
+    elif zipfile.is_zipfile(input_file):
+        with np.load(input_file) as seqdepth:
+            for contig in seqdepth.files:
+                yield contig, seqdepth[contig]
+    else:
+        raise ValueError("{} is not a depth file (npz or memmap), give the reference FastA (-f) "
+                         "to read it as a MagicBlast output".format(input_file))
+
+
+def contig_depths(input_file, fasta_file=None, blocks=True, input_format="tabular"):
+    """
+    Yields the per-base depth of each contig. With fasta_file, contigs come in FastA
+    order and those without reads are included with depth 0.
+
+    Arguments:
+        input_file {filepath} -- Depth file saved by MagicBlast_SeqDepth.py (npz or memmap,
+                                 with its .index), or MagicBlast output (requires fasta_file)
+        fasta_file {filepath} -- FastA file with the reference sequences
+        blocks, input_format -- See MagicBlast_SeqDepth.read_coverage_events
+
+    Returns:
+        [generator] -- Contig name and depth array
+    """
+    from MagicBlast_SeqDepth import get_genome_sizes, calculate_seq_depth
+    if fasta_file is None:
+        yield from depth_file_contigs(input_file)
+        return
+    genome_sizes = get_genome_sizes(fasta_file)
+    if os.path.exists(input_file + ".index") or zipfile.is_zipfile(input_file):
+        genome_seq_depth = dict(depth_file_contigs(input_file))
+        missing = [contig for contig in genome_seq_depth if contig not in genome_sizes]
+        if missing:
+            raise KeyError("Sequences not found in the reference FastA: " + ", ".join(missing[:5]))
+    else:
+        genome_seq_depth = calculate_seq_depth(input_file, genome_sizes, None, blocks, input_format)
+    for contig, length in genome_sizes.items():
+        yield contig, genome_seq_depth.pop(contig, np.zeros(length, dtype=np.uint32))
+
+
+def window_bounds(length, window_size, step=None):
+    """
+    Lays out windows along a contig. The last windows are cut at the end of the
+    contig, and those ending where the previous one ends are skipped.
+
+    Arguments:
+        length {int} -- Contig length
+        window_size {int} -- Window length
+        step {int} -- Distance between window starts. By default window_size
+
+    Returns:
+        [tuple] -- Window starts (0-based) and ends (excluded)
+    """
+    if step is None:
+        step = window_size
+    starts = np.arange(0, length, step, dtype=np.int64)
+    ends = np.minimum(starts + window_size, length)
+    keep = np.concatenate(([True], ends[1:] != ends[:-1]))
+    return starts[keep], ends[keep]
+
+
+def window_statistics(depth, window_size, step=None):
+    """
+    Calculates the mean depth and breadth of coverage of each window of a contig
+    from the cumulative sums of the depth and of the covered bases.
+
+    Arguments:
+        depth {array} -- Per-base depth
+        window_size {int} -- Window length
+        step {int} -- Distance between window starts. By default window_size
+
+    Returns:
+        [tuple] -- Window starts, ends, mean depth and breadth (fraction of bases covered)
+    """
+    starts, ends = window_bounds(len(depth), window_size, step)
+    depth_sum = np.concatenate(([0], np.cumsum(depth, dtype=np.int64)))
+    covered_sum = np.concatenate(([0], np.cumsum(depth > 0, dtype=np.int64)))
+    lengths = ends - starts
+    mean_depth = (depth_sum[ends] - depth_sum[starts]) / lengths
+    breadth = (covered_sum[ends] - covered_sum[starts]) / lengths
+    return starts, ends, mean_depth, breadth
+
+
+def low_coverage_regions(depth, min_depth=1, min_length=1):
+    """
+    Finds the runs of bases with depth below min_depth.
+
+    Arguments:
+        depth {array} -- Per-base depth
+        min_depth {int} -- Bases with lower depth are low coverage (1 finds uncovered regions)
+        min_length {int} -- Shortest region reported
+
+    Returns:
+        [tuple] -- Region starts (0-based), ends (excluded) and mean depth
+    """
+    low = np.concatenate(([0], (depth < min_depth).view(np.int8), [0]))
+    changes = np.diff(low)
+    starts = np.flatnonzero(changes == 1)
+    ends = np.flatnonzero(changes == -1)
+    keep = (ends - starts) >= min_length
+    starts, ends = starts[keep], ends[keep]
+    if len(starts) == 0:
+        return starts, ends, np.zeros(0)
+    depth_sum = np.concatenate(([0], np.cumsum(depth, dtype=np.int64)))
+    return starts, ends, (depth_sum[ends] - depth_sum[starts]) / (ends - starts)
+
+
+def depth_windows(input_file, output_prefix, window_size=1000, step=None, min_depth=1, min_length=100,
+                  fasta_file=None, blocks=True, input_format="tabular"):
+    """
+    Writes the window statistics and low coverage regions of every contig:
+        [prefix]_windows.tsv -- Sequence  Start  End  Mean_Depth  Breadth
+        [prefix]_low_coverage.bed -- Sequence  Start  End  Mean_Depth
+    Coordinates are BED-style (0-based start, end excluded).
+
+    Arguments:
+        input_file {filepath} -- MagicBlast output or depth file (see contig_depths)
+        output_prefix {string} -- Prefix of the output files
+        window_size {int} -- Window length
+        step {int} -- Distance between window starts. By default window_size
+        min_depth {int} -- Bases with lower depth are low coverage
+        min_length {int} -- Shortest low coverage region reported
+        fasta_file {filepath} -- FastA file with the reference sequences (see contig_depths)
+        blocks, input_format -- See MagicBlast_SeqDepth.read_coverage_events
+    """
+    with open(output_prefix + "_windows.tsv", 'w') as windows_output, \
+         open(output_prefix + "_low_coverage.bed", 'w') as regions_output:
+        windows_output.write("Sequence\tStart\tEnd\tMean_Depth\tBreadth\n")
+        for contig, depth in contig_depths(input_file, fasta_file, blocks, input_format):
+            if len(depth) == 0:
+                continue
+            starts, ends, mean_depth, breadth = window_statistics(depth, window_size, step)
+            pd.DataFrame({"Sequence": contig, "Start": starts, "End": ends, "Mean_Depth": mean_depth.round(3),
+                          "Breadth": breadth.round(4)}).to_csv(windows_output, sep="\t", header=False, index=False)
+            starts, ends, mean_depth = low_coverage_regions(depth, min_depth, min_length)
+            if len(starts) > 0:
+                pd.DataFrame({"Sequence": contig, "Start": starts, "End": ends,
+                              "Mean_Depth": mean_depth.round(3)}).to_csv(regions_output, sep="\t", header=False, index=False)
+
+
+################################################################################
+
+"""---3.0 Main Function---"""
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+            description='''This script calculates the mean depth and breadth of coverage in windows along each\n'''
+                        '''contig and reports the regions with low or no coverage, as BED-style tables.\n'''
+                        '''The input is a MagicBlast output (with -f) or a depth file (npz or memmap)\n'''
+                        '''saved by MagicBlast_SeqDepth.py. Give -f with a depth file to report every contig.\n'''
+                        '''Global mandatory parameters: -i [Input File] -o [Output Prefix]\n'''
+                        '''Optional Database Parameters: See ''' + sys.argv[0] + ' -h')
+    parser.add_argument('-i', '--input', dest='input_file', action='store', required=True,
+                        help='MagicBlast tabular output (requires -f) or depth file from MagicBlast_SeqDepth.py\n'
+                             '(--format npz or --memmap).')
+    parser.add_argument('-f', '--fasta_sequences', dest='fasta_sequences', action='store', required=False,
+                        help='FastA file with the reference sequences. Required for MagicBlast outputs. With a depth\n'
+                             'file, contigs are reported in FastA order and those without reads get depth 0.')
+    parser.add_argument('-o', '--output_prefix', dest='output_prefix', action='store', required=True,
+                        help='Output prefix, writes [prefix]_windows.tsv and [prefix]_low_coverage.bed.')
+    parser.add_argument('-w', '--window', dest='window_size', action='store', required=False, default=1000, type=int,
+                        help='Window length. By default 1000.')
+    parser.add_argument('--step', dest='step', action='store', required=False, type=int,
+                        help='Distance between window starts, smaller than the window for sliding windows.\n'
+                             'By default the window length.')
+    parser.add_argument('--min_depth', dest='min_depth', action='store', required=False, default=1, type=int,
+                        help='Bases with lower depth are low coverage. By default 1, i.e., uncovered regions.')
+    parser.add_argument('--min_length', dest='min_length', action='store', required=False, default=100, type=int,
+                        help='Shortest low coverage region reported. By default 100.')
+    parser.add_argument('--sam', dest='sam_input', action='store_true', required=False,
+                        help='MagicBlast input is a SAM file.')
+    parser.add_argument('--full_span', dest='full_span', action='store_true', required=False,
+                        help='Count the whole span of each MagicBlast hit as covered (see MagicBlast_SeqDepth.py).')
+    args = parser.parse_args()
+
+    depth_windows(args.input_file, args.output_prefix, args.window_size, args.step, args.min_depth, args.min_length,
+                  args.fasta_sequences, not args.full_span, "sam" if args.sam_input else "tabular")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+"""
+########################################################################
+# Author:       Carlos A. Ruiz-Perez
+# Email:        cruizperez3@gatech.edu
+# Github:       https://github.com/cruizperez
+# Institution:  Georgia Institute of Technology
+# Version:      0.1
+# Date:         15 February 2020
+
+# Description: This script parses a MagicBlast tabular output and the
+# reference sequences (in FastA format) and builds the recruitment plot
+# of each genome as a 2D histogram of reads per reference position bin and
+# percent identity bin. The output is read once, in batches, and only the
+# histograms are kept in memory (genome length / bin size x identity bins
+# counts per genome). Histograms are saved in a NumPy archive (.npz) with
+# one array per genome, ready to be plotted.
+########################################################################
+"""
+
+################################################################################
+
+"""---1.0 Import Modules---"""
+
+import argparse, sys
+import numpy as np
+from MagicBlast_SeqDepth import get_genome_sizes
+from Blast_Tabular_Reader import MAGICBLAST_COLUMNS, read_tabular_batches
+from Blast_Filter_Expression import compile_vectorized_filter
+
+################################################################################
+
+"""---2.0 Define Functions---"""
+
+def genome_layout(genome_sizes, separator=None):
+    """
+    Places the contigs of each genome one after the other, in the order of the FastA.
+
+    Arguments:
+        genome_sizes {dictionary} -- Lengths per sequence
+        separator {string} -- String separating genome name from contig, None for contigs
+
+    Returns:
+        [tuple] -- Contig: (genome, offset in the genome) and genome: length
+    """
+    contig_layout = {}
+    genome_lengths = {}
+    for contig, length in genome_sizes.items():
+        genome = contig if separator is None else contig.split(separator)[0]
+        contig_layout[contig] = (genome, genome_lengths.get(genome, 0))
+        genome_lengths[genome] = genome_lengths.get(genome, 0) + length
+    return contig_layout, genome_lengths
+
+
+def identity_bin_edges(identity_min=70, identity_step=0.5):
+    """
+    Returns the percent identity bin edges, from identity_min to 100. The last bin includes 100.
+    """
+    return np.linspace(identity_min, 100, int(round((100 - identity_min) / identity_step)) + 1)
+
+
+def recruitment_histograms(magicblast_file, genome_sizes, separator=None, bin_size=1000, identity_edges=None,
+                           filter_expression=None, batch_size=1000000):
+    """
+    Counts the hits of a MagicBlast output per genome position bin and identity bin.
+    All genomes share one flat array of position bins, and each batch of hits is
+    binned with a single np.add.at.
+
+    Arguments:
+        magicblast_file {filepath} -- File with MagicBlast tabular output
+        genome_sizes {dictionary} -- Lengths per sequence
+        separator {string} -- String separating genome name from contig, None for contigs
+        bin_size {int} -- Reference bases per position bin
+        identity_edges {array} -- Identity bin edges (see identity_bin_edges)
+        filter_expression {string} -- Only hits passing this filter are counted (see Blast_Filter_Expression)
+        batch_size {int} -- Lines read at a time
+
+    Returns:
+        [dictionary] -- Genome: histogram (uint32, position bins x identity bins). The hit
+                        position is its midpoint on the genome, with contigs concatenated
+    """
+    if identity_edges is None:
+        identity_edges = identity_bin_edges()
+    contig_layout, genome_lengths = genome_layout(genome_sizes, separator)
+    genome_bins = {genome: max(1, -(-length // bin_size)) for genome, length in genome_lengths.items()}
+    genome_first_bin = {}
+    total_bins = 0
+    for genome, bins in genome_bins.items():
+        genome_first_bin[genome] = total_bins
+        total_bins += bins
+    identity_bins = len(identity_edges) - 1
+    histogram = np.zeros((total_bins, identity_bins), dtype=np.uint32)
+
+    # Contigs are coded in FastA order so codes index the layout arrays.
+    contig_codes = {contig: code for code, contig in enumerate(genome_sizes)}
+    contig_first_bin = np.array([genome_first_bin[contig_layout[contig][0]] for contig in genome_sizes], dtype=np.int64)
+    contig_offset = np.array([contig_layout[contig][1] for contig in genome_sizes], dtype=np.int64)
+    contig_last_bin = np.array([genome_first_bin[contig_layout[contig][0]] + genome_bins[contig_layout[contig][0]] - 1
+                                for contig in genome_sizes], dtype=np.int64)
+
+    hit_filter = None
+    usecols = ["sseqid", "pident", "sstart", "send"]
+    if filter_expression is not None:
+        hit_filter = compile_vectorized_filter(filter_expression, MAGICBLAST_COLUMNS)
+        usecols += [column for column in hit_filter.columns if column not in usecols]
+    for hits in read_tabular_batches(magicblast_file, MAGICBLAST_COLUMNS, usecols, batch_size,
+                                     dictionaries={"sseqid": contig_codes}):
+        if len(contig_codes) > len(contig_offset):
+            missing = list(contig_codes)[len(contig_offset):]
+            raise KeyError("Sequences not found in the reference FastA: " + ", ".join(missing[:5]))
+        if hit_filter is not None:
+            hits = hits[hit_filter(hits)]
+        contigs = hits["sseqid"]
+        midpoints = (hits["sstart"] + hits["send"]) // 2 - 1 + contig_offset[contigs]
+        position_bins = np.minimum(contig_first_bin[contigs] + midpoints // bin_size, contig_last_bin[contigs])
+        identity_bins_hit = np.searchsorted(identity_edges, hits["pident"], side="right") - 1
+        identity_bins_hit[hits["pident"] == identity_edges[-1]] = identity_bins - 1
+        counted = (identity_bins_hit >= 0) & (identity_bins_hit < identity_bins)
+        np.add.at(histogram, (position_bins[counted], identity_bins_hit[counted]), 1)
+
+    return {genome: histogram[genome_first_bin[genome]:genome_first_bin[genome] + bins]
+            for genome, bins in genome_bins.items()}
+
+
+def save_recruitment_histograms(histograms, output_npz, bin_size, identity_edges):
+    """
+    Saves the recruitment histograms as a NumPy archive with one array per genome,
+    plus the position bin size (__bin_size__) and identity bin edges (__identity_edges__).
+    """
+    arrays = dict(histograms)
+    arrays["__bin_size__"] = np.array(bin_size)
+    arrays["__identity_edges__"] = identity_edges
+    np.savez_compressed(output_npz, **arrays)
+
+
+def load_recruitment_histograms(input_npz):
+    """
+    Loads the recruitment histograms saved by save_recruitment_histograms.
+
+    Returns:
+        [tuple] -- Genome: histogram, position bin size and identity bin edges
+    """
+    with np.load(input_npz) as archive:
+        histograms = {name: archive[name] for name in archive.files if not name.startswith("__")}
+        return histograms, int(archive["__bin_size__"]), archive["__identity_edges__"]
+
+
+################################################################################
+
+"""---3.0 Main Function---"""
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+            description='''This script builds per-genome recruitment plot histograms (reference position bins x\n'''
+                        '''percent identity bins) from a MagicBlast tabular output and saves them as a NumPy archive.\n'''
+                        '''Global mandatory parameters: -i [MagicBlast File] -f [Reference FastA] -o [Output npz]\n'''
+                        '''Optional Database Parameters: See ''' + sys.argv[0] + ' -h')
+    parser.add_argument('-i', '--input_magicblast', dest='magic_blast', action='store', required=True,
+                        help='MagicBlast tabular output (plain, gzip or zstd).')
+    parser.add_argument('-f', '--fasta_sequences', dest='fasta_sequences', action='store', required=True,
+                        help='FastA file with the reference sequences.')
+    parser.add_argument('-o', '--output', dest='output_npz', action='store', required=True,
+                        help='Output NumPy archive (.npz) with one histogram per genome.')
+    parser.add_argument('-b', '--bin_size', dest='bin_size', action='store', required=False, default=1000, type=int,
+                        help='Reference bases per position bin. By default 1000.')
+    parser.add_argument('--identity_min', dest='identity_min', action='store', required=False, default=70, type=float,
+                        help='Lowest identity plotted, hits below it are not counted. By default 70.')
+    parser.add_argument('--identity_step', dest='identity_step', action='store', required=False, default=0.5, type=float,
+                        help='Width of the identity bins. By default 0.5.')
+    parser.add_argument('--filter', dest='filter_expression', action='store', required=False,
+                        help='Only count hits passing this filter, e.g. "(qend - qstart) * 100 / qlen >= 80".\n'
+                             'Columns: ' + ' '.join(MAGICBLAST_COLUMNS))
+    parser.add_argument('--separator', dest='separator', action='store', required=False,
+                        help='''String separating genome name from contig. By default None, i.e., one plot per contig.\n'''
+                             '''If separator has "-" or "--" pass it as --separator="--"''')
+    args = parser.parse_args()
+
+    separator = args.separator
+
+    genome_sizes = get_genome_sizes(args.fasta_sequences)
+    identity_edges = identity_bin_edges(args.identity_min, args.identity_step)
+    histograms = recruitment_histograms(args.magic_blast, genome_sizes, separator, args.bin_size, identity_edges,
+                                        args.filter_expression)
+    save_recruitment_histograms(histograms, args.output_npz, args.bin_size, identity_edges)
+
+
+if __name__ == "__main__":
+    main()
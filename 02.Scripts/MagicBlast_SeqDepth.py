@@ -10,7 +10,14 @@
 
 # Description: This script parses a MagicBlast tabular output and
 # the reference sequences (in FastA format) and returns the base by base
-# sequencing depth of each reference contig/genome. 
+# sequencing depth of each reference contig/genome, as a table, a
+# run-length encoded bedGraph or a binary NumPy archive (.npz). For large
+# references the depth can be computed in a memory-mapped file holding all
+# the contigs (see calculate_seq_depth_memmap), reusable by other tools.
+# With --stats_output the depth goes straight to per contig and per genome
+# TAD, breadth, mean and median depth, and the per-base output is optional.
+# Only the aligned blocks of each read are counted: deletions and introns
+# are read from the BTOP string (or the CIGAR of SAM input) and excluded.
 ########################################################################
 """
 
@@ -20,14 +27,17 @@
 import numpy as np
 import pandas as pd
 from Bio.SeqIO.FastaIO import SimpleFastaParser
-import argparse, sys
+from Blast_Tabular_Reader import MAGICBLAST_COLUMNS, read_tabular_batches, open_tabular, read_line_batches, encode_ids
+from TAD_Calculator import add_depth_histogram, write_depth_statistics
+import argparse, sys, zipfile
 
 ################################################################################
 
 """---2.0 Define Functions---"""
 def get_genome_sizes(fasta_file):
     """
-    Calculates the length of each sequence within a FastA file
+    Calculates the length of each sequence within a FastA file. Sequences are named by
+    the first word of their header, as in the MagicBlast subject IDs.
     
     Arguments:
         fasta_file {filepath} -- Fasta file with reference sequences
@@ -38,99 +48,543 @@ def get_genome_sizes(fasta_file):
     genome_sizes = {}
     with open(fasta_file) as fasta_input:
         for title, seq in SimpleFastaParser(fasta_input):
-            genome_sizes[title] = len(seq)
+            genome_sizes[title.split()[0]] = len(seq)
     return genome_sizes
 
 
-def calculate_seq_depth(magicblast_file, genome_sizes):
+### --------------------------- Alignment Blocks ---------------------------
+# Operations consuming reference bases, and those covering them, per CIGAR character.
+CIGAR_REFERENCE = np.zeros(256, dtype=bool)
+CIGAR_REFERENCE[[ord(operation) for operation in "MDN=X"]] = True
+CIGAR_COVERED = np.zeros(256, dtype=bool)
+CIGAR_COVERED[[ord(operation) for operation in "M=X"]] = True
+
+
+def join_alignment_strings(alignment_strings):
+    """
+    Joins the BTOP or CIGAR strings of a batch into one character array, with a
+    new line after each string.
+
+    Returns:
+        [tuple] -- Characters (uint8) and alignment number per character
+    """
+    characters = np.frombuffer(("\n".join(alignment_strings) + "\n").encode(), dtype=np.uint8)
+    alignment_numbers = np.cumsum(characters == ord("\n")) - (characters == ord("\n"))
+    return characters, alignment_numbers
+
+
+def digit_runs(characters):
+    """
+    Finds the numbers written in a character array.
+
+    Arguments:
+        characters {array} -- Characters (uint8)
+
+    Returns:
+        [tuple] -- Index of the first and last digit and value of each number
+    """
+    is_digit = (characters >= ord("0")) & (characters <= ord("9"))
+    padded = np.concatenate(([False], is_digit, [False]))
+    run_starts = np.flatnonzero(is_digit & ~padded[:-2])
+    run_ends = np.flatnonzero(is_digit & ~padded[2:])
+    if len(run_starts) == 0:
+        return run_starts, run_ends, np.zeros(0, dtype=np.int64)
+    digit_index = np.flatnonzero(is_digit)
+    digit_run = np.cumsum(is_digit & ~padded[:-2])[digit_index] - 1
+    place_values = np.power(10, run_ends[digit_run] - digit_index, dtype=np.int64)
+    digit_values = (characters[digit_index].astype(np.int64) - ord("0")) * place_values
+    values = np.add.reduceat(digit_values, np.searchsorted(digit_index, run_starts))
+    return run_starts, run_ends, values
+
+
+def btop_tokens(btop_strings):
+    """
+    Splits BTOP strings into alignment operations. Numbers are matches, "^N^" are
+    introns of N bases and each pair of characters (query, subject) is a mismatch,
+    a deletion from the read ("-" in the query) or an insertion ("-" in the subject).
+
+    Arguments:
+        btop_strings {iterable} -- BTOP string per alignment
+
+    Returns:
+        [tuple] -- Alignment number, reference bases consumed and covered flag per operation,
+                   in alignment order
+    """
+    characters, alignment_numbers = join_alignment_strings(btop_strings)
+    run_starts, run_ends, values = digit_runs(characters)
+    is_intron = np.cumsum(characters == ord("^"))[run_starts] % 2 == 1
+    is_pair = ~((characters >= ord("0")) & (characters <= ord("9"))) & (characters != ord("^")) & (characters != ord("\n"))
+    pair_characters = np.flatnonzero(is_pair)
+    if len(pair_characters) % 2 != 0:
+        raise ValueError("Could not parse the BTOP strings, unpaired mismatch characters")
+    query_characters = pair_characters[0::2]
+    subject_characters = pair_characters[1::2]
+    query_gap = characters[query_characters] == ord("-")
+    subject_gap = characters[subject_characters] == ord("-")
+    positions = np.concatenate((run_starts, query_characters))
+    order = np.argsort(positions, kind="stable")
+    reference = np.concatenate((values, (~subject_gap).astype(np.int64)))[order]
+    covered = np.concatenate((~is_intron, ~query_gap & ~subject_gap))[order]
+    return alignment_numbers[positions[order]], reference, covered
+
+
+def cigar_tokens(cigar_strings):
+    """
+    Splits CIGAR strings into alignment operations.
+
+    Arguments:
+        cigar_strings {iterable} -- CIGAR string per alignment
+
+    Returns:
+        [tuple] -- Alignment number, reference bases consumed and covered flag per operation,
+                   in alignment order
+    """
+    characters, alignment_numbers = join_alignment_strings(cigar_strings)
+    run_starts, run_ends, values = digit_runs(characters)
+    operations = characters[run_ends + 1]
+    reference = np.where(CIGAR_REFERENCE[operations], values, 0)
+    return alignment_numbers[run_starts], reference, CIGAR_COVERED[operations]
+
+
+def alignment_blocks(token_alignments, token_reference, token_covered):
+    """
+    Merges the operations of each alignment into the blocks of reference bases it covers.
+
+    Arguments:
+        token_alignments {array} -- Alignment number per operation, in alignment order
+        token_reference {array} -- Reference bases consumed per operation
+        token_covered {array} -- True if the operation covers the bases it consumes
+
+    Returns:
+        [tuple] -- Alignment number, start and end (excluded) of each block, as
+                   offsets from the first reference base of the alignment
+    """
+    token_ends = np.cumsum(token_reference)
+    token_starts = token_ends - token_reference
+    first_tokens = np.searchsorted(token_alignments, token_alignments, side="left")
+    alignment_start = token_starts[first_tokens]
+    # Operations without reference bases (insertions) don't split blocks.
+    consuming = token_reference > 0
+    token_alignments = token_alignments[consuming]
+    token_covered = token_covered[consuming]
+    token_starts = (token_starts - alignment_start)[consuming]
+    token_ends = (token_ends - alignment_start)[consuming]
+    if len(token_alignments) == 0:
+        return token_alignments, token_starts, token_ends
+    same_as_previous = np.concatenate(([False], (token_alignments[1:] == token_alignments[:-1]) & token_covered[:-1]))
+    same_as_next = np.concatenate(((token_alignments[:-1] == token_alignments[1:]) & token_covered[1:], [False]))
+    block_starts = token_covered & ~same_as_previous
+    block_ends = token_covered & ~same_as_next
+    return token_alignments[block_starts], token_starts[block_starts], token_ends[block_ends]
+
+
+### --------------------------- Coverage Events ---------------------------
+def read_sam_batches(sam_file, contig_codes, batch_size=1000000):
+    """
+    Reads the mapped records of a SAM file in batches.
+
+    Arguments:
+        sam_file {filepath} -- SAM file (plain, gzip or zstd)
+        contig_codes {dictionary} -- Contig name: code, filled while reading
+
+    Returns:
+        [generator] -- Arrays of contig codes, positions (1-based) and CIGAR strings per batch
+    """
+    with open_tabular(sam_file) as sam:
+        for lines in read_line_batches(sam, batch_size):
+            records = [line.split("\t", 6) for line in lines if not line.startswith("@")]
+            records = [record for record in records if not int(record[1]) & 4 and record[5] != "*"]
+            if records:
+                yield (encode_ids(np.array([record[2] for record in records], dtype=object), contig_codes),
+                       np.array([record[3] for record in records], dtype=np.int64),
+                       [record[5] for record in records])
+
+
+def read_coverage_events(magicblast_file, contig_codes, blocks=True, input_format="tabular"):
+    """
+    Reads the hits of a MagicBlast tabular output (or SAM) in batches of coverage events.
+
+    Arguments:
+        magicblast_file {filepath} -- File with MagicBlast tabular output.
+        contig_codes {dictionary} -- Contig name: code, filled while reading
+        blocks {bool} -- Cover only the aligned blocks of each read (from the BTOP string),
+                         instead of the whole span between sstart and send. SAM input
+                         is always read by blocks (from the CIGAR string)
+        input_format {string} -- tabular or sam
+
+    Returns:
+        [generator] -- Arrays of contig codes, first covered positions (0-based) and
+                       positions after the last covered one per coverage event, and
+                       contig codes per read, per batch
+    """
+    if input_format == "sam":
+        for read_contigs, positions, cigar_strings in read_sam_batches(magicblast_file, contig_codes):
+            block_alignments, block_starts, block_ends = alignment_blocks(*cigar_tokens(cigar_strings))
+            alignment_starts = positions[block_alignments] - 1
+            yield (read_contigs[block_alignments], alignment_starts + block_starts, alignment_starts + block_ends,
+                   read_contigs)
+        return
+    usecols = ["sseqid", "sstart", "send", "btop"] if blocks else ["sseqid", "sstart", "send"]
+    for hits in read_tabular_batches(magicblast_file, MAGICBLAST_COLUMNS, usecols,
+                                     dictionaries={"sseqid": contig_codes}):
+        if not blocks:
+            seq_starts = np.minimum(hits["sstart"], hits["send"]) - 1
+            seq_ends = np.maximum(hits["sstart"], hits["send"])
+            yield hits["sseqid"], seq_starts, seq_ends, hits["sseqid"]
+            continue
+        block_alignments, block_starts, block_ends = alignment_blocks(*btop_tokens(hits["btop"]))
+        sstart = hits["sstart"][block_alignments]
+        # Minus strand alignments walk the reference from sstart down to send.
+        minus = sstart > hits["send"][block_alignments]
+        seq_starts = np.where(minus, sstart - block_ends, sstart - 1 + block_starts)
+        seq_ends = np.where(minus, sstart - block_starts, sstart - 1 + block_ends)
+        yield hits["sseqid"][block_alignments], seq_starts, seq_ends, hits["sseqid"]
+
+
+def contig_runs(contig_codes):
+    """
+    Finds the runs of consecutive equal contig codes.
+
+    Arguments:
+        contig_codes {array} -- Contig codes
+
+    Returns:
+        [list] -- (contig code, first index, index after the last) per run
+    """
+    boundaries = np.flatnonzero(contig_codes[1:] != contig_codes[:-1]) + 1
+    run_starts = np.concatenate(([0], boundaries))
+    run_ends = np.concatenate((boundaries, [len(contig_codes)]))
+    return [(contig_codes[start], start, end) for start, end in zip(run_starts, run_ends)]
+
+
+def new_difference_array(genome_size):
+    """
+    Creates the difference array of a contig: the depth change at each position, plus
+    one position after the end of the contig.
+    """
+    return np.zeros(genome_size + 1, dtype=np.int32)
+
+
+def add_coverage_events(difference, seq_starts, seq_ends):
+    """
+    Adds reads to a contig difference array: +1 where each read starts and -1 after it ends.
+
+    Arguments:
+        difference {array} -- Contig difference array (see new_difference_array)
+        seq_starts {array} -- First covered positions (0-based)
+        seq_ends {array} -- Positions after the last covered one
+    """
+    np.add.at(difference, np.clip(seq_starts, 0, len(difference) - 1), 1)
+    np.add.at(difference, np.clip(seq_ends, 0, len(difference) - 1), -1)
+
+
+def difference_to_depth(difference):
+    """
+    Converts a difference array into the per-base sequencing depth, in place.
+
+    Arguments:
+        difference {array} -- Contig difference array (see new_difference_array)
+
+    Returns:
+        [array] -- Sequencing depth per base (uint32), sharing memory with difference
+    """
+    depth = difference[:-1]
+    np.cumsum(depth, out=depth)
+    return depth.view(np.uint32)
+
+
+def calculate_seq_depth(magicblast_file, genome_sizes, read_counts=None, blocks=True, input_format="tabular"):
     """
     Calculates the base-by-base sequencing depth.
     
     Arguments:
         magicblast_file {filepath} -- File with MagicBlast tabular output.
         genome_sizes {dictionary} -- Lengths per sequence
+        read_counts {dictionary} -- If given, filled with the number of reads per sequence
+        blocks, input_format -- See read_coverage_events
     
     Returns:
         [dictionary] -- Sequencing depth per DNA fragment
     """
     genome_seq_depth = {}
-    
-    with open(magicblast_file) as magicblast:
-        for line in magicblast:
-            if line.startswith("#"):
-                continue
-            else:
-                line = line.strip().split()
-                sequence = line[1]
-                seq_start = min(int(line[8]), int(line[9]))
-                seq_end = max(int(line[8]), int(line[9]))
-                if line[1] not in genome_seq_depth:
-                    genome_seq_depth[sequence] = np.zeros(genome_sizes[sequence])
-                    genome_seq_depth[sequence][seq_start-1:seq_end-1] += 1
-                else:
-                    genome_seq_depth[sequence][seq_start-1:seq_end-1] += 1
-    
+    contig_codes = {}
+    code_reads = np.zeros(0, dtype=np.int64)
+
+    for hit_contigs, seq_starts, seq_ends, read_contigs in read_coverage_events(magicblast_file, contig_codes,
+                                                                                blocks, input_format):
+        contig_names = list(contig_codes)
+        batch_reads = np.bincount(read_contigs, minlength=len(contig_names))
+        batch_reads[:len(code_reads)] += code_reads
+        code_reads = batch_reads
+        order = np.argsort(hit_contigs, kind="stable")
+        hit_contigs, seq_starts, seq_ends = hit_contigs[order], seq_starts[order], seq_ends[order]
+        for contig_code, start, end in contig_runs(hit_contigs):
+            sequence = contig_names[contig_code]
+            if sequence not in genome_seq_depth:
+                if sequence not in genome_sizes:
+                    raise KeyError("Sequences not found in the reference FastA: " + sequence)
+                genome_seq_depth[sequence] = new_difference_array(genome_sizes[sequence])
+            add_coverage_events(genome_seq_depth[sequence], seq_starts[start:end], seq_ends[start:end])
+
+    for sequence, difference in genome_seq_depth.items():
+        genome_seq_depth[sequence] = difference_to_depth(difference)
+    if read_counts is not None:
+        read_counts.update(zip(contig_codes, code_reads.tolist()))
     return  genome_seq_depth
 
-def calculate_seq_depth_sorted(magicblast_file, genome_sizes, output_table):
+def calculate_seq_depth_sorted(magicblast_file, genome_sizes, output_table, output_format="table",
+                               contig_histograms=None, read_counts=None, blocks=True, input_format="tabular"):
     """
     Calculates the base-by-base sequencing depth from a sorted file for lower memory consumption.
     
     Arguments:
         magicblast_file {filepath} -- File with MagicBlast tabular output.
         genome_sizes {dictionary} -- Lengths per sequence
-        output_table {filepath} -- Output table file
+        output_table {filepath} -- Output table file, None to skip the per-base output
+        output_format {string} -- table, bedgraph or npz (see open_depth_output)
+        contig_histograms {dictionary} -- If given, filled with the depth histogram per sequence
+        read_counts {dictionary} -- If given, filled with the number of reads per sequence
+        blocks, input_format -- See read_coverage_events
     """
     current_contig = None
     current_bases = None
+    contig_codes = {}
 
-    with open(output_table, 'w') as output, open(magicblast_file, 'r') as magicblast:
-        output.write("Sequence\tPosition\tDepth\n")
-        for line in magicblast:
-            if line.startswith("#"):
-                continue
-            else:
-                line = line.strip().split()
-                sequence = line[1]
-                seq_start = min(int(line[8]), int(line[9]))
-                seq_end = max(int(line[8]), int(line[9]))
-                if current_contig == None:
-                    current_contig = sequence
-                    current_bases = np.zeros(genome_sizes[sequence])
-                    current_bases[seq_start-1:seq_end-1] += 1
-                elif current_contig == sequence:
-                    current_bases[seq_start-1:seq_end-1] += 1
-                elif current_contig != sequence:
-                    for base, coverage in np.ndenumerate(current_bases):
-                        output.write("{}\t{}\t{}\n".format(current_contig, str(base[0]+1), str(coverage)))
+    output = open_depth_output(output_table, output_format) if output_table is not None else None
+    try:
+        for hit_contigs, seq_starts, seq_ends, read_contigs in read_coverage_events(magicblast_file, contig_codes,
+                                                                                    blocks, input_format):
+            contig_names = list(contig_codes)
+            if read_counts is not None:
+                for contig_code, reads in enumerate(np.bincount(read_contigs)):
+                    if reads > 0:
+                        read_counts[contig_names[contig_code]] = read_counts.get(contig_names[contig_code], 0) + int(reads)
+            for contig_code, start, end in contig_runs(hit_contigs):
+                sequence = contig_names[contig_code]
+                if current_contig != sequence:
+                    if current_contig is not None:
+                        store_contig_depth(output, output_format, current_contig, difference_to_depth(current_bases),
+                                           contig_histograms)
+                    if sequence not in genome_sizes:
+                        raise KeyError("Sequences not found in the reference FastA: " + sequence)
                     current_contig = sequence
-                    current_bases = np.zeros(genome_sizes[sequence])
-                    current_bases[seq_start-1:seq_end-1] += 1
+                    current_bases = new_difference_array(genome_sizes[sequence])
+                add_coverage_events(current_bases, seq_starts[start:end], seq_ends[start:end])
+        if current_contig is not None:
+            store_contig_depth(output, output_format, current_contig, difference_to_depth(current_bases),
+                               contig_histograms)
+    finally:
+        if output is not None:
+            output.close()
+
+def store_contig_depth(output, output_format, sequence, depth, contig_histograms=None):
+    """
+    Writes the depth of a finished sequence (if there is an output) and adds its
+    depth histogram to contig_histograms (if given).
+    """
+    if output is not None:
+        write_contig_depth(output, output_format, sequence, depth)
+    if contig_histograms is not None:
+        contig_histograms[sequence] = add_depth_histogram(None, depth)
+
+def build_contig_index(genome_sizes):
+    """
+    Lays out the contigs one after the other in a flat array, in the order of the FastA.
+
+    Arguments:
+        genome_sizes {dictionary} -- Lengths per sequence
+
+    Returns:
+        [dictionary] -- Sequence: [offset, length, reads]
+    """
+    contig_index = {}
+    offset = 0
+    for sequence, length in genome_sizes.items():
+        contig_index[sequence] = [offset, length, 0]
+        offset += length
+    return contig_index
+
+
+def write_contig_index(contig_index, index_file):
+    """
+    Saves a contig index as Sequence   Offset  Length  Reads.
+    """
+    with open(index_file, 'w') as index_output:
+        index_output.write("Sequence\tOffset\tLength\tReads\n")
+        for sequence, (offset, length, reads) in contig_index.items():
+            index_output.write("{}\t{}\t{}\t{}\n".format(sequence, offset, length, reads))
+
+
+def read_contig_index(index_file):
+    """
+    Reads a contig index saved by write_contig_index.
+
+    Returns:
+        [dictionary] -- Sequence: [offset, length, reads]
+    """
+    contig_index = {}
+    with open(index_file) as index_input:
+        next(index_input)
+        for line in index_input:
+            sequence, offset, length, reads = line.rstrip("\n").split("\t")
+            contig_index[sequence] = [int(offset), int(length), int(reads)]
+    return contig_index
+
+
+def calculate_seq_depth_memmap(magicblast_file, genome_sizes, memmap_file, chunk_size=67108864, blocks=True,
+                               input_format="tabular"):
+    """
+    Calculates the base-by-base sequencing depth of all the contigs in one memory-mapped
+    file, so unsorted input of very large references is processed with bounded memory.
+    Contigs are placed one after the other (see build_contig_index) and reads are added
+    to a single difference array. Reads ending at the end of a contig are removed at the
+    first position of the next one, so one running sum over the file gives the depth of
+    every contig. The layout is saved in memmap_file.index.
+
+    Arguments:
+        magicblast_file {filepath} -- File with MagicBlast tabular output.
+        genome_sizes {dictionary} -- Lengths per sequence
+        memmap_file {filepath} -- Depth file to create (uint32 per base)
+        chunk_size {int} -- Bases added up at a time
+        blocks, input_format -- See read_coverage_events
+
+    Returns:
+        [tuple] -- Depth memmap (uint32) and contig index (see build_contig_index)
+    """
+    contig_index = build_contig_index(genome_sizes)
+    total_length = sum(genome_sizes.values())
+    difference = np.memmap(memmap_file, dtype=np.int32, mode='w+', shape=(total_length + 1,))
+    contig_codes = {}
+    code_offsets = np.zeros(0, dtype=np.int64)
+    code_lengths = np.zeros(0, dtype=np.int64)
+    code_reads = np.zeros(0, dtype=np.int64)
+
+    for hit_contigs, seq_starts, seq_ends, read_contigs in read_coverage_events(magicblast_file, contig_codes,
+                                                                                blocks, input_format):
+        if len(contig_codes) > len(code_offsets):
+            new_contigs = list(contig_codes)[len(code_offsets):]
+            missing = [sequence for sequence in new_contigs if sequence not in contig_index]
+            if missing:
+                raise KeyError("Sequences not found in the reference FastA: " + ", ".join(missing[:5]))
+            code_offsets = np.concatenate((code_offsets, [contig_index[sequence][0] for sequence in new_contigs]))
+            code_lengths = np.concatenate((code_lengths, [contig_index[sequence][1] for sequence in new_contigs]))
+            code_reads = np.concatenate((code_reads, np.zeros(len(new_contigs), dtype=np.int64)))
+        code_reads += np.bincount(read_contigs, minlength=len(code_reads))
+        seq_starts = code_offsets[hit_contigs] + np.clip(seq_starts, 0, code_lengths[hit_contigs])
+        seq_ends = code_offsets[hit_contigs] + np.clip(seq_ends, 0, code_lengths[hit_contigs])
+        np.add.at(difference, seq_starts, 1)
+        np.add.at(difference, seq_ends, -1)
+
+    # Running sum by chunks, carrying the depth over.
+    carry = 0
+    for start in range(0, total_length, chunk_size):
+        chunk = difference[start:min(start + chunk_size, total_length)]
+        np.cumsum(chunk, out=chunk)
+        chunk += carry
+        carry = int(chunk[-1])
+    difference.flush()
+
+    for sequence, reads in zip(contig_codes, code_reads):
+        contig_index[sequence][2] = int(reads)
+    write_contig_index(contig_index, memmap_file + ".index")
+    return difference.view(np.uint32), contig_index
+
+
+def open_depth_memmap(memmap_file):
+    """
+    Opens a depth file created by calculate_seq_depth_memmap, read only.
+
+    Arguments:
+        memmap_file {filepath} -- Depth file, with its memmap_file.index
 
-#TODO: Fix this table saving to avoid creating two huge data structures (save line by line).
-def save_sequencing_depth_table(genome_seq_depth, output_table):
+    Returns:
+        [tuple] -- Depth memmap (uint32) and contig index. The depth of a sequence is
+                   depth[offset:offset + length]
+    """
+    contig_index = read_contig_index(memmap_file + ".index")
+    depth = np.memmap(memmap_file, dtype=np.uint32, mode='r')
+    return depth, contig_index
+
+
+def open_depth_output(output_file, output_format="table"):
+    """
+    Opens a sequencing depth output:
+        table -- Sequence_Name   Position    Depth, one row per base
+        bedgraph -- Sequence_Name   Start   End     Depth, one row per run of bases with
+                    equal depth (0-based, end excluded)
+        npz -- NumPy archive with one uint32 array per sequence, named as the sequence
+
+    Arguments:
+        output_file {filepath} -- Output file
+        output_format {string} -- table, bedgraph or npz
+
+    Returns:
+        [file] -- Text file or zip archive (npz)
+    """
+    if output_format == "npz":
+        return zipfile.ZipFile(output_file, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+    output = open(output_file, 'w')
+    if output_format == "table":
+        output.write("Sequence\tPosition\tDepth\n")
+    return output
+
+
+def write_contig_depth(output, output_format, sequence, depth, chunk_size=1000000):
+    """
+    Writes the sequencing depth of a sequence to an output opened with open_depth_output.
+    Text rows are formatted in chunks of chunk_size bases (or runs).
+
+    Arguments:
+        output {file} -- Output from open_depth_output
+        output_format {string} -- table, bedgraph or npz
+        sequence {string} -- Sequence name
+        depth {array} -- Sequencing depth per base
+        chunk_size {int} -- Rows formatted at a time
+    """
+    if output_format == "npz":
+        with output.open(sequence + ".npy", 'w', force_zip64=True) as array_file:
+            np.lib.format.write_array(array_file, np.ascontiguousarray(depth, dtype=np.uint32))
+    elif output_format == "bedgraph":
+        changes = np.flatnonzero(depth[1:] != depth[:-1]) + 1
+        run_starts = np.concatenate(([0], changes))
+        run_ends = np.concatenate((changes, [len(depth)]))
+        for chunk in range(0, len(run_starts), chunk_size):
+            pd.DataFrame({"Sequence": sequence, "Start": run_starts[chunk:chunk+chunk_size],
+                          "End": run_ends[chunk:chunk+chunk_size],
+                          "Depth": depth[run_starts[chunk:chunk+chunk_size]]}).to_csv(output, sep="\t", header=False, index=False)
+    else:
+        for chunk in range(0, len(depth), chunk_size):
+            pd.DataFrame({"Sequence": sequence, "Position": np.arange(chunk + 1, min(chunk + chunk_size, len(depth)) + 1),
+                          "Depth": depth[chunk:chunk+chunk_size]}).to_csv(output, sep="\t", header=False, index=False)
+
+
+def save_sequencing_depth_table(genome_seq_depth, output_table, output_format="table"):
     """
     Saves a dictionary of arrays as a table with
     Sequence_Name   Position    Depth
+    or as a bedGraph or NumPy archive (see open_depth_output)
     
     Arguments:
         genome_seq_depth {dictionary} -- Array of per base sequence depth per genome
         output_table {path} -- Path of file to save table
+        output_format {string} -- table, bedgraph or npz
     """
-    sequences = []
-    positions = []
-    depths = []
-    genome_seq_depth_table = pd.DataFrame(columns=["Sequence","Position","Depth"])
-    for sequence, depth_array in genome_seq_depth.items():
-        sequence_list = [sequence] * len(depth_array)
-        sequences += sequence_list
-        position_array = np.array(range(len(depth_array))) + 1
-        positions += list(position_array)
-        depths += list(depth_array)
-    genome_seq_depth_table["Sequence"] = sequences
-    genome_seq_depth_table["Position"] = positions
-    genome_seq_depth_table["Depth"] = depths
-    genome_seq_depth_table.to_csv(output_table, sep="\t", header=True, index=False)
+    with open_depth_output(output_table, output_format) as output:
+        for sequence, depth_array in genome_seq_depth.items():
+            write_contig_depth(output, output_format, sequence, depth_array)
+
+
+def load_sequencing_depth(input_npz):
+    """
+    Loads the per-base sequencing depth saved as npz.
+
+    Arguments:
+        input_npz {filepath} -- NumPy archive written by save_sequencing_depth_table
+
+    Returns:
+        [NpzFile] -- Lazy mapping of sequence name to depth array
+    """
+    return np.load(input_npz)
 
 
 ################################################################################
@@ -149,24 +603,75 @@ def main():
     parser.add_argument('-f', '--fasta_sequences', dest='fasta_sequences', action='store', 
                         required=True, help='FastA file of reference sequences')
     parser.add_argument('-o', '--output_table', dest='output_table', action='store', 
-                        required=True, help='Output table in the form [Sequence Name]\t[Position]\t[Depth]')
+                        required=False, help='Output table in the form [Sequence Name]\t[Position]\t[Depth]')
+    parser.add_argument('--format', dest='output_format', action='store', required=False, default='table',
+                        choices=['table', 'bedgraph', 'npz'],
+                        help='Output format: per base table (table), run-length encoded bedGraph (bedgraph)\n'
+                             'or NumPy archive with one array per sequence (npz). By default table.')
     parser.add_argument('-s', '--sorted', dest='sorted_input', action='store_true', 
                         required=False, help='If input is sorted by the second column this will save memory.')
+    parser.add_argument('--memmap', dest='memmap_file', action='store', required=False,
+                        help='Calculate the depth of all the sequences in this memory-mapped file (uint32 per base),\n'
+                             'with the layout in [file].index, for large references or unsorted input with low memory.\n'
+                             'The output table (-o) is then optional.')
+    parser.add_argument('--stats_output', dest='stats_output', action='store', required=False,
+                        help='Write the TAD, breadth, mean and median depth per contig (and per genome with --separator)\n'
+                             'to this table, computed directly from the depth. The output table (-o) is then optional.')
+    parser.add_argument('--sam', dest='sam_input', action='store_true', required=False,
+                        help='Input is a SAM file (e.g. MagicBlast -outfmt sam), aligned blocks are read from the CIGAR.')
+    parser.add_argument('--full_span', dest='full_span', action='store_true', required=False,
+                        help='Count the whole span of each hit (sstart to send) as covered, including deletions and\n'
+                             'introns, instead of the aligned blocks in the BTOP string. Tabular input only.')
+    parser.add_argument('--tad', dest='tad', action='store', required=False, default=80, type=int,
+                        help='TAD percentage reported in --stats_output. By default 80.')
+    parser.add_argument('--separator', dest='separator', action='store', required=False,
+                        help='''String separating genome name from contig, adds genome rows to --stats_output.\n'''
+                             '''If separator has "-" or "--" pass it as --separator="--"''')
     args = parser.parse_args()
 
     magic_blast = args.magic_blast
     fasta_sequences = args.fasta_sequences
     output_table = args.output_table
     sorted_input = args.sorted_input
+    output_format = args.output_format
+    memmap_file = args.memmap_file
+    stats_output = args.stats_output
+    blocks = not args.full_span
+    input_format = "sam" if args.sam_input else "tabular"
+    separator = args.separator
+    if output_table is None and memmap_file is None and stats_output is None:
+        parser.error("an output table (-o), a memory-mapped file (--memmap) or a statistics table (--stats_output) is required")
+    contig_histograms = {} if stats_output is not None else None
+    read_counts = {}
 
     # Calculate Genome Length and Sequencing Depth
     genome_sizes = get_genome_sizes(fasta_sequences)
-    if sorted_input == True:
-        calculate_seq_depth_sorted(magic_blast, genome_sizes, output_table)
+    if memmap_file is not None:
+        depth, contig_index = calculate_seq_depth_memmap(magic_blast, genome_sizes, memmap_file,
+                                                         blocks=blocks, input_format=input_format)
+        output = open_depth_output(output_table, output_format) if output_table is not None else None
+        try:
+            for sequence, (offset, length, reads) in contig_index.items():
+                if reads > 0:
+                    store_contig_depth(output, output_format, sequence, depth[offset:offset+length], contig_histograms)
+                    read_counts[sequence] = reads
+        finally:
+            if output is not None:
+                output.close()
+    elif sorted_input == True:
+        calculate_seq_depth_sorted(magic_blast, genome_sizes, output_table, output_format, contig_histograms, read_counts,
+                                   blocks, input_format)
     else:
-        genome_seq_depth = calculate_seq_depth(magic_blast, genome_sizes)
+        genome_seq_depth = calculate_seq_depth(magic_blast, genome_sizes, read_counts, blocks, input_format)
         # Save output
-        save_sequencing_depth_table(genome_seq_depth, output_table)
+        if output_table is not None:
+            save_sequencing_depth_table(genome_seq_depth, output_table, output_format)
+        if contig_histograms is not None:
+            for sequence, depth_array in genome_seq_depth.items():
+                contig_histograms[sequence] = add_depth_histogram(None, depth_array)
+
+    if stats_output is not None:
+        write_depth_statistics(contig_histograms, genome_sizes, read_counts, args.tad, separator, stats_output)
 
 if __name__ == "__main__":
     main()
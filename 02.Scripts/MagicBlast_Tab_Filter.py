@@ -15,67 +15,255 @@
 # and only retains the first ocurrence per read (the highest scoring).
 # The regular option compares each ocurrence of a hit and determines the best
 # hit without you having to do additional work.
+# The grouped option (--grouped) streams the input one read at a time, relying
+# on MagicBlast writing the hits of each read together, and --threads filters
+# with several processes (partitioning ungrouped input by read).
 ########################################################################
 """
 ################################################################################
 """---0.0 Import Modules---"""
 from random import choice
-import argparse
+import argparse, os
 from sys import argv
+from zlib import crc32
+from Blast_Tabular_Reader import MAGICBLAST_COLUMNS, open_tabular, is_compressed
+from Blast_Filter_Expression import compile_filter
+from Blast_Tab_Filter import (best_hits_from_lines, first_hits_from_lines, find_shard_boundaries,
+                              read_shard_lines)
 
 ################################################################################
 """---1.0 Define Functions---"""
 
-def MagicBlast_filter_slow(input_tab, outfile, aln_fraction = 80, percent_id = 1):
+QUERY_COLUMN = MAGICBLAST_COLUMNS.index("qseqid")
+SCORE_COLUMN = MAGICBLAST_COLUMNS.index("score")
+
+def magicblast_filter_expression(aln_fraction = 80, percent_id = 1):
+    """
+    Builds the filter expression equivalent to the identity and fraction aligned options.
+
+    Returns:
+        [string] -- Filter expression (see Blast_Filter_Expression)
+    """
+    return "pident >= {!r} and (qend - qstart) * 100 / qlen >= {!r}".format(float(percent_id), float(aln_fraction))
+
+def hit_lines(lines):
+    """
+    Skips the comment lines (#) of a MagicBlast output.
+    """
+    for line in lines:
+        if not line.startswith("#"):
+            yield line
+
+def grouped_best_hits_from_lines(lines, hit_filter):
+    """
+    Yields the best high quality hit per read (a random one if tied) from lines
+    grouped by read, as MagicBlast writes them. Only the hits of the current read
+    are kept in memory.
+
+    Arguments:
+        lines {iterable} -- MagicBlast tabular lines
+        hit_filter {function} -- Compiled filter (see compile_filter)
+
+    Returns:
+        [generator] -- Retained lines
+    """
+    current_read = None
+    best_score = None
+    best_lines = []
+    for line in lines:
+        line = line.strip()
+        hit = line.split("\t")
+        if hit_filter(hit) == False:
+            continue
+        score = float(hit[SCORE_COLUMN])
+        if hit[QUERY_COLUMN] != current_read:
+            if best_lines:
+                yield choice(best_lines)
+            current_read = hit[QUERY_COLUMN]
+            best_score = score
+            best_lines = [line]
+        elif score > best_score:
+            best_score = score
+            best_lines = [line]
+        elif score == best_score:
+            best_lines.append(line)
+    if best_lines:
+        yield choice(best_lines)
+
+def MagicBlast_filter_slow(input_tab, outfile, aln_fraction = 80, percent_id = 1, filter_expression = None):
     print("Performing slow filtering...")
-    magicblast_hits = {}
-    with open(input_tab) as tabular:
-        for line in tabular:
-            if line.startswith('#'):
-                continue
-            else:
-                line = line.strip()
-                hit = line.split()
-                if float(hit[2]) < percent_id:
-                    continue
-                elif (float(hit[7]) - float(hit[6]) * 100 / float(hit[15])) < aln_fraction:
-                    continue
-                else:
-                    score = float(hit[12])
-                    if hit[0] not in magicblast_hits:
-                        magicblast_hits[hit[0]] = [score, [line]]
-                    else:
-                        if score < magicblast_hits[hit[0]][0]:
-                            continue
-                        elif score > magicblast_hits[hit[0]][0]:
-                            magicblast_hits[hit[0]] = [score, [line]]
-                        else:
-                            magicblast_hits[hit[0]][1].append(line)
+    if filter_expression is None:
+        filter_expression = magicblast_filter_expression(aln_fraction, percent_id)
+    print("Filter: " + filter_expression)
+    hit_filter = compile_filter(filter_expression, MAGICBLAST_COLUMNS)
+    with open_tabular(input_tab) as tabular:
+        magicblast_hits = best_hits_from_lines(hit_lines(tabular), hit_filter, QUERY_COLUMN, SCORE_COLUMN)
     with open(outfile, 'w') as output:
         for hit_values in magicblast_hits.values():
             output.write("{}\n".format(choice(hit_values[1])))
     print("Done! Check your output {}".format(outfile))
-                    
-def MagicBlast_filter_fast(input_tab, outfile, aln_fraction = 80, percent_id = 1):
+
+def MagicBlast_filter_fast(input_tab, outfile, aln_fraction = 80, percent_id = 1, filter_expression = None):
     print("Performing fast filtering...")
-    magicblast_hits = []
-    with open(input_tab, 'r') as tabular, open(outfile, 'w') as output:
-        for line in tabular:
-            if line.startswith("#"):
-                continue
-            else:
-                line = line.strip()
-                hit = line.split()
-                if float(hit[2]) < percent_id:
-                    continue
-                elif (float(hit[7]) - float(hit[6]) * 100 / float(hit[15])) < aln_fraction:
-                    continue
-                else:
-                    if hit[0] not in magicblast_hits:
-                        output.write("{}\n".format(line))
-                        magicblast_hits.append(hit[0])
-                    else:
-                        continue
+    if filter_expression is None:
+        filter_expression = magicblast_filter_expression(aln_fraction, percent_id)
+    print("Filter: " + filter_expression)
+    hit_filter = compile_filter(filter_expression, MAGICBLAST_COLUMNS)
+    with open_tabular(input_tab) as tabular, open(outfile, 'w') as output:
+        for line in first_hits_from_lines(hit_lines(tabular), hit_filter, QUERY_COLUMN):
+            output.write("{}\n".format(line))
+    print("Done! Check your output {}".format(outfile))
+
+def MagicBlast_filter_grouped(input_tab, outfile, aln_fraction = 80, percent_id = 1, filter_expression = None):
+    print("Performing grouped filtering...")
+    if filter_expression is None:
+        filter_expression = magicblast_filter_expression(aln_fraction, percent_id)
+    print("Filter: " + filter_expression)
+    hit_filter = compile_filter(filter_expression, MAGICBLAST_COLUMNS)
+    with open_tabular(input_tab) as tabular, open(outfile, 'w') as output:
+        for line in grouped_best_hits_from_lines(hit_lines(tabular), hit_filter):
+            output.write("{}\n".format(line))
+    print("Done! Check your output {}".format(outfile))
+
+
+### ------------------------- Parallel MagicBlast Parser -------------------------
+def filter_grouped_shard(shard):
+    """
+    Filters a byte range of a MagicBlast output grouped by read and saves the retained hits.
+
+    Arguments:
+        shard {tuple} -- Input file, start, end, shard output, filter expression and rapid
+
+    Returns:
+        [filepath] -- Shard output file
+    """
+    input_tab, start, end, shard_output, filter_expression, rapid = shard
+    hit_filter = compile_filter(filter_expression, MAGICBLAST_COLUMNS)
+    lines = hit_lines(read_shard_lines(input_tab, start, end))
+    if rapid == True:
+        retained = first_hits_from_lines(lines, hit_filter, QUERY_COLUMN)
+    else:
+        retained = grouped_best_hits_from_lines(lines, hit_filter)
+    with open(shard_output, 'w') as output:
+        for line in retained:
+            output.write("{}\n".format(line))
+    return shard_output
+
+def partition_shard(shard):
+    """
+    Reads a byte range of a MagicBlast output and writes its high quality hits to
+    one file per partition, choosing the partition from a hash of the read ID so
+    all the hits of a read end up in the same partition.
+
+    Arguments:
+        shard {tuple} -- Input file, start, end, prefix of the partition files,
+                         number of partitions and filter expression
+
+    Returns:
+        [list] -- Partition files, by partition number
+    """
+    input_tab, start, end, partition_prefix, partitions, filter_expression = shard
+    hit_filter = compile_filter(filter_expression, MAGICBLAST_COLUMNS)
+    partition_files = ["{}.part{}".format(partition_prefix, partition) for partition in range(partitions)]
+    outputs = [open(partition_file, 'w') for partition_file in partition_files]
+    try:
+        for line in hit_lines(read_shard_lines(input_tab, start, end)):
+            hit = line.rstrip("\n").split("\t")
+            if hit_filter(hit) == True:
+                outputs[crc32(hit[QUERY_COLUMN].encode()) % partitions].write(line)
+    finally:
+        for output in outputs:
+            output.close()
+    return partition_files
+
+def filter_partition(partition):
+    """
+    Retains the best (or first) hit per read of one partition. The files of the
+    partition are read in the order of the input shards, so "first" keeps its
+    meaning, and only the reads of this partition are held in memory.
+
+    Arguments:
+        partition {tuple} -- Partition files, partition output and rapid
+
+    Returns:
+        [filepath] -- Partition output file
+    """
+    partition_files, partition_output, rapid = partition
+    accept_all = lambda hit: True
+
+    def partition_lines():
+        for partition_file in partition_files:
+            with open(partition_file) as partition_hits:
+                for line in partition_hits:
+                    yield line
+            os.remove(partition_file)
+
+    with open(partition_output, 'w') as output:
+        if rapid == True:
+            for line in first_hits_from_lines(partition_lines(), accept_all, QUERY_COLUMN):
+                output.write("{}\n".format(line))
+        else:
+            magicblast_hits = best_hits_from_lines(partition_lines(), accept_all, QUERY_COLUMN, SCORE_COLUMN)
+            for hit_values in magicblast_hits.values():
+                output.write("{}\n".format(choice(hit_values[1])))
+    return partition_output
+
+def MagicBlast_filter_parallel(input_tab, outfile, aln_fraction = 80, percent_id = 1, filter_expression = None,
+                               rapid = False, grouped = False, threads = 2, partitions = None):
+    """
+    Filters a MagicBlast output with several processes.
+    Grouped input is split in byte ranges at read boundaries and each range is filtered
+    as a stream. Other input is first split in byte ranges whose high quality hits are
+    distributed into partitions by read ID, then the partitions are filtered in parallel.
+
+    Arguments:
+        input_tab {filepath} -- MagicBlast tabular output (plain)
+        outfile {filepath} -- Filtered output
+        rapid {bool} -- Retain the first high quality hit per read instead of the best
+        grouped {bool} -- Hits of each read are contiguous (MagicBlast default)
+        threads {int} -- Number of processes
+        partitions {int} -- Number of read partitions for ungrouped input, more partitions
+                            use less memory per process. By default 4 per process
+    """
+    import multiprocessing
+    from shutil import copyfileobj
+    if is_compressed(input_tab) is not None:
+        print("Compressed input cannot be split in byte ranges, filtering on a single process.")
+        if rapid == True:
+            MagicBlast_filter_fast(input_tab, outfile, aln_fraction, percent_id, filter_expression)
+        elif grouped == True:
+            MagicBlast_filter_grouped(input_tab, outfile, aln_fraction, percent_id, filter_expression)
+        else:
+            MagicBlast_filter_slow(input_tab, outfile, aln_fraction, percent_id, filter_expression)
+        return
+    print("Performing {} filtering using {} processes...".format("grouped" if grouped else "partitioned", threads))
+    if filter_expression is None:
+        filter_expression = magicblast_filter_expression(aln_fraction, percent_id)
+    print("Filter: " + filter_expression)
+    shard_ranges = find_shard_boundaries(input_tab, threads)
+    pool = multiprocessing.Pool(threads)
+    try:
+        if grouped == True:
+            shards = [(input_tab, start, end, "{}.shard{}".format(outfile, shard_number), filter_expression, rapid)
+                      for shard_number, (start, end) in enumerate(shard_ranges)]
+            filtered_outputs = pool.map(filter_grouped_shard, shards, chunksize=1)
+        else:
+            if partitions is None:
+                partitions = threads * 4
+            shards = [(input_tab, start, end, "{}.shard{}".format(outfile, shard_number), partitions, filter_expression)
+                      for shard_number, (start, end) in enumerate(shard_ranges)]
+            shard_partitions = pool.map(partition_shard, shards, chunksize=1)
+            partition_jobs = [([partition_files[partition] for partition_files in shard_partitions],
+                               "{}.partition{}".format(outfile, partition), rapid) for partition in range(partitions)]
+            filtered_outputs = pool.map(filter_partition, partition_jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    with open(outfile, 'w') as output:
+        for filtered_output in filtered_outputs:
+            with open(filtered_output) as filtered_hits:
+                copyfileobj(filtered_hits, output)
+            os.remove(filtered_output)
     print("Done! Check your output {}".format(outfile))
 
 ################################################################################
@@ -95,15 +283,26 @@ def main():
             '''Global mandatory parameters: -i [Input File] -o [Output File]\n'''
             '''Optional Database Parameters: See ''' + argv[0] + ' -h')
     parser.add_argument('-i', '--input_tab', dest='input_tab', action='store', required=True, 
-    help='Input MagicBlast tabular file.')
+    help='Input MagicBlast tabular file (plain, gzip or zstd).')
     parser.add_argument('-o', '--output', dest='outfile', action='store', required=True, 
     help='Output Table')
-    parser.add_argument('-p', '--pidentity', dest='percent_id', action='store', required=True, type=int, 
+    parser.add_argument('-p', '--pidentity', dest='percent_id', action='store', required=False, type=int, 
     help='Percentage identity of matches to retain. By default no identity filter.', default=0)
     parser.add_argument('-f', '--fraction', dest='aln_fraction', action='store', required=False, type=int, 
     help='Minimum percentage of read aligned to be included. By default 80', default=80)
+    parser.add_argument('--filter', dest='filter_expression', action='store', required=False,
+    help='Filter expression used instead of -p and -f, e.g. "pident >= 95 and (qend - qstart) * 100 / qlen >= 80".\n'
+    'Columns: ' + ' '.join(MAGICBLAST_COLUMNS))
     parser.add_argument('--rapid', dest='rapid_filter', action='store_true', required=False, 
     help='Perform rapid filter. Only retains first high quality occurrence. Useful if pre-shuffled and sorted input.')
+    parser.add_argument('--grouped', '--sorted', dest='grouped', action='store_true', required=False,
+    help='Input is grouped by read (MagicBlast default). Keeps only the hits of one read in memory.')
+    parser.add_argument('-t', '--threads', dest='threads', action='store', required=False, type=int, default=1,
+    help='Number of processes. Grouped input is split at read boundaries, other input is partitioned\n'
+    'by read in temporary files next to the output. Requires uncompressed input. By default 1')
+    parser.add_argument('--partitions', dest='partitions', action='store', required=False, type=int,
+    help='Number of read partitions used with --threads on ungrouped input. More partitions\n'
+    'use less memory per process. By default 4 per process')
     args = parser.parse_args()
 
     input_tab = args.input_tab
@@ -111,11 +310,19 @@ def main():
     percent_id = args.percent_id
     aln_fraction = args.aln_fraction
     rapid_filter = args.rapid_filter
+    filter_expression = args.filter_expression
+    grouped = args.grouped
+    threads = args.threads
 
-    if rapid_filter == True:
-        MagicBlast_filter_fast(input_tab, outfile, aln_fraction, percent_id)
+    if threads > 1:
+        MagicBlast_filter_parallel(input_tab, outfile, aln_fraction, percent_id, filter_expression,
+                                   rapid_filter, grouped, threads, args.partitions)
+    elif rapid_filter == True:
+        MagicBlast_filter_fast(input_tab, outfile, aln_fraction, percent_id, filter_expression)
+    elif grouped == True:
+        MagicBlast_filter_grouped(input_tab, outfile, aln_fraction, percent_id, filter_expression)
     else:
-        MagicBlast_filter_slow(input_tab, outfile, aln_fraction, percent_id)
+        MagicBlast_filter_slow(input_tab, outfile, aln_fraction, percent_id, filter_expression)
 
 if __name__ == "__main__":
     main()
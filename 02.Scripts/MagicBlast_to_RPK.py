@@ -7,60 +7,164 @@
 # Version:	  1.0
 # Date:		 14 August 2019
 
-# Description: This script filters a MagicBlast tabular output based
-# on the id percentage of the read and the length aligned.
+# Description: This script counts the reads recruited by each reference
+# genome in one or more MagicBlast tabular outputs and returns a
+# genomes x samples table of bases or reads per kilobase (RPK, RPKM).
 ########################################################################
 """
 
 ################################################################################
 
 """---1.0 Import Modules---"""
+import multiprocessing
+from pathlib import Path
 import numpy as np
 import pandas as pd
 from Bio.SeqIO.FastaIO import SimpleFastaParser
+from Blast_Tabular_Reader import MAGICBLAST_COLUMNS, read_tabular_batches
 
 ################################################################################
 
 """---2.0 Define Functions---"""
 
+def Contig_Genome(Contig):
+    """
+    Returns the genome of a contig: the contig name without its last "_" field,
+    except for viral contigs (VC_), which are their own genome.
+    """
+    if "VC_" in Contig:
+        return Contig
+    else:
+        return "_".join(Contig.split("_")[:-1])
+
+
 def Get_Genome_Sizes(Fasta_File):
-    Genome_Sizes = {}
+    """
+    Maps the reference contigs to their genomes and adds up the genome lengths.
+    Contigs are named by the first word of their header, as in the MagicBlast sseqid.
+
+    Arguments:
+        Fasta_File {filepath} -- FastA file with the reference contigs
+
+    Returns:
+        [tuple] -- Contig: code (in FastA order), genome code per contig (array),
+                   genome names and genome lengths (array)
+    """
+    Contig_Codes = {}
+    Genome_Codes = {}
+    Contig_Genomes = []
+    Genome_Lengths = []
     with open(Fasta_File) as Fasta:
         for title, seq in SimpleFastaParser(Fasta):
-            if "VC_" in title:
-                Genome = title
-            else:
-                Genome = title.split("_")
-                Genome = "_".join(Genome[:-1])
-            if Genome not in Genome_Sizes:
-                Genome_Sizes[Genome] = len(seq)
-    return Genome_Sizes
-
-
-def Calculate_Seq_Depth(MagicBlast_File, Genome_Sizes):
-    Genomes = {}
-    Read_Lenght = []
-    
-    with open(MagicBlast_File) as Input:
-        for line in Input:
-            line = line.strip().split()
-            if "VC_" in line[1]:
-                Genome = line[1]
-            else:
-                Genome = line[1].split("_")
-                Genome = "_".join(Genome[:-1])
-            if Genome not in Genomes:
-                Genomes[Genome] = 0
-                Genomes[Genome] += 1
-                Read_Lenght.append(int(line[15]))
-            else:
-                Genomes[Genome] += 1
-                Read_Lenght.append(int(line[15]))
-    
-    Read_Lenght = np.asarray(Read_Lenght)
-    Mean_Read_Len = np.mean(Read_Lenght)
-    
-    return(Genomes, Mean_Read_Len)
+            Contig = title.split()[0]
+            Genome = Contig_Genome(Contig)
+            if Genome not in Genome_Codes:
+                Genome_Codes[Genome] = len(Genome_Codes)
+                Genome_Lengths.append(0)
+            Contig_Codes[Contig] = len(Contig_Codes)
+            Contig_Genomes.append(Genome_Codes[Genome])
+            Genome_Lengths[Genome_Codes[Genome]] += len(seq)
+    return (Contig_Codes, np.array(Contig_Genomes, dtype=np.int64), list(Genome_Codes),
+            np.array(Genome_Lengths, dtype=np.int64))
+
+
+def Child_Initialize(_Contig_Codes, _Contig_Genomes, _Genome_Number):
+    """
+    Makes the reference mapping shared by all the samples available to the worker processes.
+    """
+    global Contig_Codes, Contig_Genomes, Genome_Number
+    Contig_Codes = _Contig_Codes
+    Contig_Genomes = _Contig_Genomes
+    Genome_Number = _Genome_Number
+
+
+def Calculate_Seq_Depth(MagicBlast_File):
+    """
+    Counts the reads recruited by each genome in one sample. Uses the reference
+    mapping set by Child_Initialize.
+
+    Arguments:
+        MagicBlast_File {filepath} -- File with MagicBlast tabular output
+
+    Returns:
+        [tuple] -- Input file, reads per genome (array), total reads and mean read length
+    """
+    # Reference contigs keep their FastA order as codes, so codes index Contig_Genomes.
+    Contigs = dict(Contig_Codes)
+    Genome_Reads = np.zeros(Genome_Number, dtype=np.int64)
+    Total_Reads = 0
+    Total_Read_Length = 0
+
+    for Hits in read_tabular_batches(MagicBlast_File, MAGICBLAST_COLUMNS, ["sseqid", "qlen"], dictionaries={"sseqid": Contigs}):
+        if len(Contigs) > len(Contig_Codes):
+            Missing = list(Contigs)[len(Contig_Codes):]
+            raise KeyError("Sequences not found in the reference FastA: " + ", ".join(Missing[:5]))
+        Genome_Reads += np.bincount(Contig_Genomes[Hits["sseqid"]], minlength=Genome_Number)
+        Total_Reads += len(Hits)
+        Total_Read_Length += int(Hits["qlen"].sum())
+
+    Mean_Read_Len = Total_Read_Length / Total_Reads if Total_Reads > 0 else 0.0
+
+    return(MagicBlast_File, Genome_Reads, Total_Reads, Mean_Read_Len)
+
+
+def Sample_Abundance(Genome_Reads, Genome_Lengths, Total_Reads, Mean_Read_Len, Metric="bpk"):
+    """
+    Normalizes the reads per genome of a sample:
+        bpk -- Bases recruited per kilobase of genome (reads * mean read length / kb)
+        rpk -- Reads per kilobase of genome
+        rpkm -- Reads per kilobase of genome per million reads recruited in the sample
+
+    Returns:
+        [array] -- Abundance per genome
+    """
+    Genome_Kb = Genome_Lengths / 1000
+    if Metric == "bpk":
+        return Genome_Reads * Mean_Read_Len / Genome_Kb
+    RPK = Genome_Reads / Genome_Kb
+    if Metric == "rpkm":
+        return RPK / (Total_Reads / 1e6) if Total_Reads > 0 else RPK * 0
+    return RPK
+
+
+def MagicBlast_to_Abundance(MagicBlast_Files, Fasta_File, Sample_Names, Metric="bpk", Threads=1):
+    """
+    Builds a genomes x samples abundance table from the MagicBlast outputs of many samples.
+
+    Arguments:
+        MagicBlast_Files {list} -- Files with MagicBlast tabular output, one per sample
+        Fasta_File {filepath} -- FastA file with the reference contigs
+        Sample_Names {list} -- Sample name per file, must be unique
+        Metric {string} -- bpk, rpk or rpkm (see Sample_Abundance)
+        Threads {int} -- Samples processed at the same time
+
+    Returns:
+        [DataFrame] -- Abundance with genomes as rows and samples as columns
+    """
+    if len(set(Sample_Names)) != len(Sample_Names):
+        raise ValueError("Sample names must be unique: " + ", ".join(Sample_Names))
+    Contig_Codes, Contig_Genomes, Genome_Names, Genome_Lengths = Get_Genome_Sizes(Fasta_File)
+    Results = {}
+    if Threads <= 1 or len(MagicBlast_Files) <= 1:
+        Child_Initialize(Contig_Codes, Contig_Genomes, len(Genome_Names))
+        for MagicBlast_File in MagicBlast_Files:
+            Result = Calculate_Seq_Depth(MagicBlast_File)
+            Results[Result[0]] = Result[1:]
+    else:
+        pool = multiprocessing.Pool(min(Threads, len(MagicBlast_Files)), initializer = Child_Initialize,
+                                    initargs = (Contig_Codes, Contig_Genomes, len(Genome_Names)))
+        for Result in pool.imap_unordered(Calculate_Seq_Depth, MagicBlast_Files):
+            Results[Result[0]] = Result[1:]
+        pool.close()
+        pool.join()
+
+    Table = {}
+    for MagicBlast_File, Sample in zip(MagicBlast_Files, Sample_Names):
+        Genome_Reads, Total_Reads, Mean_Read_Len = Results[MagicBlast_File]
+        Table[Sample] = Sample_Abundance(Genome_Reads, Genome_Lengths, Total_Reads, Mean_Read_Len, Metric)
+    Table = pd.DataFrame(Table, index=Genome_Names)
+    Table.index.name = "Genome"
+    return Table
 
 ################################################################################
 """---3.0 Main Function---"""
@@ -68,35 +172,41 @@ def Calculate_Seq_Depth(MagicBlast_File, Genome_Sizes):
 def main():
     import argparse, sys
     # Setup parser for arguments.
-    parser = argparse.ArgumentParser(description='''This script parses MAPLE's output and returns a table with each KEGG KO ID with its associated module and step in that module\n
-                                                     The input should be any .matrix file from either the KAAS or the BLAST folders.'''
-                                    'Global mandatory parameters: [Maple_Output] [Output Table]\n'
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                     description='''This script counts the reads recruited by each genome in one or more\n'''
+                                     '''MagicBlast tabular outputs and returns a genomes x samples table of\n'''
+                                     '''bases per kb (bpk), reads per kb (rpk) or reads per kb per million reads (rpkm).\n'''
+                                     '''Contigs are grouped into genomes by removing their last "_" field (except VC_ contigs).\n'''
+                                    'Global mandatory parameters: [MagicBlast Files] [Reference FastA] [Output Table]\n'
                                     'Optional Database Parameters: See ' + sys.argv[0] + ' -h')
-    parser.add_argument("-i", "--inputMagicBlast", dest='MagicBlast', action='store', required=True, help="Input Maple Annotation")
-    parser.add_argument('-f', '--genomes', dest='Genomes_File', action='store', required=True, help='Mapping file from KO IDs to gene, downloaded from https://www.genome.jp/kegg-bin/get_htext#B1')
-    parser.add_argument('-o', '--outputTable', dest='Output_Table', action='store', required=True, help='Output table in the form KEGG_ID Module Step')
-    parser.add_argument('-s', '--sample', dest='Sample_Name', action='store', required=True, help='Output table in the form KEGG_ID Module Step')
+    parser.add_argument("-i", "--inputMagicBlast", dest='MagicBlast', action='store', nargs='+', required=True,
+                        help="MagicBlast tabular outputs, one per sample")
+    parser.add_argument('-f', '--genomes', dest='Genomes_File', action='store', required=True,
+                        help='FastA file with the reference contigs')
+    parser.add_argument('-o', '--outputTable', dest='Output_Table', action='store', required=True,
+                        help='Output table with genomes as rows and samples as columns')
+    parser.add_argument('-s', '--sample', dest='Sample_Name', action='store', nargs='+', required=False,
+                        help='Sample name per input file. By default the file names without their last extension')
+    parser.add_argument('-m', '--metric', dest='Metric', action='store', required=False, default="bpk",
+                        choices=["bpk", "rpk", "rpkm"], help='Abundance metric. By default bpk')
+    parser.add_argument('-t', '--threads', dest='Threads', action='store', required=False, default=1, type=int,
+                        help='Samples processed in parallel. By default 1')
     args = parser.parse_args()
 
     MagicBlast = args.MagicBlast
     Genomes_File = args.Genomes_File
     Output_Table = args.Output_Table
     Sample_Name = args.Sample_Name
-
-
-    # Calculate Genome Length and Sequencing Depth
-    Genome_Sizes = Get_Genome_Sizes(Genomes_File)
-    (Seq_Depth, Mean_Read_Len) = Calculate_Seq_Depth(MagicBlast, Genome_Sizes)
-    
-    # Merge into a single Table
-    Genome_Depth = {}
-    for key, value in Seq_Depth.items():
-        Genome_Depth[key] = ((value * Mean_Read_Len) / (Genome_Sizes[key])) * 1000
-
-
-    Table = pd.DataFrame.from_dict(Genome_Depth, orient='index')
-    Table.columns = [Sample_Name]
-    Table.index.name = "Genome"
+    if Sample_Name is None:
+        Sample_Name = [Path(File).stem for File in MagicBlast]
+    elif len(Sample_Name) != len(MagicBlast):
+        parser.error("give one sample name (-s) per input file (-i)")
+    if len(set(Sample_Name)) != len(Sample_Name):
+        parser.error("sample names must be unique, found repeated names: {} (name them with -s)".format(
+            ", ".join(sorted(set(Name for Name in Sample_Name if Sample_Name.count(Name) > 1)))))
+
+    # Calculate the abundance of each genome per sample
+    Table = MagicBlast_to_Abundance(MagicBlast, Genomes_File, Sample_Name, args.Metric, args.Threads)
     Table.to_csv(Output_Table, sep="\t")
 
 
@@ -9,7 +9,9 @@
 # Date:		   14 March 2020
 
 # Description: This script parses a base-by-base sequencing depth file
-# and calculates the TAD (Truncated Average Sequencing Depth) per genome.
+# (table, npz or memmap from MagicBlast_SeqDepth.py) and calculates the TAD
+# (Truncated Average Sequencing Depth) per genome from histograms of the
+# per-base depths, in one pass over the input.
 # By default it calculates the TAD80 removing the 10% top and bottom
 # covered bases, which takes care of highly (conserved) or poorly (contig
 # edges) covered genome regions.
@@ -20,69 +22,264 @@
 
 """---1.0 Import Modules---"""
 from Bio.SeqIO.FastaIO import SimpleFastaParser
-from statistics import mean
-import argparse, sys
+import argparse, sys, os, zipfile
 
 ################################################################################
 
 """---2.0 Define Functions---"""
-def calculate_tad_from_file(input_table, tad_percent, separator, outfile):
-    to_remove = (100 - tad_percent)/2
-    genome_seq = {}
-    if separator is None:
-        with open(input_table, 'r') as seqdepth:
-            for line in seqdepth:
-                if line.startswith('Sequence'):
-                    continue
-                else:
-                    line = line.strip().split()
-                    if line[0] not in genome_seq:
-                        genome_seq[line[0]] = [float(line[2])]
-                    else:
-                        genome_seq[line[0]].append(float(line[2]))
-    else:
-        with open(input_table, 'r') as seqdepth:
-            for line in seqdepth:
-                if line.startswith('Sequence'):
-                    continue
-                else:
-                    line = line.strip().split()
-                    genome = line[0].split(separator)[0]
-                    if genome not in genome_seq:
-                        genome_seq[genome] = [float(line[2])]
-                    else:
-                        genome_seq[genome].append(float(line[2]))
-    
+def merge_depth_histograms(histogram, counts):
+    """
+    Adds a depth histogram to another.
+
+    Arguments:
+        histogram {array} -- Number of bases per depth value (index), or None to start one.
+                             Updated in place when long enough
+        counts {array} -- Histogram to add, left unchanged
+
+    Returns:
+        [array] -- Updated histogram
+    """
+    if histogram is None:
+        return counts.copy()
+    if len(counts) > len(histogram):
+        counts = counts.copy()
+        counts[:len(histogram)] += histogram
+        return counts
+    histogram[:len(counts)] += counts
+    return histogram
+
+def add_depth_histogram(histogram, depth):
+    """
+    Adds the per-base depths of a sequence to a depth histogram.
+
+    Arguments:
+        histogram {array} -- Number of bases per depth value (index), or None to start one
+        depth {array} -- Per-base depths (non-negative integers)
+
+    Returns:
+        [array] -- Updated histogram, extended if depth has higher values
+    """
+    import numpy as np
+    return merge_depth_histograms(histogram, np.bincount(np.asarray(depth, dtype=np.int64).ravel()))
+
+def histogram_truncated_average(histogram, tad_percent):
+    """
+    Calculates the truncated average depth from a depth histogram, trimming the
+    top and bottom (100 - tad_percent)/2 percent of the bases from the cumulative counts.
+
+    Arguments:
+        histogram {array} -- Number of bases per depth value (index)
+        tad_percent {int} -- TAD percentage to calculate
+
+    Returns:
+        [float] -- Truncated average depth
+    """
+    import numpy as np
+    if histogram is None:
+        return 0.0
+    histogram = np.asarray(histogram, dtype=np.int64)
+    total = int(histogram.sum())
+    positions = round(total*(100 - tad_percent)/2/100)
+    low, high = positions, total - positions
+    if high <= low:
+        return 0.0
+    # Bases of each depth value kept between ranks low and high of the sorted depths.
+    cumulative = np.cumsum(histogram)
+    kept = np.clip(np.minimum(cumulative, high) - np.maximum(cumulative - histogram, low), 0, None)
+    return float(np.dot(kept, np.arange(len(histogram), dtype=np.float64)) / (high - low))
+
+def truncated_average_depth(depth_arrays, tad_percent, total_length=None):
+    """
+    Calculates the TAD of a genome from the per-base depth of its contigs.
+
+    Arguments:
+        depth_arrays {list} -- Per-base depth arrays
+        tad_percent {int} -- TAD percentage to calculate
+        total_length {int} -- Genome length, bases missing from depth_arrays have depth 0.
+                              By default the total length of the arrays
+
+    Returns:
+        [float] -- Truncated average depth
+    """
+    histogram = None
+    for depth in depth_arrays:
+        histogram = add_depth_histogram(histogram, depth)
+    covered = 0 if histogram is None else int(histogram.sum())
+    if total_length is not None and total_length > covered:
+        histogram = add_depth_histogram(histogram, [0])
+        histogram[0] += total_length - covered - 1
+    return histogram_truncated_average(histogram, tad_percent)
+
+def calculate_tad_from_file(input_table, tad_percent, separator, outfile, chunk_size=5000000):
+    """
+    Calculates the TAD per genome from a per-base sequencing depth table
+    (Sequence  Position  Depth). The table is read in chunks and each genome
+    is kept as a histogram of its depths, so memory does not grow with its length.
+
+    Arguments:
+        input_table {filepath} -- Sequencing depth table
+        tad_percent {int} -- TAD percentage to calculate
+        separator {string} -- String separating genome name from contig, None for contigs
+        outfile {filepath} -- Output table
+        chunk_size {int} -- Rows read at a time
+    """
+    import pandas as pd
+    with open(input_table, 'r') as seqdepth:
+        header = 0 if seqdepth.readline().startswith('Sequence') else None
+    genome_histograms = {}
+    for chunk in pd.read_csv(input_table, sep="\t", header=header, names=["Sequence", "Position", "Depth"],
+                             usecols=["Sequence", "Depth"],
+                             dtype={"Sequence": str, "Depth": "int64"}, chunksize=chunk_size):
+        contigs = chunk["Sequence"]
+        if separator is not None:
+            contigs = contigs.str.split(separator, n=1).str[0]
+        for genome, rows in chunk["Depth"].groupby(contigs.to_numpy(), sort=False):
+            genome_histograms[genome] = add_depth_histogram(genome_histograms.get(genome), rows.to_numpy())
+
     with open(outfile, 'w') as output:
         output.write("Genome\tTAD{}\n".format(tad_percent))
-        for genome, depth in genome_seq.items():
-            positions = round(len(depth)*to_remove/100)
-            seq_sorted = sorted(depth, key=float)[positions:-positions]
-            output.write("{}\t{}\n".format(genome, round(mean(seq_sorted),3)))
+        for genome, histogram in genome_histograms.items():
+            tad = histogram_truncated_average(histogram, tad_percent)
+            output.write("{}\t{}\n".format(genome, round(tad,3)))
+
+def calculate_tad_from_npz(input_npz, tad_percent, separator, outfile):
+    """
+    Calculates the TAD per genome from the per-base sequencing depth arrays
+    saved by MagicBlast_SeqDepth.py with --format npz. Only the contigs of one
+    genome are loaded at a time.
+
+    Arguments:
+        input_npz {filepath} -- NumPy archive with one depth array per contig
+        tad_percent {int} -- TAD percentage to calculate
+        separator {string} -- String separating genome name from contig, None for contigs
+        outfile {filepath} -- Output table
+    """
+    import numpy as np
+    with np.load(input_npz) as seqdepth:
+        genome_contigs = {}
+        for contig in seqdepth.files:
+            genome = contig if separator is None else contig.split(separator)[0]
+            genome_contigs.setdefault(genome, []).append(contig)
+        with open(outfile, 'w') as output:
+            output.write("Genome\tTAD{}\n".format(tad_percent))
+            for genome, contigs in genome_contigs.items():
+                tad = truncated_average_depth([seqdepth[contig] for contig in contigs], tad_percent)
+                output.write("{}\t{}\n".format(genome, round(tad,3)))
+
+def calculate_tad_from_memmap(memmap_file, tad_percent, separator, outfile):
+    """
+    Calculates the TAD per genome from the memory-mapped depth file created by
+    MagicBlast_SeqDepth.py with --memmap. Contigs without reads are skipped, as
+    in the other depth formats.
+
+    Arguments:
+        memmap_file {filepath} -- Depth file, with its memmap_file.index
+        tad_percent {int} -- TAD percentage to calculate
+        separator {string} -- String separating genome name from contig, None for contigs
+        outfile {filepath} -- Output table
+    """
+    from MagicBlast_SeqDepth import open_depth_memmap
+    depth, contig_index = open_depth_memmap(memmap_file)
+    genome_contigs = {}
+    for contig, (offset, length, reads) in contig_index.items():
+        if reads > 0:
+            genome = contig if separator is None else contig.split(separator)[0]
+            genome_contigs.setdefault(genome, []).append(depth[offset:offset+length])
+    with open(outfile, 'w') as output:
+        output.write("Genome\tTAD{}\n".format(tad_percent))
+        for genome, contig_depths in genome_contigs.items():
+            tad = truncated_average_depth(contig_depths, tad_percent)
+            output.write("{}\t{}\n".format(genome, round(tad,3)))
 
 def calculate_tad_from_dict(input_dict, tad_percent, separator, outfile):
-    to_remove = (100 - tad_percent)/2
-    genome_seq = {}
-    if separator is None:
-        for contig, seq_depth in input_dict.items():
-            if contig not in genome_seq:
-                genome_seq[contig] = seq_depth
-            else:
-                genome_seq[contig] += seq_depth
-    else:
-        for contig, seq_depth in input_dict.items():
-            genome = contig.split(separator)[0]
-            if genome not in genome_seq:
-                genome_seq[genome] = seq_depth
-            else:
-                genome_seq[genome] += seq_depth
+    """
+    Calculates the TAD per genome from a dictionary of per-base depth arrays,
+    as returned by MagicBlast_SeqDepth.calculate_seq_depth.
+
+    Arguments:
+        input_dict {dictionary} -- Sequence: depth array
+        tad_percent {int} -- TAD percentage to calculate
+        separator {string} -- String separating genome name from contig, None for contigs
+        outfile {filepath} -- Output table
+    """
+    genome_histograms = {}
+    for contig, seq_depth in input_dict.items():
+        genome = contig if separator is None else contig.split(separator)[0]
+        genome_histograms[genome] = add_depth_histogram(genome_histograms.get(genome), seq_depth)
 
     with open(outfile, 'w') as output:
         output.write("Genome\tTAD{}\n".format(tad_percent))
-        for genome, depth in genome_seq.items():
-            positions = round(len(depth)*to_remove/100)
-            seq_sorted = sorted(depth, key=float)[positions:-positions]
-            output.write("{}\t{}\n".format(genome, round(mean(seq_sorted),1)))
+        for genome, histogram in genome_histograms.items():
+            tad = histogram_truncated_average(histogram, tad_percent)
+            output.write("{}\t{}\n".format(genome, round(tad,3)))
+
+def histogram_median(histogram):
+    """
+    Calculates the median depth from a depth histogram.
+    """
+    import numpy as np
+    cumulative = np.cumsum(histogram)
+    total = int(cumulative[-1]) if len(cumulative) else 0
+    if total == 0:
+        return 0.0
+    lower = int(np.searchsorted(cumulative, (total - 1)//2, side='right'))
+    upper = int(np.searchsorted(cumulative, total//2, side='right'))
+    return (lower + upper)/2
+
+def depth_statistics(histogram, tad_percent):
+    """
+    Calculates the coverage statistics of a sequence or genome from its depth histogram.
+
+    Arguments:
+        histogram {array} -- Number of bases per depth value (index)
+        tad_percent {int} -- TAD percentage to calculate
+
+    Returns:
+        [list] -- TAD, breadth (fraction of bases covered), mean and median depth
+    """
+    import numpy as np
+    length = int(histogram.sum())
+    if length == 0:
+        return [0.0, 0.0, 0.0, 0.0]
+    mean_depth = float(np.dot(histogram, np.arange(len(histogram), dtype=np.float64))) / length
+    breadth = (length - int(histogram[0])) / length
+    return [histogram_truncated_average(histogram, tad_percent), breadth, mean_depth, histogram_median(histogram)]
+
+def write_depth_statistics(contig_histograms, genome_sizes, read_counts, tad_percent, separator, outfile):
+    """
+    Writes the coverage statistics of each reference contig and, if a separator
+    is given, of each genome, as
+    Sequence  Level (contig/genome)  Length  Reads  TAD  Breadth  Mean_Depth  Median_Depth
+    Contigs without reads are included with depth 0.
+
+    Arguments:
+        contig_histograms {dictionary} -- Contig: depth histogram (see add_depth_histogram)
+        genome_sizes {dictionary} -- Lengths per sequence, sets the contigs and their order
+        read_counts {dictionary} -- Contig: reads
+        tad_percent {int} -- TAD percentage to calculate
+        separator {string} -- String separating genome name from contig, None for contigs only
+        outfile {filepath} -- Output table
+    """
+    import numpy as np
+    genome_histograms = {}
+    genome_reads = {}
+    with open(outfile, 'w') as output:
+        output.write("Sequence\tLevel\tLength\tReads\tTAD{}\tBreadth\tMean_Depth\tMedian_Depth\n".format(tad_percent))
+        for contig, length in genome_sizes.items():
+            histogram = contig_histograms.get(contig)
+            if histogram is None:
+                histogram = np.array([length], dtype=np.int64)
+            reads = read_counts.get(contig, 0)
+            statistics = [round(value, 4) for value in depth_statistics(histogram, tad_percent)]
+            output.write("{}\tcontig\t{}\t{}\t{}\n".format(contig, length, reads, "\t".join(map(str, statistics))))
+            if separator is not None:
+                genome = contig.split(separator)[0]
+                genome_histograms[genome] = merge_depth_histograms(genome_histograms.get(genome), histogram)
+                genome_reads[genome] = genome_reads.get(genome, 0) + reads
+        for genome, histogram in genome_histograms.items():
+            statistics = [round(value, 4) for value in depth_statistics(histogram, tad_percent)]
+            output.write("{}\tgenome\t{}\t{}\t{}\n".format(genome, int(histogram.sum()), genome_reads[genome],
+                                                               "\t".join(map(str, statistics))))
 
 
 ################################################################################
@@ -99,7 +296,7 @@ def main():
                         '''Global mandatory parameters: [MagicBlast File] [Reference FastA]\n'''
                         'Optional Database Parameters: See ' + sys.argv[0] + ' -h')
     parser.add_argument("-i", "--input_seqdepth", dest='seqdepth', action='store', 
-                        required=True, help="Input table with sequencing depth per base")
+                        required=True, help="Input table with sequencing depth per base, or npz or memmap file from MagicBlast_SeqDepth.py")
     parser.add_argument('-o', '--output_table', dest='output_table', action='store', 
                         required=True, help='Output table in the form [Sequence Name]\t[Position]\t[Depth]')
     parser.add_argument('--tad', dest='tad', action='store', required=False, default=80, type=int,
@@ -117,7 +314,12 @@ def main():
         separator = separator[0]
 
     # Calculate TAD and store results
-    calculate_tad_from_file(seqdepth, tad, separator, output_table)
+    if os.path.exists(seqdepth + ".index"):
+        calculate_tad_from_memmap(seqdepth, tad, separator, output_table)
+    elif zipfile.is_zipfile(seqdepth):
+        calculate_tad_from_npz(seqdepth, tad, separator, output_table)
+    else:
+        calculate_tad_from_file(seqdepth, tad, separator, output_table)
 
 
 if __name__ == "__main__":